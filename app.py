@@ -1,19 +1,64 @@
 import os
 import json
+import time
 import base64
+import threading
+import contextvars
 from typing import Generator
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from dotenv import load_dotenv
 from flask import Flask, Response, request
-from azure.monitor.opentelemetry import configure_azure_monitor
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from utils.logger import logger
+from utils.telemetry import registry, record, measure_stream
 from utils.openai import OpenAIClient
-from utils.cosmos import CosmosContainer
+from utils.cosmos import CosmosContainer, CachedCosmosContainer
+from utils.streams import AnswerStream, StreamRegistry
+from utils.assets import StaticAssets, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL
+from utils.compression import choose_encoding, compress, compress_stream
 
 # .envファイルから環境変数を読み込む
 load_dotenv(override=True)
 ASSISTANT_INITIAL_MESSAGE = os.getenv("ASSISTANT_INITIAL_MESSAGE", "こんにちは！何かお手伝いできることはありますか？")
 
+# 回答ストリーミングのプロトコルバージョン
+# 1: 毎回それまでの回答全文を返す (互換用)
+# 2: 差分(delta)のみを返し、最後に全文を含む完了フレームを返す
+STREAM_PROTOCOL_CUMULATIVE = 1
+STREAM_PROTOCOL_DELTA = 2
+STREAM_PROTOCOL_VERSIONS = [STREAM_PROTOCOL_CUMULATIVE, STREAM_PROTOCOL_DELTA]
+
+# チャット一覧の1ページあたりの件数
+TALKS_PAGE_SIZE = int(os.getenv("TALKS_PAGE_SIZE", 20))
+TALKS_MAX_PAGE_SIZE = 100
+
+# 回答生成時に会話履歴として読み込む直近のメッセージ数
+TALK_HISTORY_WINDOW = int(os.getenv("TALK_HISTORY_WINDOW", 50))
+
+# トークン数の上限から溢れた会話履歴を要約して会話情報に保存するかどうか
+TALK_SUMMARY_ENABLED = True if os.getenv("TALK_SUMMARY_ENABLED", "true") == "true" else False
+
+# 回答の生成中にクライアントの切断を検知するため、送信が途絶えた場合に空行を返す間隔(秒) (差分形式のみ)
+STREAM_HEARTBEAT_INTERVAL = float(os.getenv("STREAM_HEARTBEAT_INTERVAL", 5))
+
+# 切断したクライアントの再接続を待つ時間(秒) (この間に再接続されなければ回答の生成を取り消す)
+STREAM_RESUME_GRACE = float(os.getenv("STREAM_RESUME_GRACE", 15))
+
+# 生成中の回答を会話情報に保存する間隔(秒) (0 の場合は生成が終わった時のみ保存する)
+STREAM_CHECKPOINT_INTERVAL = float(os.getenv("STREAM_CHECKPOINT_INTERVAL", 2))
+
+# API のレスポンス (回答のストリーミングと JSON) を、クライアントが対応していれば圧縮して返すかどうか
+RESPONSE_COMPRESSION_ENABLED = True if os.getenv("RESPONSE_COMPRESSION_ENABLED") == "true" else False
+
+# これより小さい JSON のレスポンスは圧縮しない (バイト)
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", 1024))
+
+# 最初の回答の後に、チャットのタイトルをバックグラウンドで自動生成するかどうか
+TALK_TITLE_AUTO_GENERATE = True if os.getenv("TALK_TITLE_AUTO_GENERATE", "true") == "true" else False
+
+# 回答の完了後に、自動生成したタイトルをクライアントへ返すために待つ時間(秒)
+# (過ぎた場合はタイトルを返さずにストリーミングを終える。生成したタイトルはそのまま会話情報に保存する)
+TALK_TITLE_WAIT_SECONDS = float(os.getenv("TALK_TITLE_WAIT_SECONDS", 5))
+
 # Flask の初期化
 app = Flask(__name__)
 
@@ -21,39 +66,154 @@ app = Flask(__name__)
 debug = True if os.getenv("DEBUG") == "true" else False
 
 # デバッグ実行でない場合のみ、Azure Application Insights によるログ出力とトレースを有効化
+# (読み込みに時間がかかるため、使用する場合のみインポートする)
 if not debug:
+    from azure.monitor.opentelemetry import configure_azure_monitor
+    from opentelemetry.instrumentation.flask import FlaskInstrumentor
+
     configure_azure_monitor()
     FlaskInstrumentor().instrument_app(app)
 
 # Azure OpenAI Service にアクセスするためのクライアントの初期化
 openai_client = OpenAIClient()
 
-# Azure Cosmos DB にアクセスするためのクライアントの初期化
-cosmos_client = CosmosContainer()
+# タイトル生成などをリクエストとは別に実行するためのスレッドプールの初期化
+background_executor = ThreadPoolExecutor(max_workers=int(os.getenv("BACKGROUND_MAX_WORKERS", 4)), thread_name_prefix="background")
+
+# Azure Cosmos DB にアクセスするためのクライアントの初期化 (キャッシュが有効な場合はプロセス内にキャッシュする)
+cosmos_client = CachedCosmosContainer() if int(os.getenv("AZURE_COSMOS_CACHE_SIZE", 1000)) > 0 else CosmosContainer()
+
+# 静的ファイル (ハッシュ付きのパスと、あらかじめ圧縮した内容を用意する。デバッグ実行時はファイルの更新を反映する)
+static_assets = StaticAssets(app.static_folder, reload=debug)
+
+# 生成中・生成済みの回答のストリーム (切断したクライアントが再接続できるように、ストリームIDで管理する)
+answer_streams = StreamRegistry()
+
+
+if debug:
+
+    @app.route("/metrics", methods=["GET"])
+    def get_metrics() -> Response:
+        """
+        デバッグ実行時のみ、プロセス内で集計した指標を Prometheus のテキスト形式で返す
+        """
+        # キャッシュとエンドポイントの統計情報もゲージとして出力する (ツールのキャッシュは階層ごと、エンドポイントは名前ごとにラベルを付ける)
+        gauges = {}
+        caches = [("cosmos_cache", "", getattr(cosmos_client, "stats", dict)()), ("completion_cache", "", openai_client.completion_cache_stats())]
+        caches += [("tool_cache", f'tier="{tier}"', stats) for tier, stats in openai_client.tools.cache_stats().items()]
+        caches += [("openai_endpoint", f'endpoint="{name}"', stats) for name, stats in openai_client.endpoint_stats().items()]
+        caches += [("answer_streams", "", answer_streams.stats())]
+        for name, labels, stats in caches:
+            for key, value in stats.items():
+                gauges.setdefault(f"{name}_{key}", {})[labels] = value
+        return Response(registry.render(gauges), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/", defaults={"path": "index.html"})
 @app.route("/<path:path>")
 def static_file(path: str) -> Response:
-    return app.send_static_file(path)
+    """
+    静的ファイルを返す
+
+    クライアントが対応していれば、あらかじめ圧縮した内容 (brotli/gzip) を返す。
+    ハッシュ付きのパス (index.html から参照するもの) は期限なしでキャッシュさせ、
+    それ以外は ETag で更新を確認させる (変わっていなければ 304 を返す)。
+
+    Args:
+        path (str): 静的ファイルのパス
+    """
+    asset, immutable = static_assets.get(path)
+    if asset is None:
+        return "", 404
+
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"), list(asset.encoded))
+    headers = {
+        "ETag": f'"{asset.etag(encoding)}"',
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL,
+        "Vary": "Accept-Encoding",
+    }
+    if asset.hash in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(asset.encoded.get(encoding, asset.data), mimetype=asset.mimetype, headers=headers)
+
+
+@app.after_request
+def compress_response(response: Response) -> Response:
+    """
+    RESPONSE_COMPRESSION_ENABLED が有効な場合、一定以上の大きさの JSON のレスポンスを圧縮する
+    """
+    if (
+        not RESPONSE_COMPRESSION_ENABLED
+        or response.is_streamed
+        or response.mimetype != "application/json"
+        or "Content-Encoding" in response.headers
+        or response.content_length is None
+        or response.content_length < RESPONSE_COMPRESSION_MIN_BYTES
+    ):
+        return response
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    if encoding:
+        response.set_data(compress(response.get_data(), encoding))
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+    return response
 
 
 @app.route("/talks", methods=["GET"])
 def list_talks() -> tuple[dict, int]:
     """
-    ユーザが作成したチャット一覧を取得する
+    ユーザが作成したチャット一覧を取得する (新しい順・ページング対応)
+
+    チャット一覧の表示に必要な ID・タイトル・更新日時のみを返す。
+    メッセージは GET /talks/<talk_id> で個別に取得する。
+
+    Query Parameters:
+        limit (int): 1ページあたりの最大件数
+        continuation (str): 前ページの取得時に返された継続トークン
     """
 
+    # クエリパラメータからページング情報を取得
+    limit = request.args.get("limit", TALKS_PAGE_SIZE, type=int)
+    if limit < 1 or limit > TALKS_MAX_PAGE_SIZE:
+        return f"limit must be between 1 and {TALKS_MAX_PAGE_SIZE}", 400
+    continuation = request.args.get("continuation") or None
+
     # ログインユーザ情報を取得
     user_id, _ = get_user_info()
 
     # ユーザが作成したチャット一覧を取得
-    query = "SELECT c.id, c.title, c.messages FROM c WHERE c.userId = @userId ORDER BY c._ts ASC"
+    query = "SELECT c.id, c.title, c._ts AS updatedAt FROM c WHERE c.userId = @userId AND NOT IS_DEFINED(c.talkId) ORDER BY c._ts DESC"
     parameters = [{"name": "@userId", "value": user_id}]
-    items = cosmos_client.query_items(query, parameters=parameters)
+    items, continuation = cosmos_client.query_items_page(
+        query, parameters=parameters, partition_key=user_id, max_item_count=limit, continuation_token=continuation
+    )
+
+    # チャット一覧と次ページの継続トークンを返す
+    return {"talks": items, "continuation": continuation}, 200
+
+
+@app.route("/talks/<talk_id>", methods=["GET"])
+def get_talk(talk_id: str) -> tuple[dict, int]:
+    """
+    指定したチャットのメッセージを取得する
 
-    # チャット一覧を返す
-    return items, 200
+    Args:
+        talk_id (str): チャットID
+    """
+
+    # ログインユーザ情報を取得
+    user_id, _ = get_user_info()
+
+    # 対象の会話情報を取得
+    talk = cosmos_client.get_item(talk_id, user_id)
+    if talk is None or talk["userId"] != user_id:
+        return "", 404
+
+    # 会話情報を返す
+    messages = cosmos_client.get_talk_messages(talk)
+    return {"id": talk["id"], "title": talk["title"], "updatedAt": talk.get("_ts"), "messages": messages}, 200
 
 
 @app.route("/talks", methods=["POST"])
@@ -71,7 +231,7 @@ def add_talk() -> tuple[dict, int]:
     user_id, _ = get_user_info()
 
     # 新しいチャットを作成
-    item = cosmos_client.upsert_item(
+    item = cosmos_client.create_item(
         {
             "title": title,
             "userId": user_id,
@@ -80,7 +240,7 @@ def add_talk() -> tuple[dict, int]:
     )
 
     # 作成したチャット情報を返す
-    return {key: item[key] for key in ["id", "title", "userId", "messages"]}, 200
+    return {"id": item["id"], "title": item["title"], "userId": item["userId"], "updatedAt": item.get("_ts"), "messages": item["messages"]}, 200
 
 
 @app.route("/talks/<talk_id>", methods=["DELETE"])
@@ -95,13 +255,13 @@ def delete_talk(talk_id: str) -> tuple[str, int]:
     # ログインユーザ情報を取得
     user_id, _ = get_user_info()
 
-    # 対象の会話情報を削除する権限があるか確認
-    talk = cosmos_client.get_item(talk_id)
+    # 対象の会話情報を削除する権限があるか確認 (他のプロセスで追加されたセグメントも削除するため、最新かどうかを確認する)
+    talk = cosmos_client.get_item(talk_id, user_id, revalidate=True)
     if talk is None or talk["userId"] != user_id:
         return "", 404
 
     # 会話情報を削除
-    cosmos_client.delete_item(talk_id)
+    cosmos_client.delete_talk(talk)
 
     return "", 204
 
@@ -120,49 +280,375 @@ def add_message(talk_id: str):
         if "message" not in request.json:
             return "message is required", 400
         message = request.json["message"]
+        record("payload_bytes", request.content_length or 0, kind="request")
+
+        # ストリーミングのプロトコルバージョンを取得 (指定がない場合は互換用の全文形式)
+        stream_version = request.json.get("stream_version", STREAM_PROTOCOL_CUMULATIVE)
+        if stream_version not in STREAM_PROTOCOL_VERSIONS:
+            return "unsupported stream_version", 400
 
         # ログインユーザ情報を取得
         user_id, _ = get_user_info()
 
-        # 対象の会話情報を取得
-        talk = cosmos_client.get_item(talk_id)
+        # 対象の会話情報を取得 (他のプロセスで追記された会話履歴を反映するため、キャッシュしている場合も最新かどうかを確認する)
+        talk = cosmos_client.get_item(talk_id, user_id, revalidate=True)
         if talk is None or talk["userId"] != user_id:
             return "", 404
 
-        # ユーザメッセージを会話情報に追加
-        talk["messages"].append({"role": "user", "content": message})
+        # 直近の会話履歴を取得し、要約済みのメッセージは除く (途中で切断された回答の印などはモデルに渡さない)
+        history = [{"role": m["role"], "content": m["content"]} for m in cosmos_client.get_talk_messages(talk, window=TALK_HISTORY_WINDOW)]
+        summary = talk.get("summary") or {}
+        covered_count = summary.get("coveredCount", 0)
+        message_count = cosmos_client.message_count(talk)
+        first_index = max(message_count - len(history), covered_count)
+        history = history[len(history) - (message_count - first_index) :]
+
+        # ユーザメッセージを追加し、トークン数の上限に収める
+        user_message = {"role": "user", "content": message}
+        messages, dropped = openai_client.fit_context(history + [user_message], summary.get("content"))
+
+        # 直近の会話履歴より前に要約していないメッセージがある場合は、古いものから (1回あたり TALK_HISTORY_WINDOW 件まで) 要約に含める
+        # (要約済みの範囲が連続するように、残りがある場合はトークン数の上限から溢れた会話履歴は次回以降に要約する)
+        if TALK_SUMMARY_ENABLED and first_index > covered_count:
+            gap = cosmos_client.get_talk_messages(talk, window=message_count - covered_count)[: first_index - covered_count]
+            gap = [{"role": m["role"], "content": m["content"]} for m in gap]
+            dropped = gap[:TALK_HISTORY_WINDOW] if len(gap) > TALK_HISTORY_WINDOW else gap + dropped
+        covered_count += len(dropped)
+
+        # Azure OpenAI Service で回答を生成する (クライアントが切断しても続けられるように、別のスレッドで生成する)
+        chunks = openai_client.get_completion_with_tools(messages, summary.get("content"))
+        stream = answer_streams.create(talk_id, user_id)
+        args = (stream, talk, user_message, chunks, stream_version, dropped, covered_count)
+        threading.Thread(target=contextvars.copy_context().run, args=(generate_answer, *args), name=f"answer-{stream.id[:8]}", daemon=True).start()
+
+        # 回答をストリーミング形式で返却する (切断した場合は、ストリームIDを指定して GET /talks/<talk_id>/streams/<stream_id> で再開できる)
+        resp = to_stream_resp(stream, stream_version)
+        return to_http_stream_resp(resp, stream.id)
+
+    except Exception as e:
+        logger.exception(e)
+        return "", 500
+
 
-        # Azure OpenAI Service で回答を生成する
-        chunks = openai_client.get_completion_with_tools([m for m in talk["messages"]])  # Deep Copy
+@app.route("/talks/<talk_id>/streams/<stream_id>", methods=["GET"])
+def resume_stream(talk_id: str, stream_id: str):
+    """
+    切断した回答のストリーミングを、指定した連番から再開する (差分形式のみ)
+
+    生成中の回答の場合は、新しい差分が生成されるたびに返す。別のプロセスで生成している回答の場合は、
+    保存された途中経過を STREAM_CHECKPOINT_INTERVAL 秒ごとに読み込んで返す (読み込んでいる間は、生成中のプロセスは回答を取り消さない)。
+
+    Args:
+        talk_id (str): チャットID
+        stream_id (str): ストリームID (POST /talks/<talk_id>/message の X-Stream-Id ヘッダー)
+
+    Query Parameters:
+        offset (int): 次に受け取る差分の連番 (seq)
+    """
+    try:
 
-        # 回答をストリーミング形式で返却する
-        return Response(to_stream_resp(talk, chunks), mimetype="text/event-stream")
+        # ログインユーザ情報を取得
+        user_id, _ = get_user_info()
+        offset = request.args.get("offset", 0, type=int)
+
+        # このプロセスで生成したストリームがなければ、保存された途中経過から作成する
+        # (読み込んだ時刻を lastPolledAt として書き込み、更新後の最新の途中経過を受け取る)
+        stream = answer_streams.get(stream_id)
+        follow = None
+        if stream is None or stream.talk_id != talk_id or stream.user_id != user_id:
+            operations = [{"op": "set", "path": "/lastPolledAt", "value": time.time()}]
+            checkpoint = cosmos_client.patch_item(cosmos_client.stream_checkpoint_id(talk_id), user_id, operations)
+            if checkpoint is None or checkpoint.get("streamId") != stream_id or checkpoint.get("talkId") != talk_id:
+                return "", 404
+            stream = AnswerStream(talk_id, user_id, stream_id)
+            stream.apply_checkpoint(checkpoint)
+            if not stream.finished:
+                follow = threading.Thread(target=follow_stream_checkpoint, args=(stream, checkpoint), name=f"follow-{stream_id[:8]}", daemon=True)
+
+        if offset < 0 or offset > len(stream.deltas):
+            return "invalid offset", 400
+        if follow is not None:
+            follow.start()
+        resp = to_stream_resp(stream, STREAM_PROTOCOL_DELTA, offset)
+        return to_http_stream_resp(resp, stream.id)
 
     except Exception as e:
         logger.exception(e)
         return "", 500
 
 
-def to_stream_resp(talk: dict, chunks: Generator) -> Generator:
+def to_http_stream_resp(chunks: Generator[str, None, None], stream_id: str) -> Response:
     """
-    Azure OpenAI Service で生成した回答をクライアントへストリーミング形式で返却する
+    回答のストリーミングのレスポンスを作成する
+
+    RESPONSE_COMPRESSION_ENABLED が有効で、クライアントが対応している場合は、フレームごとにフラッシュしながら圧縮して返す。
 
     Args:
+        chunks (Generator[str, None, None]): 返却するフレーム
+        stream_id (str): ストリームID
+
+    Returns:
+        Response: レスポンス
+    """
+    chunks = measure_stream(chunks, "response")
+    headers = {"X-Stream-Id": stream_id}
+    encoding = choose_encoding(request.headers.get("Accept-Encoding")) if RESPONSE_COMPRESSION_ENABLED else None
+    if encoding:
+        chunks = compress_stream(chunks, encoding)
+        headers.update({"Content-Encoding": encoding, "Vary": "Accept-Encoding"})
+    return Response(chunks, mimetype="text/event-stream", headers=headers)
+
+
+def generate_answer(
+    stream: AnswerStream,
+    talk: dict,
+    user_message: dict,
+    chunks: Generator,
+    stream_version: int = STREAM_PROTOCOL_CUMULATIVE,
+    dropped: list[dict] = None,
+    covered_count: int = 0,
+):
+    """
+    Azure OpenAI Service で生成した回答をストリームに追加し、生成が終わったら会話情報に保存する
+
+    生成中の回答は STREAM_CHECKPOINT_INTERVAL 秒ごとに、会話情報とは別のアイテムに途中経過として保存する。
+    Azure OpenAI Service の呼び出しなどで回答の生成に失敗した場合や、会話情報への保存に失敗した場合は、クライアントへエラーを通知する。
+    全てのクライアントが切断してから STREAM_RESUME_GRACE 秒以内に再接続されなかった (別のプロセスからも途中経過が読み込まれなかった) 場合は回答の生成を取り消し、
+    それまでの回答を "truncated": true として会話情報に保存する。
+
+    Args:
+        stream (AnswerStream): 回答を追加するストリーム
         talk (dict): チャット情報
+        user_message (dict): ユーザメッセージ
         chunks (Generator): 生成された回答
+        stream_version (int): ストリーミングのプロトコルバージョン (差分形式の場合のみタイトルを自動生成する)
+        dropped (list[dict]): トークン数の上限から溢れて回答生成に使わなかった会話履歴
+        covered_count (int): 溢れた会話履歴を要約に含めた後、要約済みとなるメッセージ数
+    """
+    truncated = False
+    failed = False
+    try:
+        # 生成された回答をストリームに追加する (回答を返していない間も、空のチャンクで切断を確認する)
+        checkpointed_at = time.monotonic()
+        checkpointed_seq = None
+        try:
+            for chunk in chunks:
+                if stream.abandoned(STREAM_RESUME_GRACE):
+                    chunks.close()
+                    truncated = True
+                    break
+                if chunk and chunk != "[DONE]":
+                    stream.append(chunk)
+                if STREAM_CHECKPOINT_INTERVAL > 0 and time.monotonic() - checkpointed_at >= STREAM_CHECKPOINT_INTERVAL:
+                    checkpointed_seq = save_stream_checkpoint(talk, stream, checkpointed_seq)
+                    checkpointed_at = time.monotonic()
+        except Exception as e:
+            logger.exception(e)
+            failed = True
+        if failed:
+            stream.complete(error=True)
+            save_stream_checkpoint(talk, stream, checkpointed_seq, done=True, error=True, finished=True)
+            return
+        assistant_message = {"role": "assistant", "content": stream.content}
+        if truncated:
+            assistant_message["truncated"] = True
+        new_messages = [user_message, assistant_message]
+
+        # 生成しきったら、今回のユーザメッセージと回答のみを会話情報に追記する
+        # (保存に失敗した場合は、再読み込みで回答が消えてしまうため、完了ではなくエラーとしてクライアントへ通知する)
+        try:
+            cosmos_client.append_talk_messages(talk, new_messages)
+        except Exception as e:
+            logger.exception(e)
+            stream.complete(error=True)
+            save_stream_checkpoint(talk, stream, checkpointed_seq, done=True, error=True, finished=True)
+            return
+
+        # 最初の回答の場合は、タイトルの生成をバックグラウンドで開始する
+        title_future = None
+        if not truncated and TALK_TITLE_AUTO_GENERATE and stream_version == STREAM_PROTOCOL_DELTA and should_generate_title(talk):
+            messages = cosmos_client.get_talk_first_messages(talk, openai_client.title_excerpt_messages) + new_messages
+            title_future = background_executor.submit(generate_and_save_title, talk, messages)
+
+        # クライアントへ完了を通知する (タイトルを生成中の場合は、クライアントがタイトルの生成を重複して依頼しないように伝える)
+        stream.complete(truncated, title_pending=title_future is not None)
+        checkpointed_seq = save_stream_checkpoint(
+            talk, stream, checkpointed_seq, done=True, truncated=truncated, titlePending=title_future is not None, finished=title_future is None
+        )
+
+        # タイトルを生成した場合は、クライアントへ通知する
+        if title_future is not None:
+            try:
+                stream.set_title(title_future.result(timeout=TALK_TITLE_WAIT_SECONDS))
+            except FutureTimeoutError:
+                logger.info(f"title generation did not finish within {TALK_TITLE_WAIT_SECONDS}s, continuing in background")
+            except Exception as e:
+                logger.exception(e)
+            save_stream_checkpoint(talk, stream, checkpointed_seq, title=stream.title, finished=True)
+    finally:
+        stream.finish()
+
+    # 溢れた会話履歴は要約に含めて、次回以降の回答生成で参照できるようにする
+    if not truncated and dropped and TALK_SUMMARY_ENABLED:
+        update_talk_summary(talk, dropped, covered_count)
+
+
+def save_stream_checkpoint(talk: dict, stream: AnswerStream, saved_seq: int = None, **fields) -> int:
+    """
+    生成中の回答の途中経過を、会話情報とは別のアイテムに保存する (別のプロセスで再開する場合に使う)
+
+    前回までに保存した差分の続きのみを追記する (最初に保存する場合と、前回の保存に失敗した場合は全て書き込む)。
+    別のプロセスのクライアントが途中経過を読み込んでいる場合は、その時刻 (lastPolledAt) をストリームに記録する。
+    途中経過のアイテムは STREAM_RESUME_TTL 秒後に削除される (コンテナの TTL が有効な場合)。
+
+    Args:
+        talk (dict): チャット情報
+        stream (AnswerStream): 回答のストリーム
+        saved_seq (int): 保存済みの差分の数 (None の場合は全て書き込む)
+        **fields: 同時に保存する項目 (done・truncated・title・finished)
+
+    Returns:
+        int: 保存済みの差分の数 (保存に失敗した場合は None)
     """
+    seq = len(stream.deltas)
+    checkpoint_id = cosmos_client.stream_checkpoint_id(talk["id"])
+    try:
+        if saved_seq is None:
+            checkpoint = {
+                "id": checkpoint_id,
+                "talkId": talk["id"],
+                "userId": talk["userId"],
+                "streamId": stream.id,
+                "chunks": [stream.checkpoint_chunk(0)],
+                "seq": seq,
+                "updatedAt": time.time(),
+                "lastPolledAt": stream.remote_polled_at,
+                "ttl": int(answer_streams.ttl),
+                **fields,
+            }
+            checkpoint = cosmos_client.upsert_item(checkpoint)
+        else:
+            operations = [{"op": "set", "path": "/seq", "value": seq}, {"op": "set", "path": "/updatedAt", "value": time.time()}]
+            if seq > saved_seq:
+                operations.append({"op": "add", "path": "/chunks/-", "value": stream.checkpoint_chunk(saved_seq)})
+            operations += [{"op": "set", "path": f"/{key}", "value": value} for key, value in fields.items()]
+            checkpoint = cosmos_client.patch_item(checkpoint_id, talk["userId"], operations)
+        if checkpoint is None:
+            return None
+        stream.touch(checkpoint.get("lastPolledAt"))
+        return seq
+    except Exception as e:
+        logger.warning(f"failed to save stream checkpoint: {e}")
+        return None
 
-    # Azure OpenAI Service で生成した回答をストリーミング形式で返却する
-    content = ""
-    for chunk in chunks:
-        if not chunk or chunk == "[DONE]":
-            continue
-        content += chunk
-        yield json.dumps({"content": content}).replace("\n", "\\n") + "\n"
 
-    # 返却しきったら、会話情報を更新する
-    talk["messages"].append({"role": "assistant", "content": content})
-    cosmos_client.upsert_item(talk)
+def follow_stream_checkpoint(stream: AnswerStream, checkpoint: dict):
+    """
+    別のプロセスで生成している回答の途中経過を STREAM_CHECKPOINT_INTERVAL 秒ごとに読み込み、ストリームに追加する
+
+    読み込むたびに途中経過の lastPolledAt を更新し、生成中のプロセスが回答を取り消さないようにする。
+    後処理まで終わった場合、クライアントが切断した場合、途中経過が STREAM_RESUME_GRACE 秒以上更新されない
+    (生成中のプロセスが停止した) 場合に終了する。
+
+    Args:
+        stream (AnswerStream): 途中経過から作成したストリーム
+        checkpoint (dict): 最初に読み込んだ途中経過
+    """
+    interval = STREAM_CHECKPOINT_INTERVAL or STREAM_HEARTBEAT_INTERVAL
+    updated_at = checkpoint.get("updatedAt")
+    changed_at = time.monotonic()
+    try:
+        while not stream.finished and not stream.abandoned(0) and time.monotonic() - changed_at < STREAM_RESUME_GRACE:
+            time.sleep(interval)
+            operations = [{"op": "set", "path": "/lastPolledAt", "value": time.time()}]
+            checkpoint = cosmos_client.patch_item(cosmos_client.stream_checkpoint_id(stream.talk_id), stream.user_id, operations)
+            if checkpoint is None or checkpoint.get("streamId") != stream.id:
+                break
+            stream.apply_checkpoint(checkpoint)
+            if checkpoint.get("updatedAt") != updated_at:
+                updated_at = checkpoint.get("updatedAt")
+                changed_at = time.monotonic()
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        stream.finish()
+
+
+def to_stream_resp(stream: AnswerStream, stream_version: int = STREAM_PROTOCOL_CUMULATIVE, offset: int = 0) -> Generator:
+    """
+    ストリームに追加された回答をクライアントへストリーミング形式で返却する
+
+    Args:
+        stream (AnswerStream): 回答のストリーム
+        stream_version (int): ストリーミングのプロトコルバージョン
+            1: {"content": 回答全文} を毎回返す
+            2: {"v": 2, "seq": 連番, "delta": 差分} を返し、最後に {"v": 2, "seq": 連番, "done": true, "content": 回答全文} を返す
+               回答の生成を途中で取り消した場合は、完了フレームに "truncated": true を含める
+               タイトルを生成中の場合は、完了フレームに "titlePending": true を含める
+               回答の生成に失敗した場合は、完了フレームの代わりに {"v": 2, "seq": 連番, "error": true} を返す
+               タイトルを自動生成した場合は、その後に {"v": 2, "title": タイトル} を返す
+        offset (int): 最初に返す差分の連番 (再開する場合)
+
+    差分形式の場合、ツールの実行中などで STREAM_HEARTBEAT_INTERVAL 秒以上送信が途絶えたら空行を返す。
+    """
+    seq = offset
+    done_sent = False
+    title_sent = False
+    stream.attach()
+    try:
+        while True:
+            # 後処理まで終わったかどうかは先に確認し、それまでに追加された情報を全て返してから終了する
+            changed = stream.wait(seq, done_sent, title_sent, STREAM_HEARTBEAT_INTERVAL)
+            finished = stream.finished
+            deltas = stream.deltas[seq:]
+            if stream_version == STREAM_PROTOCOL_DELTA:
+                for delta in deltas:
+                    yield json.dumps({"v": STREAM_PROTOCOL_DELTA, "seq": seq, "delta": delta}) + "\n"
+                    seq += 1
+            elif deltas:
+                seq += len(deltas)
+                yield json.dumps({"content": "".join(stream.deltas[:seq])}).replace("\n", "\\n") + "\n"
+
+            # 差分形式の場合は、検証用に回答全文を含む完了フレームと、生成したタイトルを返す
+            if stream.done and not done_sent and seq >= len(stream.deltas):
+                done_sent = True
+                if stream_version == STREAM_PROTOCOL_DELTA and stream.error:
+                    yield json.dumps({"v": STREAM_PROTOCOL_DELTA, "seq": seq, "error": True}) + "\n"
+                elif stream_version == STREAM_PROTOCOL_DELTA:
+                    frame = {"v": STREAM_PROTOCOL_DELTA, "seq": seq, "done": True, "content": stream.content}
+                    if stream.truncated:
+                        frame["truncated"] = True
+                    if stream.title_pending:
+                        frame["titlePending"] = True
+                    yield json.dumps(frame) + "\n"
+            if stream.title is not None and not title_sent and done_sent:
+                title_sent = True
+                if stream_version == STREAM_PROTOCOL_DELTA:
+                    yield json.dumps({"v": STREAM_PROTOCOL_DELTA, "title": stream.title}) + "\n"
+            if finished:
+                break
+            if not changed and stream_version == STREAM_PROTOCOL_DELTA:
+                yield "\n"
+    finally:
+        # クライアントが切断した場合も、読み出しを終えたことをストリームに通知する
+        stream.detach()
+
+
+def update_talk_summary(talk: dict, dropped: list[dict], covered_count: int):
+    """
+    会話情報に保存している要約に、溢れた会話履歴を追加する
+
+    Args:
+        talk (dict): チャット情報
+        dropped (list[dict]): 要約に追加する会話履歴
+        covered_count (int): 要約に追加した後、要約済みとなるメッセージ数
+    """
+    try:
+        summary = talk.get("summary") or {}
+        content = openai_client.summarize(dropped, summary.get("content"))
+        cosmos_client.patch_item(talk["id"], talk["userId"], [{"op": "set", "path": "/summary", "value": {"content": content, "coveredCount": covered_count}}])
+    except Exception as e:
+        logger.exception(e)
 
 
 @app.route("/talk/<talk_id>/title", methods=["PUT"])
@@ -183,13 +669,12 @@ def update_talk_title(talk_id: str) -> tuple[str, int]:
     user_id, _ = get_user_info()
 
     # 対象の会話情報を取得
-    talk = cosmos_client.get_item(talk_id)
+    talk = cosmos_client.get_item(talk_id, user_id)
     if talk is None or talk["userId"] != user_id:
         return "", 404
 
-    # 会話情報を更新
-    talk["title"] = title
-    cosmos_client.upsert_item(talk)
+    # 会話情報のタイトルのみを更新 (以降はタイトルを自動生成しない)
+    cosmos_client.patch_item(talk_id, user_id, [{"op": "set", "path": "/title", "value": title}, {"op": "set", "path": "/titleEdited", "value": True}])
 
     return "", 204
 
@@ -207,28 +692,42 @@ def generate_talk_title(talk_id: str) -> tuple[str, int]:
     user_id, _ = get_user_info()
 
     # 対象の会話情報を取得
-    talk = cosmos_client.get_item(talk_id)
+    talk = cosmos_client.get_item(talk_id, user_id)
     if talk is None or talk["userId"] != user_id:
         return "", 404
 
-    # 今までの会話からチャットタイトルを生成
-    messages = [m for m in talk["messages"]]  # deep copy
-    user_message = """
-    今までの会話履歴を元に、タイトルを生成してください。
-    タイトルは15文字以下で、以下のJSONフォーマットで出力してください。
+    # 会話の冒頭からチャットタイトルを生成して、会話情報を更新
+    messages = cosmos_client.get_talk_first_messages(talk, openai_client.title_excerpt_messages)
+    title = generate_and_save_title(talk, messages)
 
-    # 出力フォーマット
-    {"title": "{生成したタイトル}"}
+    return title, 200
+
+
+def should_generate_title(talk: dict) -> bool:
     """
-    messages.append({"role": "user", "content": user_message})
-    completion = openai_client.get_completion(messages, json_mode=True)
-    title = completion["title"]
+    最初の回答の後にタイトルを自動生成するかどうかを判定する
 
-    # 会話情報を更新
-    talk["title"] = title
-    cosmos_client.upsert_item(talk)
+    Args:
+        talk (dict): チャット情報 (今回の回答を追記する前のもの)
+    """
+    return cosmos_client.message_count(talk) <= 1 and not talk.get("titleGenerated") and not talk.get("titleEdited")
 
-    return title, 200
+
+def generate_and_save_title(talk: dict, messages: list[dict]) -> str:
+    """
+    会話の冒頭からチャットのタイトルを生成し、会話情報に保存する
+
+    Args:
+        talk (dict): チャット情報
+        messages (list[dict]): 会話の冒頭のメッセージ
+
+    Returns:
+        str: 生成したタイトル
+    """
+    title = openai_client.generate_title(messages)
+    operations = [{"op": "set", "path": "/title", "value": title}, {"op": "set", "path": "/titleGenerated", "value": True}]
+    cosmos_client.patch_item(talk["id"], talk["userId"], operations)
+    return title
 
 
 def get_user_info() -> tuple[str, str]:
@@ -0,0 +1,118 @@
+"""
+1プロセスで同時にストリーミングできる回答数のベンチマーク
+
+gunicorn を1ワーカーで起動し、thread モード(gthread)と async モード(gevent)のそれぞれで、
+一定間隔でトークンを返す回答ストリームを多数同時に要求して、同時に進行したストリーム数を計測する。
+回答生成は Azure OpenAI Service の代わりに、I/O 待ち(sleep)を挟みながらトークンを返すスタブで再現する。
+
+使い方:
+    python -m benchmarks.concurrent_streams [--streams 300] [--tokens 50] [--interval 0.05]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+import requests
+from flask import Flask, Response
+
+# 計測対象のスタブアプリ (gunicorn から benchmarks.concurrent_streams:stub_app として読み込む)
+stub_app = Flask(__name__)
+
+
+@stub_app.route("/stream")
+def stream() -> Response:
+    tokens = int(os.getenv("STUB_TOKENS", 50))
+    interval = float(os.getenv("STUB_INTERVAL", 0.05))
+
+    def generate():
+        for seq in range(tokens):
+            time.sleep(interval)  # 上流(Azure OpenAI Service)からのトークン待ちを再現する
+            yield json.dumps({"v": 2, "seq": seq, "delta": "トークン"}) + "\n"
+
+    return Response(generate(), mimetype="text/event-stream")
+
+
+def run_client(url: str, results: list, index: int):
+    start = time.monotonic()
+    try:
+        with requests.get(url, stream=True, timeout=600) as resp:
+            first_byte = None
+            for _ in resp.iter_lines():
+                if first_byte is None:
+                    first_byte = time.monotonic()
+        results[index] = (start, first_byte, time.monotonic())
+    except requests.RequestException:
+        results[index] = None
+
+
+def max_overlap(intervals: list[tuple[float, float]]) -> int:
+    events = sorted([(s, 1) for s, _ in intervals] + [(e, -1) for _, e in intervals], key=lambda e: (e[0], e[1]))
+    current = peak = 0
+    for _, delta in events:
+        current += delta
+        peak = max(peak, current)
+    return peak
+
+
+def measure(mode: str, args: argparse.Namespace) -> dict:
+    env = dict(os.environ, SERVER_MODE=mode, WEB_CONCURRENCY="1", PORT=str(args.port), STUB_TOKENS=str(args.tokens), STUB_INTERVAL=str(args.interval))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "benchmarks.concurrent_streams:stub_app"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        url = f"http://127.0.0.1:{args.port}/stream"
+        for _ in range(100):
+            try:
+                requests.get(url, timeout=10).close()
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+
+        results = [None] * args.streams
+        clients = [threading.Thread(target=run_client, args=(url, results, i)) for i in range(args.streams)]
+        start = time.monotonic()
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        elapsed = time.monotonic() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    completed = [r for r in results if r is not None and r[1] is not None]
+    ttfb = sorted(r[1] - r[0] for r in completed)
+    return {
+        "mode": mode,
+        "completed": len(completed),
+        "max_concurrent": max_overlap([(r[1], r[2]) for r in completed]),
+        "elapsed": elapsed,
+        "ttfb_p50": ttfb[len(ttfb) // 2] if ttfb else 0,
+        "ttfb_max": ttfb[-1] if ttfb else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent answer streams per process")
+    parser.add_argument("--streams", type=int, default=300)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--modes", default="thread,async")
+    args = parser.parse_args()
+
+    print(f"{'mode':<8} {'completed':>10} {'max concurrent':>15} {'elapsed s':>10} {'ttfb p50 s':>11} {'ttfb max s':>11}")
+    for mode in args.modes.split(","):
+        r = measure(mode, args)
+        print(f"{r['mode']:<8} {r['completed']:>10} {r['max_concurrent']:>15} {r['elapsed']:>10.1f} {r['ttfb_p50']:>11.2f} {r['ttfb_max']:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
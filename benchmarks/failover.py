@@ -0,0 +1,89 @@
+"""
+Azure OpenAI Service のエンドポイントを複数指定した場合の、ルーティングとフェイルオーバーを確認するベンチマーク
+
+応答の速さが異なる2つの代替実装 (benchmarks/fakes.py) をエンドポイントとして app.py を起動し、
+以下の段階ごとに会話を繰り返して、エラーの数・最初の応答までの時間・各エンドポイントへのリクエスト数を出力する。
+
+- healthy: 両方とも正常 (応答時間の短い primary に振り分けられる)
+- error: primary が 503 を返す (secondary にフェイルオーバーし、primary のサーキットが開く)
+- stream: primary がストリームを最初のトークンの前に切断する
+- recovered: primary が回復する (サーキットが閉じた後に primary へ戻る)
+
+使い方:
+    python -m benchmarks.failover [--concurrency 4] [--requests 12] [--routing latency]
+"""
+
+import os
+import time
+import argparse
+import threading
+from benchmarks.fakes import FakeServices
+from benchmarks.load import percentile, run_conversation, start_app
+
+
+def run_phase(url: str, args: argparse.Namespace) -> dict:
+    """
+    指定した同時実行数で会話を繰り返し、結果を集計する
+    """
+    results, errors = [], []
+    lock = threading.Lock()
+    remaining = iter(range(args.requests))
+
+    def worker():
+        for _ in remaining:
+            try:
+                run_conversation(url, results, lock)
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+
+    workers = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return {"conversations": len(results), "errors": len(errors), "ttfb_p50_ms": percentile([r["ttfb"] for r in results], 50) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check routing and failover across multiple fake model endpoints")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of concurrent conversations")
+    parser.add_argument("--requests", type=int, default=12, help="conversations per phase")
+    parser.add_argument("--routing", default="latency", choices=["latency", "weighted"], help="routing strategy")
+    parser.add_argument("--cooldown", type=float, default=2, help="seconds a failing endpoint is skipped")
+    parser.add_argument("--cosmos-latency", type=float, default=0.005, help="latency injected into fake Cosmos DB operations in seconds")
+    args = parser.parse_args()
+
+    primary = FakeServices(token_rate=200, answer_tokens=20, tool_calls=0)
+    secondary = FakeServices(token_rate=50, answer_tokens=20, tool_calls=0)
+    primary.start()
+    secondary.start()
+    os.environ.update(
+        {
+            "AZURE_OPENAI_ENDPOINTS": (
+                f'[{{"name": "primary", "endpoint": "{primary.url}", "api_key": "fake", "deployment": "gpt-4o"}},'
+                f' {{"name": "secondary", "endpoint": "{secondary.url}", "api_key": "fake", "deployment": "gpt-4o"}}]'
+            ),
+            "AZURE_OPENAI_ROUTING": args.routing,
+            "AZURE_OPENAI_CIRCUIT_COOLDOWN": str(args.cooldown),
+            "AZURE_OPENAI_TIMEOUT": "5",
+        }
+    )
+    url = start_app(primary, args)
+
+    for phase in ["healthy", "error", "stream", "recovered"]:
+        primary.outage = phase if phase in ("error", "stream") else None
+        if phase == "recovered":
+            time.sleep(args.cooldown)
+        primary.chat_completion_requests = secondary.chat_completion_requests = 0
+        report = run_phase(url, args)
+        print(
+            f"{phase:<10} conversations={report['conversations']} errors={report['errors']} ttfb_p50={report['ttfb_p50_ms']:.1f}ms "
+            f"primary_requests={primary.chat_completion_requests} secondary_requests={secondary.chat_completion_requests}"
+        )
+    primary.stop()
+    secondary.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+ベンチマーク用の、Azure の各サービスのローカルな代替実装
+
+- FakeServices: Azure OpenAI Service (チャット補完のストリーミングと Function Calling、埋め込み)、Bing Search API、
+  Azure AI Search、Web ページを1つのローカル HTTP サーバで再現する
+- FakeCosmosClient: azure.cosmos.CosmosClient の代わりに、メモリ上でアイテムを読み書きする (遅延を挿入できる)
+"""
+
+import copy
+import json
+import time
+import uuid
+import threading
+from flask import Flask, Response, request
+from werkzeug.serving import make_server
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceExistsError, CosmosResourceNotFoundError
+
+
+class FakeServices:
+    """
+    Azure OpenAI Service・Bing Search API・Azure AI Search・Web ページを再現するローカル HTTP サーバ
+
+    Args:
+        token_rate (float): 回答を返す速度 (トークン/秒)
+        answer_tokens (int): 回答のトークン数
+        tool_calls (int): 最初の応答で要求するツール呼び出しの数 (0 の場合はツールを呼び出さない)
+        tool_latency (float): Bing Search API・Azure AI Search・Web ページの応答にかかる時間(秒)
+        page_bytes (int): Web ページの大きさ(バイト)
+        vectorize_latency (float): クエリのベクトル化にかかる時間(秒) (埋め込みの1リクエスト、または Azure AI Search のベクトルクエリ1件ごと)
+        rpm_limit (int): チャット補完の1分あたりのリクエスト数の上限 (超えた場合は retry-after-ms 付きの 429 を返す、0 の場合は制限しない)
+
+    outage 属性で、チャット補完の障害を再現できる (起動後に変更してもよい)。
+    "error" の場合は 503 を返し、"stream" の場合はストリームを最初のトークンの前に切断する。
+    """
+
+    def __init__(
+        self,
+        token_rate: float = 50,
+        answer_tokens: int = 200,
+        tool_calls: int = 1,
+        tool_latency: float = 0.2,
+        page_bytes: int = 50000,
+        vectorize_latency: float = 0.05,
+        rpm_limit: int = 0,
+    ):
+        self.token_rate = token_rate
+        self.answer_tokens = answer_tokens
+        self.tool_calls = tool_calls
+        self.tool_latency = tool_latency
+        self.page_bytes = page_bytes
+        self.vectorize_latency = vectorize_latency
+        self.embedding_requests = 0
+        self.rpm_limit = rpm_limit
+        self.chat_requests = []  # 直近1分間のチャット補完のリクエスト時刻
+        self.throttled_requests = 0
+        self.outage = None
+        self.chat_completion_requests = 0
+        self.lock = threading.Lock()
+        self.app = Flask(__name__)
+        self.app.add_url_rule("/openai/deployments/<deployment>/chat/completions", view_func=self.chat_completions, methods=["POST"])
+        self.app.add_url_rule("/openai/deployments/<deployment>/embeddings", view_func=self.embeddings, methods=["POST"])
+        self.app.add_url_rule("/bing/search", view_func=self.bing_search)
+        self.app.add_url_rule("/bing/news/search", view_func=self.bing_news_search)
+        self.app.add_url_rule("/indexes('<index>')/docs/search.post.search", view_func=self.search_documents, methods=["POST"])
+        self.app.add_url_rule("/pages/<int:page>", view_func=self.page)
+        self.server = None
+        self.url = None
+
+    def start(self, port: int = 0) -> str:
+        """
+        バックグラウンドのスレッドでサーバを起動し、ベース URL を返す
+        """
+        self.server = make_server("127.0.0.1", port, self.app, threaded=True)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+
+    def chat_completions(self, deployment: str) -> Response:
+        self.chat_completion_requests += 1
+        throttled = self._throttle()
+        if throttled:
+            return throttled
+        if self.outage == "error":
+            return Response(json.dumps({"error": {"code": "503", "message": "Service unavailable."}}), status=503, mimetype="application/json")
+        if self.outage == "stream":
+            return Response(self._broken_stream(deployment), mimetype="text/event-stream")
+        body = request.json
+        messages = body["messages"]
+        tools = [t["function"]["name"] for t in body.get("tools") or []]
+        if not body.get("stream"):
+            return self._completion(deployment, body)
+        if tools and self.tool_calls > 0 and messages[-1]["role"] == "user":
+            return Response(self._stream_tool_calls(deployment, tools), mimetype="text/event-stream")
+        return Response(self._stream_answer(deployment), mimetype="text/event-stream")
+
+    def embeddings(self, deployment: str) -> dict:
+        time.sleep(self.vectorize_latency)
+        self.embedding_requests += 1
+        inputs = request.json["input"]
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        data = [{"object": "embedding", "index": i, "embedding": [(hash(text) >> (8 * d)) % 256 / 256 for d in range(8)]} for i, text in enumerate(inputs)]
+        return {"object": "list", "model": deployment, "data": data, "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)}}
+
+    def bing_search(self) -> dict:
+        time.sleep(self.tool_latency)
+        query = request.args.get("q", "")
+        count = int(request.args.get("count", 3))
+        return {"webPages": {"value": [{"name": f"{query} {i}", "url": f"{self.url}/pages/{i}", "snippet": f"{query} の検索結果 {i}"} for i in range(count)]}}
+
+    def bing_news_search(self) -> dict:
+        time.sleep(self.tool_latency)
+        query = request.args.get("q", "")
+        count = int(request.args.get("count", 3))
+        return {"value": [{"name": f"{query} ニュース {i}", "url": f"{self.url}/pages/{i}", "description": f"{query} のニュース {i}"} for i in range(count)]}
+
+    def search_documents(self, index: str) -> dict:
+        # ベクトル化が必要なクエリ(kind=text)は、検索サービス側でベクトルフィールドごとにベクトル化する
+        vectorizations = sum(1 for q in request.json.get("vectorQueries") or [] if q.get("kind") == "text")
+        time.sleep(self.tool_latency + self.vectorize_latency * vectorizations)
+        top = request.json.get("top", 3)
+        return {"value": [{"@search.score": 1.0 - i / 10, "id": str(i), "content": f"ドキュメント {i} の本文"} for i in range(top)]}
+
+    def page(self, page: int) -> Response:
+        time.sleep(self.tool_latency)
+        paragraph = f"<p>ページ {page} の本文です。<a href='/pages/{page + 1}'>次のページ</a></p>"
+        body = paragraph * max(1, self.page_bytes // len(paragraph.encode("utf-8")))
+        html = f"<html><head><title>Page {page}</title><script>var x = 1;</script></head><body><nav>nav</nav><main>{body}</main></body></html>"
+        return Response(html, mimetype="text/html", headers={"ETag": f'"page-{page}"'})
+
+    def _throttle(self) -> Response:
+        # 直近1分間のリクエスト数が上限に達している場合は、最も古いリクエストから1分後までの 429 を返す
+        if not self.rpm_limit:
+            return None
+        with self.lock:
+            now = time.monotonic()
+            self.chat_requests = [t for t in self.chat_requests if now - t < 60]
+            if len(self.chat_requests) < self.rpm_limit:
+                self.chat_requests.append(now)
+                return None
+            self.throttled_requests += 1
+            retry_after_ms = int((60 - (now - self.chat_requests[0])) * 1000) + 1
+        body = {"error": {"code": "429", "message": "Requests to the ChatCompletions_Create Operation have exceeded rate limit."}}
+        return Response(json.dumps(body), status=429, mimetype="application/json", headers={"retry-after-ms": str(retry_after_ms)})
+
+    def _completion(self, deployment: str, body: dict) -> dict:
+        time.sleep(20 / self.token_rate)
+        json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+        content = json.dumps({"title": "ベンチマーク"}, ensure_ascii=False) if json_mode else "これまでの会話の要約です。"
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+        }
+
+    def _stream_answer(self, deployment: str):
+        yield self._sse(deployment, [])  # Azure OpenAI Service は最初に choices が空のチャンクを返す
+        yield self._sse(deployment, [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+        for i in range(self.answer_tokens):
+            time.sleep(1 / self.token_rate)
+            yield self._sse(deployment, [{"index": 0, "delta": {"content": f"トークン{i} "}, "finish_reason": None}])
+        yield self._sse(deployment, [{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        yield "data: [DONE]\n\n"
+
+    def _broken_stream(self, deployment: str):
+        yield self._sse(deployment, [])
+        time.sleep(10 / self.token_rate)
+        raise ConnectionError("fake stream broken before the first token")
+
+    def _stream_tool_calls(self, deployment: str, tools: list[str]):
+        yield self._sse(deployment, [])
+        time.sleep(10 / self.token_rate)
+        for index in range(self.tool_calls):
+            name = tools[index % len(tools)]
+            arguments = json.dumps({"url": f"{self.url}/pages/{index}"} if name == "get_html_by_url" else {"query": f"ベンチマーク {index}"}, ensure_ascii=False)
+            call = {"index": index, "id": f"call_{uuid.uuid4().hex[:8]}", "type": "function", "function": {"name": name, "arguments": ""}}
+            delta = {"role": "assistant", "tool_calls": [call]} if index == 0 else {"tool_calls": [call]}
+            yield self._sse(deployment, [{"index": 0, "delta": delta, "finish_reason": None}])
+            for start in range(0, len(arguments), 8):
+                time.sleep(1 / self.token_rate)
+                fragment = {"index": index, "function": {"arguments": arguments[start : start + 8]}}
+                yield self._sse(deployment, [{"index": 0, "delta": {"tool_calls": [fragment]}, "finish_reason": None}])
+        yield self._sse(deployment, [{"index": 0, "delta": {}, "finish_reason": "tool_calls"}])
+        yield "data: [DONE]\n\n"
+
+    @staticmethod
+    def _sse(deployment: str, choices: list[dict]) -> str:
+        chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": deployment, "choices": choices}
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+class FakeCosmosClient:
+    """
+    azure.cosmos.CosmosClient の代わりに使う、メモリ上の Cosmos DB
+
+    1リクエストあたりに挿入する遅延(秒)は、クラス変数 latency で指定する
+    """
+
+    latency = 0.005
+
+    def __init__(self):
+        self.container = FakeContainer(self.latency)
+
+    @classmethod
+    def from_connection_string(cls, connection_string: str, **kwargs) -> "FakeCosmosClient":
+        return cls()
+
+    def create_database_if_not_exists(self, id: str, **kwargs) -> "FakeCosmosClient":
+        return self
+
+    def get_database_client(self, id: str) -> "FakeCosmosClient":
+        return self
+
+    def create_container_if_not_exists(self, id: str, partition_key, **kwargs) -> "FakeContainer":
+        self.container.partition_key_path = partition_key["paths"][0]
+        return self.container
+
+    def get_container_client(self, id: str) -> "FakeContainer":
+        return self.container
+
+
+class FakeContainer:
+    """
+    azure.cosmos.ContainerProxy の代わりに使う、メモリ上のコンテナ
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.partition_key_path = "/userId"
+        self.items = {}  # (パーティションキー, ID) -> アイテム
+        self.lock = threading.Lock()
+
+    def read(self) -> dict:
+        return {"partitionKey": {"paths": [self.partition_key_path]}}
+
+    def read_item(self, item: str, partition_key: str, etag: str = None, match_condition=None, **kwargs) -> dict:
+        time.sleep(self.latency)
+        with self.lock:
+            stored = self.items.get((partition_key, item))
+            if stored is None:
+                raise CosmosResourceNotFoundError(message="Not Found")
+            if etag and stored["_etag"] == etag:
+                return None  # 304 Not Modified
+            return copy.deepcopy(stored)
+
+    def create_item(self, body: dict, **kwargs) -> dict:
+        time.sleep(self.latency)
+        key = (body[self.partition_key_path[1:]], body["id"])
+        with self.lock:
+            if key in self.items:
+                raise CosmosResourceExistsError(message="Conflict")
+            return self._store(key, copy.deepcopy(body))
+
+    def upsert_item(self, body: dict, etag: str = None, match_condition=None, **kwargs) -> dict:
+        time.sleep(self.latency)
+        key = (body[self.partition_key_path[1:]], body["id"])
+        with self.lock:
+            if etag and (key not in self.items or self.items[key]["_etag"] != etag):
+                raise CosmosAccessConditionFailedError(message="Precondition Failed")
+            return self._store(key, copy.deepcopy(body))
+
+    def patch_item(self, item: str, partition_key: str, patch_operations: list[dict], etag: str = None, match_condition=None, **kwargs) -> dict:
+        time.sleep(self.latency)
+        key = (partition_key, item)
+        with self.lock:
+            stored = self.items.get(key)
+            if stored is None:
+                raise CosmosResourceNotFoundError(message="Not Found")
+            if etag and stored["_etag"] != etag:
+                raise CosmosAccessConditionFailedError(message="Precondition Failed")
+            stored = copy.deepcopy(stored)
+            for operation in patch_operations:
+                path = operation["path"].strip("/").split("/")
+                if operation["op"] == "add" and path[-1] == "-":
+                    stored[path[0]].append(operation["value"])
+                elif operation["op"] == "incr":
+                    stored[path[0]] = stored.get(path[0], 0) + operation["value"]
+                else:
+                    stored[path[0]] = operation["value"]
+            return self._store(key, stored)
+
+    def delete_item(self, item: str, partition_key: str, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            if self.items.pop((partition_key, item), None) is None:
+                raise CosmosResourceNotFoundError(message="Not Found")
+
+    def query_items(self, query: str, parameters: list[dict] = None, partition_key: str = None, max_item_count: int = 20, **kwargs) -> "FakePager":
+        # チャット一覧のクエリ (ユーザのチャットを更新日時の新しい順に取得) のみを再現する
+        time.sleep(self.latency)
+        user_id = {p["name"]: p["value"] for p in parameters or []}.get("@userId", partition_key)
+        with self.lock:
+            talks = [i for (pk, _), i in self.items.items() if pk == user_id and "talkId" not in i]
+        talks.sort(key=lambda i: i["_ts"], reverse=True)
+        return FakePager([{"id": t["id"], "title": t["title"], "updatedAt": t["_ts"]} for t in talks], max_item_count)
+
+    def _store(self, key: tuple[str, str], item: dict) -> dict:
+        item["_etag"] = f'"{uuid.uuid4().hex}"'
+        item["_ts"] = time.time()
+        self.items[key] = item
+        return copy.deepcopy(item)
+
+
+class FakePager:
+    """
+    azure.core.paging.ItemPaged の代わりに使う、継続トークン付きのページャー
+    """
+
+    def __init__(self, items: list[dict], page_size: int):
+        self.items = items
+        self.page_size = page_size
+        self.continuation_token = None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def by_page(self, continuation_token: str = None) -> "FakePager":
+        self.offset = int(continuation_token or 0)
+        return self
+
+    def __next__(self) -> list[dict]:
+        page = self.items[self.offset : self.offset + self.page_size]
+        self.offset += self.page_size
+        self.continuation_token = str(self.offset) if self.offset < len(self.items) else None
+        return page
@@ -0,0 +1,101 @@
+"""
+HtmlTool.remove_unnecessary_html_tags のベンチマーク
+
+保存済みのHTMLページ(*.html)に対して、現在の1回走査の実装と従来の BeautifulSoup による実装の
+処理時間と出力を比較する。ページを指定しない場合は、深い入れ子を含む合成ページで計測する。
+
+使い方:
+    python -m benchmarks.html_cleaner [保存済みページのディレクトリ] [--repeat N]
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+import difflib
+from bs4 import BeautifulSoup, Comment
+from utils.html import HtmlTool
+
+
+def remove_unnecessary_html_tags_bs4(html: str, required_attrs: list[str] = ["href", "src", "alt", "title"]) -> str:
+    """
+    従来の BeautifulSoup による実装 (比較用)
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    unnecessary_tags = [
+        "head", "meta", "style", "link", "script", "noscript", "header", "footer", "nav", "img", "svg", "form", "select",
+        "input", "textarea", "button", "i", "iframe", "figure", "object", "audio", "video", "progress", "canvas", "picture",
+    ]
+    for tag in unnecessary_tags:
+        for tag_elm in soup.find_all(tag):
+            tag_elm.extract()
+    for selector in ["div.header", "div.footer", "div.page-header", "div.page-footer", "div.nav"]:
+        for tag_elm in soup.select(selector):
+            tag_elm.extract()
+    for name in ["main", "section#main", "section#main-content", "section.main", "section.main-content", "div#main", "div#main-content", "div.main", "div.main-content", "body"]:
+        elm = soup.find(name)
+        if elm is not None:
+            soup = elm
+            break
+    for tag in soup.find_all():
+        if tag.text.strip() == "":
+            tag.extract()
+    for tag in soup.find_all():
+        tag.attrs = {key: tag.attrs[key] for key in tag.attrs.keys() if key in required_attrs}
+    for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
+        comment.extract()
+    for div in soup.find_all("div"):
+        div.unwrap()
+    return str(soup).replace("\n", "").strip()
+
+
+def synthetic_pages() -> dict[str, str]:
+    """
+    合成ページ(深い入れ子・大量の段落)を生成する
+    """
+    nested = "<div><section>" * 200 + "<p>深い入れ子の本文</p>" + "</section></div>" * 200
+    paragraphs = "".join(f'<p class="p{i}" onclick="f()">段落 {i} <a href="/p/{i}">リンク</a><span> </span></p>' for i in range(5000))
+    page = '<html><head><script>var x = 1;</script></head><body><header>ヘッダー</header><main>{}</main><footer>フッター</footer></body></html>'
+    return {"nested.html": page.format(nested), "paragraphs.html": page.format(paragraphs)}
+
+
+def load_pages(directory: str) -> dict[str, str]:
+    pages = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.html"))):
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            pages[os.path.basename(path)] = f.read()
+    return pages
+
+
+def measure(func, html: str, repeat: int) -> tuple[float, str]:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(html)
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTML cleaning benchmark")
+    parser.add_argument("directory", nargs="?", help="directory of saved *.html pages")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    sys.setrecursionlimit(10000)  # BeautifulSoup は深い入れ子で再帰が深くなる
+    pages = load_pages(args.directory) if args.directory else synthetic_pages()
+    if not pages:
+        sys.exit(f"no *.html pages found in {args.directory}")
+    print(f"{'page':<40} {'bytes':>10} {'bs4 ms':>10} {'1-pass ms':>10} {'speedup':>8} {'similarity':>10}")
+    total_old = total_new = 0.0
+    for name, html in pages.items():
+        old_time, old_result = measure(remove_unnecessary_html_tags_bs4, html, args.repeat)
+        new_time, new_result = measure(HtmlTool.remove_unnecessary_html_tags, html, args.repeat)
+        similarity = 1.0 if old_result == new_result else difflib.SequenceMatcher(None, old_result, new_result, autojunk=False).quick_ratio()
+        total_old += old_time
+        total_new += new_time
+        print(f"{name[:40]:<40} {len(html):>10} {old_time * 1000:>10.1f} {new_time * 1000:>10.1f} {old_time / new_time:>7.1f}x {similarity:>10.3f}")
+    print(f"{'total':<40} {'':>10} {total_old * 1000:>10.1f} {total_new * 1000:>10.1f} {total_old / total_new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Azure のリソースを使わずに app.py の負荷試験を行うベンチマーク
+
+Azure OpenAI Service・Cosmos DB・Bing Search API・Azure AI Search・Web ページをローカルの代替実装
+(benchmarks/fakes.py) に置き換えて app.py を起動し、指定した同時実行数でチャットの作成 (POST /talks) と
+メッセージの送信 (POST /talks/<id>/message) を繰り返す。
+最初の応答までの時間 (TTFB)・トークン/秒・レイテンシのパーセンタイル・1ストリームあたりのメモリを出力する。
+
+使い方:
+    python -m benchmarks.load [--concurrency 20] [--requests 100] [--token-rate 50] [--answer-tokens 200] [--tool-calls 1]
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import statistics
+import requests
+import dotenv
+from werkzeug.serving import make_server
+from benchmarks.fakes import FakeServices, FakeCosmosClient
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def rss_bytes() -> int:
+    # Linux の /proc から現在の常駐メモリサイズを取得する
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def start_app(services: FakeServices, args: argparse.Namespace) -> str:
+    """
+    代替実装を向くように環境変数を設定して app.py を読み込み、バックグラウンドで起動する
+    """
+    os.environ.update(
+        {
+            "DEBUG": "true",
+            "AZURE_OPENAI_ENDPOINT": services.url,
+            "AZURE_OPENAI_API_KEY": "fake",
+            "AZURE_OPENAI_MODEL": "gpt-4o",
+            "AZURE_COSMOS_CONNECTION_STRING": "fake",
+            "AZURE_COSMOS_DB_NAME": "db",
+            "AZURE_COSMOS_CONTAINER_NAME": "talks",
+            "BING_SEARCH_API_KEY": "fake",
+            "BING_SEARCH_ENDPOINT": f"{services.url}/bing",
+            "AZURE_SEARCH_ENDPOINT": services.url,
+            "AZURE_SEARCH_QUERY_KEY": "fake",
+            "AZURE_SEARCH_INDEX_NAME": "docs",
+        }
+    )
+
+    # .env の設定で実際の Azure リソースへ接続しないように、読み込みを無効化する
+    dotenv.load_dotenv = lambda *a, **k: False
+
+    # Cosmos DB をメモリ上の代替実装に置き換える
+    import utils.cosmos
+
+    FakeCosmosClient.latency = args.cosmos_latency
+    utils.cosmos.CosmosClient = FakeCosmosClient
+
+    from app import app
+    from utils.logger import logger
+
+    # リクエストごとのログ出力を抑制する
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    logger.setLevel(logging.WARNING)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def run_conversation(url: str, results: list, lock: threading.Lock):
+    """
+    チャットを作成してメッセージを1件送信し、各種の時間を記録する
+    """
+    session = requests.Session()
+    start = time.perf_counter()
+    resp = session.post(f"{url}/talks", json={"title": "ベンチマーク"})
+    resp.raise_for_status()
+    talk_id = resp.json()["id"]
+    create_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    first_byte = None
+    tokens = 0
+    with session.post(f"{url}/talks/{talk_id}/message", json={"message": "ベンチマークの質問です", "stream_version": 2}, stream=True) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            if not line:
+                continue
+            frame = json.loads(line)
+            if "delta" in frame:
+                if first_byte is None:
+                    first_byte = time.perf_counter() - start
+                tokens += 1
+    total = time.perf_counter() - start
+    stream_time = total - (first_byte or 0)
+
+    with lock:
+        results.append(
+            {
+                "create": create_time,
+                "ttfb": first_byte or total,
+                "total": total,
+                "tokens": tokens,
+                "tokens_per_sec": tokens / stream_time if stream_time > 0 else 0.0,
+            }
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load benchmark for app.py")
+    parser.add_argument("--concurrency", type=int, default=20, help="number of concurrent conversations")
+    parser.add_argument("--requests", type=int, default=100, help="total number of conversations")
+    parser.add_argument("--token-rate", type=float, default=50, help="fake model output tokens per second")
+    parser.add_argument("--answer-tokens", type=int, default=200, help="tokens per fake answer")
+    parser.add_argument("--tool-calls", type=int, default=1, help="tool calls requested by the fake model per answer")
+    parser.add_argument("--tool-latency", type=float, default=0.2, help="latency of fake Bing/Search/HTML responses in seconds")
+    parser.add_argument("--cosmos-latency", type=float, default=0.005, help="latency injected into fake Cosmos DB operations in seconds")
+    parser.add_argument("--rpm-limit", type=int, default=0, help="requests per minute accepted by the fake model before it returns 429")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    services = FakeServices(token_rate=args.token_rate, answer_tokens=args.answer_tokens, tool_calls=args.tool_calls, tool_latency=args.tool_latency, rpm_limit=args.rpm_limit)
+    services.start()
+    url = start_app(services, args)
+
+    # 同時実行数を保ちながら会話を繰り返す
+    results, errors = [], []
+    lock = threading.Lock()
+    remaining = iter(range(args.requests))
+
+    def worker():
+        for _ in remaining:
+            try:
+                run_conversation(url, results, lock)
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+
+    baseline_rss = rss_bytes()
+    peak_rss = baseline_rss
+    workers = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    while any(w.is_alive() for w in workers):
+        peak_rss = max(peak_rss, rss_bytes())
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    services.stop()
+
+    ttfb = [r["ttfb"] for r in results]
+    total = [r["total"] for r in results]
+    report = {
+        "conversations": len(results),
+        "errors": len(errors),
+        "concurrency": args.concurrency,
+        "elapsed_sec": elapsed,
+        "throughput_per_sec": len(results) / elapsed if elapsed else 0.0,
+        "create_talk_p50_ms": percentile([r["create"] for r in results], 50) * 1000,
+        "ttfb_p50_ms": percentile(ttfb, 50) * 1000,
+        "ttfb_p95_ms": percentile(ttfb, 95) * 1000,
+        "ttfb_p99_ms": percentile(ttfb, 99) * 1000,
+        "latency_p50_ms": percentile(total, 50) * 1000,
+        "latency_p95_ms": percentile(total, 95) * 1000,
+        "latency_p99_ms": percentile(total, 99) * 1000,
+        "tokens_per_sec_mean": statistics.mean([r["tokens_per_sec"] for r in results]) if results else 0.0,
+        "memory_per_stream_kb": (peak_rss - baseline_rss) / args.concurrency / 1024,
+        "throttled_responses": services.throttled_requests,
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:<24} {value:>12.1f}" if isinstance(value, float) else f"{key:<24} {value:>12}")
+    if errors:
+        print(f"first error: {errors[0]}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
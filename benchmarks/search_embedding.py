@@ -0,0 +1,102 @@
+"""
+Azure AI Search のベクトル検索で、クエリのベクトル化をどこで行うかによるレイテンシの違いを計測するベンチマーク
+
+- service: VectorizableTextQuery を送り、検索サービス側でベクトルフィールドごとにクエリをベクトル化する
+- client: アプリ側で埋め込みを計算し (キャッシュ・同時リクエストのまとめあり)、VectorizedQuery を全てのベクトルフィールドで使い回す
+
+Azure AI Search と Azure OpenAI Service の埋め込みはローカルの代替実装 (benchmarks/fakes.py) に置き換える。
+検索サービス側のベクトル化はベクトルクエリ1件ごとに、埋め込みは1リクエストごとに --vectorize-latency 秒かかるものとする。
+
+使い方:
+    python -m benchmarks.search_embedding [--queries 20] [--repeat 5] [--concurrency 8] [--fields 2]
+"""
+
+import os
+import time
+import logging
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.fakes import FakeServices
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run(mode: str, queries: list[str], args: argparse.Namespace) -> dict:
+    """
+    指定したモードの AzureSearchClient で全クエリを検索し、1検索あたりのレイテンシを集計する
+    """
+    if mode == "client":
+        os.environ["AZURE_OPENAI_EMBEDDING_MODEL"] = "text-embedding-3-small"
+    else:
+        os.environ.pop("AZURE_OPENAI_EMBEDDING_MODEL", None)
+
+    from utils.search import AzureSearchClient
+
+    client = AzureSearchClient()
+
+    # モジュールの読み込みや接続の確立を計測に含めないように、別のクエリで1度検索しておく
+    client.search("ウォームアップ", top=3)
+    latencies = []
+
+    def search(query: str):
+        start = time.perf_counter()
+        client.search(query, top=3)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(search, queries))
+    elapsed = time.perf_counter() - start
+    return {
+        "mode": mode,
+        "searches": len(latencies),
+        "elapsed_sec": elapsed,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "embedding_cache": client.embedder.stats() if client.embedder else {},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare service-side and client-side query vectorization")
+    parser.add_argument("--queries", type=int, default=20, help="number of distinct queries")
+    parser.add_argument("--repeat", type=int, default=5, help="times each query is searched")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent searches")
+    parser.add_argument("--fields", type=int, default=2, help="number of vector fields")
+    parser.add_argument("--search-latency", type=float, default=0.05, help="latency of a fake search without vectorization in seconds")
+    parser.add_argument("--vectorize-latency", type=float, default=0.05, help="latency of vectorizing a query in seconds")
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    services = FakeServices(tool_latency=args.search_latency, vectorize_latency=args.vectorize_latency)
+    services.start()
+    os.environ.update(
+        {
+            "AZURE_OPENAI_ENDPOINT": services.url,
+            "AZURE_OPENAI_API_KEY": "fake",
+            "AZURE_SEARCH_ENDPOINT": services.url,
+            "AZURE_SEARCH_QUERY_KEY": "fake",
+            "AZURE_SEARCH_INDEX_NAME": "docs",
+            "AZURE_SEARCH_VECTOR_FIELD_NAMES": ",".join(f"vector{i}" for i in range(args.fields)),
+        }
+    )
+
+    queries = [f"ベンチマークの質問 {i % args.queries}" for i in range(args.queries * args.repeat)]
+    for mode in ["service", "client"]:
+        services.embedding_requests = 0
+        report = run(mode, queries, args)
+        print(
+            f"{mode:<8} searches={report['searches']} elapsed={report['elapsed_sec']:.2f}s "
+            f"mean={report['mean_ms']:.1f}ms p50={report['p50_ms']:.1f}ms p95={report['p95_ms']:.1f}ms "
+            f"embedding_requests={services.embedding_requests}"
+        )
+    services.stop()
+
+
+if __name__ == "__main__":
+    main()
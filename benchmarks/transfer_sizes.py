@@ -0,0 +1,84 @@
+"""
+静的ファイルと API のレスポンスの転送量 (圧縮後の実際のバイト数) を比較するベンチマーク
+
+代替実装 (benchmarks/fakes.py) を向けて app.py を起動し、以下を Accept-Encoding を付けない場合 (identity)・
+gzip の場合・brotli の場合 (brotli がインストールされている場合のみ) で取得して、転送されたバイト数を出力する。
+
+- 静的ファイル (index.html とそこから参照するファイル) の初回表示
+- 再訪問 (index.html は ETag で 304、ハッシュ付きのパスはキャッシュから読むため転送しない)
+- 回答のストリーミング (差分形式) と、チャット一覧の JSON (RESPONSE_COMPRESSION_ENABLED を有効にした場合)
+
+使い方:
+    python -m benchmarks.transfer_sizes [--answer-tokens 200] [--talks 20]
+"""
+
+import re
+import argparse
+import requests
+from benchmarks.fakes import FakeServices
+from benchmarks.load import start_app
+from utils.compression import ENCODINGS
+
+# index.html から参照するローカルのファイル
+REFERENCE_PATTERN = re.compile(r'(?:src|href)="([^"#:]+)"')
+
+
+def get(url: str, encoding: str, headers: dict = None, method: str = "GET", **kwargs) -> tuple[requests.Response, int]:
+    """
+    リクエストを送り、レスポンスと転送されたボディのバイト数 (展開前) を返す
+    """
+    headers = {"Accept-Encoding": encoding or "identity", **(headers or {})}
+    with requests.request(method, url, headers=headers, stream=True, **kwargs) as resp:
+        resp.raise_for_status()
+        size = len(resp.raw.read(decode_content=False))
+    return resp, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare transfer sizes of static assets and API responses per content encoding")
+    parser.add_argument("--answer-tokens", type=int, default=200, help="tokens per fake answer")
+    parser.add_argument("--talks", type=int, default=20, help="talks created before listing them")
+    parser.add_argument("--cosmos-latency", type=float, default=0.0, help="latency injected into fake Cosmos DB operations in seconds")
+    args = parser.parse_args()
+
+    services = FakeServices(token_rate=1000, answer_tokens=args.answer_tokens, tool_calls=0)
+    services.start()
+    url = start_app(services, args)
+    import app
+
+    encodings = [None] + list(reversed(ENCODINGS))
+    rows = []
+
+    # 初回表示: index.html と、そこから参照するローカルのファイル
+    index = requests.get(f"{url}/").text
+    paths = ["/"] + [f"/{p}" for p in REFERENCE_PATTERN.findall(index)]
+    first_visit = {e: sum(get(f"{url}{p}", e)[1] for p in paths) for e in encodings}
+    rows.append(("first visit (static)", first_visit))
+
+    # 再訪問: index.html は ETag で確認し、ハッシュ付きのパスはブラウザのキャッシュから読む (転送しない)
+    repeat_visit = {}
+    for e in encodings:
+        resp, _ = get(f"{url}/", e)
+        resp, size = get(f"{url}/", e, headers={"If-None-Match": resp.headers["ETag"]})
+        assert resp.status_code == 304
+        repeat_visit[e] = size
+    rows.append(("repeat visit (static)", repeat_visit))
+
+    # 回答のストリーミングとチャット一覧の JSON (圧縮の有効・無効を切り替える)
+    for _ in range(args.talks):
+        talk_id = requests.post(f"{url}/talks", json={"title": "転送量の確認"}).json()["id"]
+    body = {"message": "転送量の確認の質問です", "stream_version": 2}
+    for enabled in [False, True]:
+        app.RESPONSE_COMPRESSION_ENABLED = enabled
+        label = "on" if enabled else "off"
+        rows.append((f"answer stream (compression {label})", {e: get(f"{url}/talks/{talk_id}/message", e, method="POST", json=body)[1] for e in encodings}))
+        rows.append((f"talk list JSON (compression {label})", {e: get(f"{url}/talks?limit={args.talks}", e)[1] for e in encodings}))
+
+    print(f"{'':<36}" + "".join(f"{e or 'identity':>12}" for e in encodings))
+    for name, sizes in rows:
+        print(f"{name:<36}" + "".join(f"{sizes[e]:>12,}" for e in encodings))
+    services.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+# gunicorn の設定ファイル (Azure App Service の既定の起動コマンドからも読み込まれる)
+#
+# SERVER_MODE 環境変数で、回答のストリーミングを処理するワーカーの種類を切り替える
+# - async:  gevent ワーカー。ストリーミング中の回答が I/O 待ちの間はスレッドを占有しないため、
+#           1プロセスで数百の回答を同時にストリーミングできる (既定)
+# - thread: gthread ワーカー。1つの回答が完了するまで1スレッドを占有する (従来の動作)
+import os
+import multiprocessing
+
+mode = os.getenv("SERVER_MODE", "async")
+
+bind = "0.0.0.0:" + os.getenv("PORT", "8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+timeout = 600
+
+if mode == "async":
+    worker_class = "gevent"
+    worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 1000))
+else:
+    worker_class = "gthread"
+    threads = int(os.getenv("GUNICORN_THREADS", 8))
@@ -0,0 +1,49 @@
+"""
+会話情報を、ID でパーティション分割されたコンテナから userId でパーティション分割されたコンテナへ移行する
+
+Cosmos DB ではコンテナのパーティションキーを変更できないため、新しいコンテナを作成して全アイテムをコピーする。
+移行後は AZURE_COSMOS_CONTAINER_NAME を移行先のコンテナ名に変更してアプリを再起動する。
+
+使い方:
+    python -m scripts.migrate_cosmos_partition --source <移行元コンテナ名> --target <移行先コンテナ名> [--dry-run]
+"""
+
+import os
+import argparse
+from dotenv import load_dotenv
+from azure.cosmos import PartitionKey
+from azure.cosmos.cosmos_client import CosmosClient
+from utils.cosmos import PARTITION_KEY_PATH
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate talks to a userId-partitioned container")
+    parser.add_argument("--source", default=os.getenv("AZURE_COSMOS_CONTAINER_NAME"), help="source container name")
+    parser.add_argument("--target", required=True, help="target container name")
+    parser.add_argument("--dry-run", action="store_true", help="count items without writing")
+    args = parser.parse_args()
+
+    load_dotenv(override=True)
+    client = CosmosClient.from_connection_string(os.getenv("AZURE_COSMOS_CONNECTION_STRING"))
+    database = client.get_database_client(os.getenv("AZURE_COSMOS_DB_NAME"))
+    source = database.get_container_client(args.source)
+    target = database.create_container_if_not_exists(id=args.target, partition_key=PartitionKey(path=PARTITION_KEY_PATH))
+
+    # 移行元の全アイテムを読み込み、システムプロパティを除いて移行先へ書き込む
+    copied = skipped = 0
+    for item in source.read_all_items():
+        if "userId" not in item:
+            print(f"skip (no userId): {item['id']}")
+            skipped += 1
+            continue
+        if not args.dry_run:
+            target.upsert_item({k: v for k, v in item.items() if not k.startswith("_")})
+        copied += 1
+        if copied % 100 == 0:
+            print(f"{copied} items copied")
+
+    print(f"done: copied={copied}, skipped={skipped}{' (dry run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+会話情報を保存する Cosmos DB のデータベースとコンテナを作成する
+
+アプリの起動時にはデータベースとコンテナの作成・確認を行わないため、初回のデプロイ前に1度だけ実行する。
+既に存在する場合は、コンテナのパーティションキーが userId であることを確認し、TTL が無効であれば有効にする。
+
+使い方:
+    python -m scripts.provision_cosmos [--container <コンテナ名>]
+"""
+
+import os
+import sys
+import argparse
+from dotenv import load_dotenv
+from azure.cosmos import PartitionKey
+from azure.cosmos.cosmos_client import CosmosClient
+from utils.cosmos import PARTITION_KEY_PATH
+
+
+def main():
+    load_dotenv(override=True)
+    parser = argparse.ArgumentParser(description="Create the Cosmos DB database and container for talks")
+    parser.add_argument("--container", default=os.getenv("AZURE_COSMOS_CONTAINER_NAME"), help="container name")
+    args = parser.parse_args()
+
+    client = CosmosClient.from_connection_string(os.getenv("AZURE_COSMOS_CONNECTION_STRING"))
+    database = client.create_database_if_not_exists(id=os.getenv("AZURE_COSMOS_DB_NAME"))
+    # 回答の途中経過のアイテムは ttl を指定して自動で削除するため、TTL を有効にする (ttl を指定しないアイテムは削除されない)
+    container = database.create_container_if_not_exists(id=args.container, partition_key=PartitionKey(path=PARTITION_KEY_PATH), default_ttl=-1)
+
+    # 以前のバージョンで作成されたコンテナの場合は、移行を促す
+    paths = container.read()["partitionKey"]["paths"]
+    if paths != [PARTITION_KEY_PATH]:
+        print(
+            f"Container '{args.container}' is partitioned by {paths}, expected ['{PARTITION_KEY_PATH}']. "
+            "Migrate it with: python -m scripts.migrate_cosmos_partition",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    # 以前のバージョンで作成されたコンテナの場合は、TTL を有効にする
+    if container.read().get("defaultTtl") is None:
+        container = database.replace_container(container, partition_key=PartitionKey(path=PARTITION_KEY_PATH), default_ttl=-1)
+
+    print(f"ready: database={database.id}, container={args.container}, partition_key={PARTITION_KEY_PATH}")
+
+
+if __name__ == "__main__":
+    main()
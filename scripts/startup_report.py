@@ -0,0 +1,104 @@
+"""
+ワーカーの起動にかかる時間 (app.py の読み込み時間) を計測し、パッケージごとの内訳を出力する
+
+別プロセスで python -X importtime -c "import app" を実行し、モジュールごとの読み込み時間を
+トップレベルのパッケージ単位に集計する。起動時間の推移を追跡するために、--json で JSON 形式でも出力できる。
+
+使い方:
+    python -m scripts.startup_report [--top 15] [--debug] [--json]
+    python -m scripts.startup_report --check   # 最初に使う時に読み込むモジュールが起動時に読み込まれていないかを確認する
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# 最初に使う時に読み込むモジュール (app.py の読み込み時に読み込まれていないことを --check で確認する)
+# (Azure Monitor の送信は requests などを読み込むため、DEBUG=true で確認する)
+LAZY_MODULES = ["requests", "urllib3", "openai", "tiktoken", "azure.core", "azure.cosmos", "azure.search"]
+
+
+def measure(debug: bool) -> tuple[float, dict[str, int], set[str]]:
+    """
+    app.py を別プロセスで読み込み、全体の時間とパッケージごとの読み込み時間(マイクロ秒)、読み込まれたモジュールを返す
+    """
+    env = dict(os.environ)
+    if debug:
+        env["DEBUG"] = "true"
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"import app failed:\n{proc.stderr[-2000:]}")
+
+    # "import time: self [us] | cumulative | imported package" の形式の行を集計する
+    packages = {}
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        modules.add(name.strip())
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+    return elapsed, packages, modules
+
+
+def check_lazy_modules(modules: set[str]) -> list[str]:
+    """
+    最初に使う時に読み込むモジュールのうち、app.py の読み込み時に読み込まれたものを返す
+
+    Args:
+        modules (set[str]): app.py の読み込み時に読み込まれたモジュール
+
+    Returns:
+        list[str]: 読み込まれていたモジュール (LAZY_MODULES の名前)
+    """
+    return [lazy for lazy in LAZY_MODULES if any(m == lazy or m.startswith(f"{lazy}.") for m in modules)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the import-time breakdown of app.py")
+    parser.add_argument("--top", type=int, default=15, help="number of packages to show")
+    parser.add_argument("--debug", action="store_true", help="measure with DEBUG=true (skips Azure Monitor)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--check", action="store_true", help="fail if modules that should load lazily are imported at startup (implies --debug)")
+    args = parser.parse_args()
+
+    if args.check:
+        _, _, modules = measure(debug=True)
+        loaded = check_lazy_modules(modules)
+        if loaded:
+            print(f"modules loaded at startup that should load lazily: {', '.join(loaded)}")
+            sys.exit(1)
+        print(f"ok: none of {', '.join(LAZY_MODULES)} is loaded at startup")
+        return
+
+    elapsed, packages, _ = measure(args.debug)
+    ranking = sorted(packages.items(), key=lambda p: p[1], reverse=True)
+    report = {
+        "startup_sec": elapsed,
+        "import_sec": sum(packages.values()) / 1e6,
+        "packages": {name: us / 1e6 for name, us in ranking[: args.top]},
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'startup_sec':<32} {report['startup_sec']:>8.3f}")
+    print(f"{'import_sec':<32} {report['import_sec']:>8.3f}")
+    for name, sec in report["packages"].items():
+        print(f"  {name:<30} {sec:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
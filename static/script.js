@@ -1,6 +1,11 @@
 const DEFAULT_CHAT_TITLE = "新しいチャット";
 const MESSAGE_IN_PROGRESS = "少々お待ちください...";
 const MESSAGE_ERROR = "エラーが発生したため回答できませんでした。";
+const MESSAGE_TRUNCATED = "\n\n(回答の途中で接続が切断されました)";
+const STREAM_VERSION = 2; // 回答ストリーミングのプロトコルバージョン(2: 差分形式)
+const STREAM_RESUME_RETRIES = 5; // 回答の受信中に切断した場合に、受信が進まないまま再接続を試みる回数
+const TITLE_POLL_RETRIES = 5; // サーバ側でタイトルを生成中のまま回答を終えた場合に、タイトルを確認する回数
+const TITLE_POLL_INTERVAL = 2000; // タイトルを確認する間隔(ミリ秒)
 
 Vue.use(VueMarkdown);
 const vue = new Vue({
@@ -8,6 +13,7 @@ const vue = new Vue({
     data: {
         userMessage: "",
         talks: [],
+        talksContinuation: null, // チャット一覧の次ページの継続トークン
         selectedTalkIndex: 0,
         receiving: false,
         maxTalkCount: 20,
@@ -19,27 +25,41 @@ const vue = new Vue({
             const match = this.userMessage.match(/\n/g);
             this.textAreaRows = match ? match.length + 1 : 1;
         },
-        selectedTalkIndex: function () {
+        selectedTalkIndex: async function () {
+            await this.loadTalkMessages(this.selectedTalkIndex); // 選択されたチャットのメッセージを読み込む
             this.refreshSyntaxHighlighting(); // コードをシンタックスハイライトする
         },
     },
     async mounted() {
         await this.listTalks();
-        this.refreshSyntaxHighlighting(); // コードをシンタックスハイライトする
         if (this.talks.length == 0)
-            this.addTalk();
+            await this.addTalk();
+        await this.loadTalkMessages(this.selectedTalkIndex);
+        this.refreshSyntaxHighlighting(); // コードをシンタックスハイライトする
     },
     methods: {
         listTalks: async function () {
-            const resp = await axios.get("talks");
-            this.talks = resp.data;
+            // チャット一覧(ID・タイトルのみ)を新しい順に1ページ分取得する
+            const params = this.talksContinuation ? { continuation: this.talksContinuation } : {};
+            const resp = await axios.get("talks", { params });
+            const talks = resp.data.talks.map(t => ({ ...t, messages: null })); // メッセージは選択時に取得する
+            this.talks = this.talks.concat(talks);
+            this.talksContinuation = resp.data.continuation;
+        },
+        loadTalkMessages: async function (talkIndex) {
+            // メッセージが未取得のチャットのみサーバから取得する
+            const talk = this.talks[talkIndex];
+            if (!talk || talk.messages) return;
+            const resp = await axios.get(`talks/${talk.id}`);
+            // 接続の切断により途中で止まった回答には、その旨を付け加えて表示する
+            talk.messages = resp.data.messages.map(m => m.truncated ? { ...m, content: m.content + MESSAGE_TRUNCATED } : m);
         },
         addTalk: async function () {
             this.selectedTalkIndex = -1;
             const resp = await axios.post("talks", { title: DEFAULT_CHAT_TITLE });
             const talk = resp.data;
-            this.talks.push(talk);
-            this.selectedTalkIndex = this.talks.length - 1;
+            this.talks.unshift(talk);
+            this.selectedTalkIndex = 0;
         },
         deleteTalk: async function (talkIndex) {
             // サーバ側のチャットデータを削除する
@@ -47,16 +67,18 @@ const vue = new Vue({
 
             // チャット表示を削除する
             this.talks.splice(talkIndex, 1);
-            this.selectedTalkIndex--;
-            if (this.selectedTalkIndex < 0)
-                this.selectedTalkIndex = 0;
+            if (this.selectedTalkIndex >= this.talks.length)
+                this.selectedTalkIndex = this.talks.length - 1;
+            if (this.talks.length == 0 && this.talksContinuation)
+                await this.listTalks();
             if (this.talks.length == 0)
                 await this.addTalk();
+            await this.loadTalkMessages(this.selectedTalkIndex);
         },
         sendUserMessage: async function () {
             const talk = this.talks[this.selectedTalkIndex];
             const message = this.userMessage.trim();
-            if (this.receiving || !message) return;
+            if (this.receiving || !message || !talk.messages) return;
 
             // 画面に入力したメッセージを表示する
             talk.messages.push({ role: "user", content: message });
@@ -69,7 +91,7 @@ const vue = new Vue({
             const resp = await fetch(`/talks/${talk.id}/message`, {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({ message }),
+                body: JSON.stringify({ message, stream_version: STREAM_VERSION }),
             });
 
             // サーバ側でエラーが発生した場合の処理
@@ -80,28 +102,95 @@ const vue = new Vue({
             }
 
             // サーバ側からのメッセージを受信する(ストリーミング形式)
-            const reader = resp.body.getReader();
-            let runningText = "";
-            while (true) {
-                const { done, value } = await reader.read();
-                if (done) break;
-                const text = new TextDecoder("utf-8").decode(value);
-                text.split("\n").forEach((t) => {
-                    try {
-                        if (!t) return;
-                        runningText += t;
-                        const result = JSON.parse(runningText);
-                        if (result.content)
-                            talk.messages[talk.messages.length - 1].content = result.content
-                        runningText = "";
-                    } catch { } // JSONパースに失敗した場合は無視する(入力途中はあり得る)
-                });
+            // 差分(delta)を連番順に連結し、完了フレームの全文で最終的な内容を確定する
+            const streamId = resp.headers.get("X-Stream-Id");
+            let content = "";
+            let expectedSeq = 0;
+            let doneReceived = false;
+            let titleReceived = false;
+            let titlePending = false;
+            const applyFrame = (frame) => {
+                if (frame.title) { // サーバ側で自動生成されたタイトル
+                    talk.title = frame.title;
+                    titleReceived = true;
+                    return;
+                }
+                if (frame.error) { // サーバ側で回答の生成に失敗した (会話情報には保存されない)
+                    doneReceived = true;
+                    talk.messages[talk.messages.length - 1].content = MESSAGE_ERROR;
+                    this.receiving = false;
+                    return;
+                }
+                if (frame.done) {
+                    doneReceived = true;
+                    titlePending = !!frame.titlePending;
+                    if (frame.content !== content)
+                        console.warn("stream content mismatch; using final content");
+                    talk.messages[talk.messages.length - 1].content = frame.truncated ? frame.content + MESSAGE_TRUNCATED : frame.content;
+                    this.receiving = false; // タイトルの生成を待たずに次のメッセージを入力できるようにする
+                    this.refreshSyntaxHighlighting();
+                    return;
+                }
+                if (frame.seq < expectedSeq) return; // 再接続時に重複して受信した差分は無視する
+                if (frame.seq !== expectedSeq)
+                    console.warn(`unexpected stream seq: ${frame.seq} (expected ${expectedSeq})`);
+                expectedSeq = frame.seq + 1;
+                content += frame.delta;
+                talk.messages[talk.messages.length - 1].content = content;
+            };
+            const readFrames = async (resp) => {
+                const reader = resp.body.getReader();
+                const decoder = new TextDecoder("utf-8");
+                let buffer = "";
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    const lines = buffer.split("\n");
+                    buffer = lines.pop(); // 最後の行は受信途中の可能性があるため次回に持ち越す
+                    lines.forEach((line) => {
+                        if (!line) return; // 空行は接続確認用
+                        try {
+                            applyFrame(JSON.parse(line));
+                        } catch { } // JSONパースに失敗した行は無視する
+                    });
+                }
+            };
+            try {
+                await readFrames(resp);
+            } catch (e) {
+                console.warn("stream interrupted", e);
+            }
+
+            // 完了フレームを受信する前に切断した場合は、受信済みの連番の続きから再開する
+            // (受信が進んだ場合は、再接続を試みる回数を数え直す)
+            for (let retry = 0; !doneReceived && streamId && retry < STREAM_RESUME_RETRIES; retry++) {
+                await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** Math.min(retry, 3)));
+                const receivedSeq = expectedSeq;
+                try {
+                    const resumed = await fetch(`/talks/${talk.id}/streams/${streamId}?offset=${expectedSeq}`);
+                    if (resumed.status === 404) break;
+                    if (resumed.ok) await readFrames(resumed);
+                } catch (e) {
+                    console.warn("stream resume failed", e);
+                }
+                if (expectedSeq > receivedSeq) retry = -1;
             }
+            if (!doneReceived)
+                talk.messages[talk.messages.length - 1].content = content ? content + MESSAGE_TRUNCATED : MESSAGE_ERROR;
             this.receiving = false;
             this.refreshSyntaxHighlighting(); // コードをシンタックスハイライトする
 
             // 初回のメッセージ送信時かつタイトルが変更されていない場合にタイトルを自動生成する
-            if (talk.messages.length <= 3 && talk.title == DEFAULT_CHAT_TITLE) {
+            // (サーバ側で自動生成されたタイトルを受信した場合は不要。サーバ側で生成中の場合は、生成を依頼せずに保存されるのを待つ)
+            if (!titleReceived && titlePending) {
+                for (let retry = 0; retry < TITLE_POLL_RETRIES && talk.title == DEFAULT_CHAT_TITLE; retry++) {
+                    await new Promise(resolve => setTimeout(resolve, TITLE_POLL_INTERVAL));
+                    const resp = await axios.get(`talks/${talk.id}`);
+                    if (resp.data.title != DEFAULT_CHAT_TITLE)
+                        talk.title = resp.data.title;
+                }
+            } else if (!titleReceived && talk.messages.length <= 3 && talk.title == DEFAULT_CHAT_TITLE) {
                 const resp = await axios.post(`/talk/${talk.id}/title/gen`);
                 talk.title = resp.data;
             }
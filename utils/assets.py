@@ -0,0 +1,129 @@
+import os
+import re
+import hashlib
+import mimetypes
+import threading
+from utils.compression import ENCODINGS, compress
+
+# 圧縮して配信するファイルの拡張子 (画像などの圧縮済みの形式は除く)
+COMPRESSIBLE_EXTENSIONS = {".html", ".js", ".css", ".svg", ".json", ".txt", ".map"}
+
+# これより小さいファイルは、圧縮してもほとんど小さくならないため圧縮しない
+MIN_COMPRESS_BYTES = 256
+
+# HTML 内の、静的ファイルへの相対パスでの参照 (src="script.js" など)
+REFERENCE_PATTERN = re.compile(r'(src|href)="([^"#?:]+)"')
+
+# ハッシュ付きのパスで配信する場合の Cache-Control (内容が変わればパスも変わるため、期限なしでキャッシュさせる)
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# ハッシュなしのパス (index.html など) で配信する場合の Cache-Control (毎回 ETag で更新を確認させる)
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+class StaticAsset:
+    """
+    配信する静的ファイル
+
+    Args:
+        path (str): 静的ファイルのディレクトリからの相対パス
+        data (bytes): ファイルの内容
+    """
+
+    def __init__(self, path: str, data: bytes):
+        self.path = path
+        self.data = data
+        self.hash = hashlib.sha256(data).hexdigest()[:16]
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        stem, ext = os.path.splitext(path)
+        self.fingerprinted_path = f"{stem}.{self.hash}{ext}"
+
+        # 圧縮形式ごとの、あらかじめ圧縮した内容 (圧縮しても小さくならない場合は用意しない)
+        self.encoded = {}
+        if ext in COMPRESSIBLE_EXTENSIONS and len(data) >= MIN_COMPRESS_BYTES:
+            for encoding in ENCODINGS:
+                compressed = compress(data, encoding, level=11 if encoding == "br" else 9)
+                if len(compressed) < len(data):
+                    self.encoded[encoding] = compressed
+
+    def etag(self, encoding: str = None) -> str:
+        # 圧縮形式ごとに内容が異なるため、ETag も区別する
+        return f"{self.hash}-{encoding}" if encoding else self.hash
+
+
+class StaticAssets:
+    """
+    静的ファイルを読み込み、内容のハッシュを付けたパスと、あらかじめ圧縮した内容(brotli/gzip)を用意する
+
+    index.html 内の静的ファイルへの参照はハッシュ付きのパスに書き換える。
+    ファイルは最初に使う時にまとめて読み込む (reload が True の場合は、ファイルが更新されるたびに読み込み直す)。
+
+    Args:
+        root (str): 静的ファイルのディレクトリ
+        reload (bool): ファイルの更新を確認するかどうか (デバッグ実行用)
+    """
+
+    def __init__(self, root: str, reload: bool = False):
+        self.root = root
+        self.reload = reload
+        self.assets = None  # 相対パス -> StaticAsset
+        self.fingerprinted = {}  # ハッシュ付きのパス -> StaticAsset
+        self.signature = None
+        self.lock = threading.Lock()
+
+    def get(self, path: str) -> tuple[StaticAsset, bool]:
+        """
+        パスに対応する静的ファイルを取得する
+
+        Args:
+            path (str): リクエストされたパス (ハッシュ付きのパスでもよい)
+
+        Returns:
+            tuple[StaticAsset, bool]: 静的ファイル (存在しない場合は None) と、ハッシュ付きのパスでリクエストされたかどうか
+        """
+        if self.assets is None or (self.reload and self._signature() != self.signature):
+            with self.lock:
+                if self.assets is None or (self.reload and self._signature() != self.signature):
+                    self._load()
+        if path in self.fingerprinted:
+            return self.fingerprinted[path], True
+        return self.assets.get(path), False
+
+    def stats(self) -> dict:
+        """
+        静的ファイルの数と、圧縮形式ごとの合計サイズを取得する
+        """
+        assets = list((self.assets or {}).values())
+        stats = {"files": len(assets), "identity_bytes": sum(len(a.data) for a in assets)}
+        for encoding in ENCODINGS:
+            stats[f"{encoding}_bytes"] = sum(len(a.encoded.get(encoding, a.data)) for a in assets)
+        return stats
+
+    def _load(self):
+        files = {}
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                full_path = os.path.join(directory, name)
+                with open(full_path, "rb") as f:
+                    files[os.path.relpath(full_path, self.root).replace(os.sep, "/")] = f.read()
+
+        # HTML 以外を先に用意し、HTML 内の参照をハッシュ付きのパスに書き換える
+        assets = {path: StaticAsset(path, data) for path, data in files.items() if not path.endswith(".html")}
+
+        def fingerprint(match: re.Match) -> str:
+            asset = assets.get(match.group(2))
+            return f'{match.group(1)}="{asset.fingerprinted_path}"' if asset else match.group(0)
+
+        for path, data in files.items():
+            if path.endswith(".html"):
+                assets[path] = StaticAsset(path, REFERENCE_PATTERN.sub(fingerprint, data.decode("utf-8")).encode("utf-8"))
+
+        self.fingerprinted = {asset.fingerprinted_path: asset for asset in assets.values()}
+        self.assets = assets
+        self.signature = self._signature()
+
+    def _signature(self) -> tuple:
+        # ファイルのパスと更新日時の組 (ファイルの追加・更新・削除の検知に使う)
+        return tuple(
+            sorted((os.path.join(directory, name), os.path.getmtime(os.path.join(directory, name))) for directory, _, names in os.walk(self.root) for name in names)
+        )
@@ -1,11 +1,13 @@
 import os
-import requests
+from utils.http import get_session, get_timeout
 
 
 class BingSearchClient:
 
     def __init__(self):
         self.api_key = os.environ.get("BING_SEARCH_API_KEY")
+        self.endpoint = os.environ.get("BING_SEARCH_ENDPOINT", "https://api.bing.microsoft.com/v7.0").rstrip("/")
+        self.session = get_session()
 
     def search_web_pages(self, query: str, mkt: str = "ja-JP", count: int = 10, offset: int = 0) -> list[dict]:
         """
@@ -22,7 +24,7 @@ class BingSearchClient:
         """
         params = {"q": query, "mkt": mkt, "count": count, "offset": offset, "sortby": "date"}
         headers = {"Ocp-Apim-Subscription-Key": self.api_key}
-        resp = requests.get(f"https://api.bing.microsoft.com/v7.0/search", params=params, headers=headers)
+        resp = self.session.get(f"{self.endpoint}/search", params=params, headers=headers, timeout=get_timeout())
         resp.raise_for_status()
         resp = resp.json()
         return resp["webPages"]["value"] if "webPages" in resp else []
@@ -52,6 +54,6 @@ class BingSearchClient:
         """
         params = {"q": query, "mkt": mkt, "count": count, "offset": offset, "sortby": sortby, "freshness": freshness}
         headers = {"Ocp-Apim-Subscription-Key": self.api_key}
-        resp = requests.get(f"https://api.bing.microsoft.com/v7.0//news/search", params=params, headers=headers)
+        resp = self.session.get(f"{self.endpoint}/news/search", params=params, headers=headers, timeout=get_timeout())
         resp.raise_for_status()
         return resp.json()["value"]
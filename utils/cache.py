@@ -0,0 +1,199 @@
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    プロセス内で保持する、有効期限とサイズ上限(バイト数)付きの LRU キャッシュ
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()  # key -> (有効期限, 値, サイズ)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> str:
+        """
+        キャッシュから値を取得する
+
+        Args:
+            key (str): キー
+
+        Returns:
+            str: 値 (存在しないか有効期限切れの場合は None)
+        """
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[0] < time.time():
+                if item is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: str, value: str, ttl: float):
+        """
+        キャッシュに値を保存する (サイズ上限を超える場合は古いものから削除する)
+
+        Args:
+            key (str): キー
+            value (str): 値
+            ttl (float): 有効期間(秒)
+        """
+        size = len(key) + len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                self._remove(key)
+            self.items[key] = (time.time() + ttl, value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.items))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        キャッシュのヒット数・ミス数・削除数などの統計情報を取得する
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "items": len(self.items), "bytes": self.size}
+
+    def _remove(self, key: str):
+        _, _, size = self.items.pop(key)
+        self.size -= size
+
+
+class SqliteCache:
+    """
+    複数のワーカープロセスで共有する、SQLite ファイルを用いたキャッシュ
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL, size INTEGER, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def get(self, key: str) -> str:
+        """
+        キャッシュから値を取得する
+
+        Args:
+            key (str): キー
+
+        Returns:
+            str: 値 (存在しないか有効期限切れの場合は None)
+        """
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key: str) -> tuple[str, float]:
+        """
+        キャッシュから値と、有効期限までの残り時間を取得する
+
+        Args:
+            key (str): キー
+
+        Returns:
+            tuple[str, float]: 値と有効期限までの残り時間(秒) (存在しないか有効期限切れの場合は (None, 0))
+        """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, expires FROM cache WHERE key = ? AND expires >= ?", (key, now)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        with self.lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return (row[0], row[1] - now) if row else (None, 0)
+
+    def set(self, key: str, value: str, ttl: float):
+        """
+        キャッシュに値を保存する (サイズ上限を超える場合は期限切れのものと古いものから削除する)
+
+        Args:
+            key (str): キー
+            value (str): 値
+            ttl (float): 有効期間(秒)
+        """
+        now = time.time()
+        size = len(key) + len(value.encode("utf-8"))
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)", (key, value, now + ttl, size, now))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+            if total > self.max_bytes:
+                conn.execute("DELETE FROM cache WHERE expires < ?", (now,))
+                evicted = 0
+                for old_key, old_size in conn.execute("SELECT key, size FROM cache ORDER BY accessed ASC").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute("DELETE FROM cache WHERE key = ?", (old_key,))
+                    total -= old_size
+                    evicted += 1
+                with self.lock:
+                    self.evictions += evicted
+
+    def stats(self) -> dict:
+        """
+        キャッシュのヒット数・ミス数・削除数などの統計情報を取得する
+        """
+        with self._connect() as conn:
+            items, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "items": items, "bytes": size}
+
+    def _connect(self) -> sqlite3.Connection:
+        # SQLite の接続はスレッド間で共有できないため、スレッドごとに接続する
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+
+class TieredCache:
+    """
+    プロセス内の LRU キャッシュと、任意で共有キャッシュ(SQLite)を組み合わせたキャッシュ
+    """
+
+    def __init__(self, memory: LRUCache, shared: SqliteCache = None):
+        self.memory = memory
+        self.shared = shared
+
+    def get(self, key: str) -> str:
+        value = self.memory.get(key)
+        if value is None and self.shared is not None:
+            value, remaining = self.shared.get_with_ttl(key)
+            if value is not None:
+                # 共有キャッシュにヒットした場合は、プロセス内キャッシュにも短時間だけ保存する (共有キャッシュの有効期限は超えない)
+                self.memory.set(key, value, ttl=min(60, remaining))
+        return value
+
+    def set(self, key: str, value: str, ttl: float):
+        self.memory.set(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def stats(self) -> dict:
+        stats = {"memory": self.memory.stats()}
+        if self.shared is not None:
+            stats["shared"] = self.shared.stats()
+        return stats
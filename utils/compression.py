@@ -0,0 +1,91 @@
+import gzip
+import zlib
+from typing import Iterator
+from utils.telemetry import record
+
+# brotli は任意の依存パッケージ (インストールされていない場合は gzip のみを使う)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 対応している圧縮形式 (優先する順)
+ENCODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def choose_encoding(accept_encoding: str, available: list[str] = None) -> str:
+    """
+    Accept-Encoding ヘッダーから、使用する圧縮形式を選ぶ
+
+    Args:
+        accept_encoding (str): Accept-Encoding ヘッダーの値
+        available (list[str]): 選択肢となる圧縮形式 (優先する順、指定しない場合は対応している全ての形式)
+
+    Returns:
+        str: 圧縮形式 (圧縮しない場合は None)
+    """
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in available if available is not None else ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str, level: int = None) -> bytes:
+    """
+    データを一度に圧縮する
+
+    Args:
+        data (bytes): 圧縮するデータ
+        encoding (str): 圧縮形式 ("br" または "gzip")
+        level (int): 圧縮レベル (brotli は 0〜11、gzip は 1〜9、指定しない場合はそれぞれ 5 と 6)
+
+    Returns:
+        bytes: 圧縮したデータ
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=5 if level is None else level)
+    return gzip.compress(data, compresslevel=6 if level is None else level, mtime=0)
+
+
+def compress_stream(chunks: Iterator[str], encoding: str) -> Iterator[bytes]:
+    """
+    ストリーミングで返却するデータを圧縮する
+
+    1フレームごとにフラッシュし、クライアントがフレームを受け取り次第展開できるようにする
+    (フレーム間で圧縮の辞書は引き継ぐため、似たフレームが続く場合はよく縮む)。
+
+    Args:
+        chunks (Iterator[str]): 返却するデータ
+        encoding (str): 圧縮形式 ("br" または "gzip")
+    """
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+    size = 0
+    try:
+        for chunk in chunks:
+            data = process(chunk.encode("utf-8")) + flush()
+            size += len(data)
+            yield data
+        data = finish()
+        size += len(data)
+        yield data
+    finally:
+        # クライアントが切断した場合も、元のストリームを閉じて返却できた大きさを記録する
+        if hasattr(chunks, "close"):
+            chunks.close()
+        record("payload_bytes", size, kind=f"response_{encoding}")
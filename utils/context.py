@@ -0,0 +1,114 @@
+import os
+import json
+import threading
+from functools import lru_cache
+from utils.logger import logger
+
+
+# メッセージ1件あたりに付加されるトークン数 (ロールや区切り文字の分)
+TOKENS_PER_MESSAGE = 3
+
+
+class ContextWindow:
+
+    def __init__(self, model: str = "gpt-4o"):
+
+        # 各種設定値を環境変数から取得
+        self.token_budget = int(os.getenv("AZURE_OPENAI_CONTEXT_TOKEN_BUDGET", 16000))
+        cache_size = int(os.getenv("AZURE_OPENAI_CONTEXT_TOKEN_CACHE_SIZE", 4096))
+
+        # トークナイザは語彙ファイルの取得に時間がかかるため、最初に使う時に初期化する
+        self.model = model
+        self._encoding = None
+        self._encoding_loaded = False
+        self._encoding_lock = threading.Lock()
+
+        # 同じ文字列のトークン数を何度も数えないようにキャッシュする
+        self._count_text = lru_cache(maxsize=cache_size)(self._count_text_uncached)
+
+    @property
+    def encoding(self):
+        # トークナイザを初期化 (tiktoken は読み込みに時間がかかるため、ここで読み込む)
+        # (tiktoken がインストールされていない場合や、語彙ファイルを取得できない場合は文字数から概算する)
+        if not self._encoding_loaded:
+            with self._encoding_lock:
+                if not self._encoding_loaded:
+                    try:
+                        import tiktoken
+
+                        try:
+                            self._encoding = tiktoken.encoding_for_model(self.model)
+                        except KeyError:
+                            self._encoding = tiktoken.get_encoding("o200k_base")
+                    except ImportError:
+                        pass
+                    except Exception as e:
+                        logger.warning(f"tiktoken encoding is not available, falling back to approximate token counts: {e}")
+                    self._encoding_loaded = True
+        return self._encoding
+
+    def count_tokens(self, message: dict) -> int:
+        """
+        メッセージ1件のトークン数を数える
+
+        Args:
+            message (dict): チャットメッセージ
+
+        Returns:
+            int: トークン数
+        """
+        tokens = TOKENS_PER_MESSAGE + self._count_text(message["role"])
+        if message.get("content"):
+            tokens += self._count_text(message["content"])
+        if message.get("tool_calls"):
+            tokens += self._count_text(json.dumps(message["tool_calls"], ensure_ascii=False))
+        if message.get("name"):
+            tokens += self._count_text(message["name"])
+        return tokens
+
+    def fit(self, messages: list[dict], reserved_tokens: int = 0) -> tuple[list[dict], list[dict]]:
+        """
+        会話履歴をトークン数の上限に収まるように新しいものから詰める
+
+        最新のメッセージ(ユーザの質問)は上限を超えていても必ず残す。
+
+        Args:
+            messages (list[dict]): 古い順に並んだチャットメッセージのリスト
+            reserved_tokens (int): システムメッセージや要約など、会話履歴以外で使用するトークン数
+
+        Returns:
+            tuple[list[dict], list[dict]]: 上限に収めたメッセージのリストと、切り捨てたメッセージのリスト
+        """
+        budget = self.token_budget - reserved_tokens
+        total = 0
+        start = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            tokens = self.count_tokens(messages[i])
+            if total + tokens > budget and i < len(messages) - 1:
+                break
+            total += tokens
+            start = i
+
+        # 切り捨てた分のトークン数を記録する
+        dropped = messages[:start]
+        if dropped:
+            saved = sum(self.count_tokens(m) for m in dropped)
+            logger.info(f"context window: kept={len(messages) - start} messages ({total} tokens), dropped={len(dropped)} messages, saved={saved} tokens")
+        return messages[start:], dropped
+
+    def count_text(self, text: str) -> int:
+        """
+        テキストのトークン数を数える (Web ページの段落など、繰り返し数えないテキスト用にキャッシュしない)
+
+        Args:
+            text (str): テキスト
+
+        Returns:
+            int: トークン数
+        """
+        return self._count_text_uncached(text)
+
+    def _count_text_uncached(self, text: str) -> int:
+        if self.encoding is None:
+            return len(text) // 2 + 1  # 日本語を考慮して 2 文字 ≒ 1 トークンで概算する
+        return len(self.encoding.encode(text))
@@ -1,8 +1,29 @@
 import os
+import copy
+import time
 import uuid
-from azure.cosmos import PartitionKey
-from azure.cosmos.cosmos_client import CosmosClient
-from azure.cosmos.exceptions import CosmosResourceNotFoundError
+import threading
+from collections import OrderedDict
+from utils.telemetry import cosmos_operation
+
+# コンテナのパーティションキー (ユーザごとのチャット一覧を単一パーティションで取得できるようにする)
+PARTITION_KEY_PATH = "/userId"
+
+# azure.cosmos は読み込みに時間がかかるため、最初に接続する時に読み込む (ベンチマークでは代替実装に置き換える)
+CosmosClient = None
+
+
+def _errors():
+    # azure.cosmos の例外のモジュール (except 節は例外が発生した時に評価されるため、その時点で読み込み済み)
+    from azure.cosmos import exceptions
+
+    return exceptions
+
+
+def _match_conditions():
+    from azure.core import MatchConditions
+
+    return MatchConditions
 
 
 class CosmosContainer:
@@ -10,70 +31,430 @@ class CosmosContainer:
     def __init__(self):
 
         # 各種設定値を環境変数から取得
-        db_name = os.getenv("AZURE_COSMOS_DB_NAME")
-        container_name = os.getenv("AZURE_COSMOS_CONTAINER_NAME")
-        connection_string = os.getenv("AZURE_COSMOS_CONNECTION_STRING")
+        self.db_name = os.getenv("AZURE_COSMOS_DB_NAME")
+        self.container_name = os.getenv("AZURE_COSMOS_CONTAINER_NAME")
+        self.connection_string = os.getenv("AZURE_COSMOS_CONNECTION_STRING")
+
+        # Azure Cosmos DB への接続は最初に使う時に行う
+        # (データベースとコンテナの作成は起動時には行わず、python -m scripts.provision_cosmos で事前に行う)
+        self._container = None
+        self._container_lock = threading.Lock()
 
-        # Azure Cosmos DB アカウントを参照する
-        client = CosmosClient.from_connection_string(connection_string)
+        # 会話情報のメッセージを分割保存する際の1セグメントあたりの最大メッセージ数
+        self.segment_size = int(os.getenv("AZURE_COSMOS_TALK_SEGMENT_SIZE", 50))
 
-        # データベースを参照する (存在しない場合は作成する)
-        client.create_database_if_not_exists(id=db_name)
-        database = client.get_database_client(db_name)
+        # ETag の不一致(同時更新)が発生した場合に、読み直して再試行する回数
+        self.max_retries = int(os.getenv("AZURE_COSMOS_MAX_CONFLICT_RETRIES", 3))
 
-        # コンテナを参照する (存在しない場合は作成する)
-        database.create_container_if_not_exists(id=container_name, partition_key=PartitionKey(path="/id"))
-        self.container = database.get_container_client(container_name)
+    @property
+    def container(self):
+        global CosmosClient
+        if self._container is None:
+            with self._container_lock:
+                if self._container is None:
+                    if CosmosClient is None:
+                        from azure.cosmos.cosmos_client import CosmosClient
+                    client = CosmosClient.from_connection_string(self.connection_string)
+                    self._container = client.get_database_client(self.db_name).get_container_client(self.container_name)
+        return self._container
 
-    def query_items(self, query: str, parameters: list[dict] = None) -> list[dict]:
+    def query_items(self, query: str, parameters: list[dict] = None, partition_key: str = None) -> list[dict]:
         """
         Azure Cosmos DB にクエリを実行する
 
         Args:
             query (str): クエリ文字列
             parameters (list[dict]): クエリパラメータ
+            partition_key (str): パーティションキー (None の場合はパーティションをまたいで検索する)
 
         Returns:
             list[dict]: クエリ結果
         """
-        items = self.container.query_items(query, parameters=parameters, enable_cross_partition_query=True)
-        return [i for i in items]
+        with cosmos_operation("query") as hook:
+            items = [i for i in self.container.query_items(query, parameters=parameters, **self._partition_options(partition_key))]
+            hook(self._last_response_headers())
+            return items
 
-    def get_item(self, id: str) -> dict:
+    def query_items_page(
+        self, query: str, parameters: list[dict] = None, partition_key: str = None, max_item_count: int = 20, continuation_token: str = None
+    ) -> tuple[list[dict], str]:
+        """
+        Azure Cosmos DB にクエリを実行し、結果を1ページ分だけ取得する
+
+        Args:
+            query (str): クエリ文字列
+            parameters (list[dict]): クエリパラメータ
+            partition_key (str): パーティションキー (None の場合はパーティションをまたいで検索する)
+            max_item_count (int): 1ページあたりの最大件数
+            continuation_token (str): 前ページの取得時に返された継続トークン (先頭ページの場合は None)
+
+        Returns:
+            tuple[list[dict], str]: クエリ結果と次ページの継続トークン (次ページがない場合は None)
+        """
+        with cosmos_operation("query") as hook:
+            items = self.container.query_items(query, parameters=parameters, max_item_count=max_item_count, **self._partition_options(partition_key))
+            pager = items.by_page(continuation_token)
+            page = [i for i in next(pager, [])]
+            hook(self._last_response_headers())
+            return page, pager.continuation_token
+
+    def get_item(self, id: str, partition_key: str, revalidate: bool = False) -> dict:
         """
         Azure Cosmos DB から指定されたIDのアイテムを取得する
 
         Args:
             id (str): アイテムID
+            partition_key (str): パーティションキー (ユーザID)
+            revalidate (bool): キャッシュしている場合も、最新かどうかを必ず確認するかどうか (キャッシュしない場合は常に最新を読み込む)
         """
         try:
-            return self.container.read_item(item=id, partition_key=id)
-        except CosmosResourceNotFoundError:
+            with cosmos_operation("read") as hook:
+                return self.container.read_item(item=id, partition_key=partition_key, response_hook=hook)
+        except _errors().CosmosResourceNotFoundError:
             return None
 
-    def upsert_item(self, item: dict):
+    def create_item(self, item: dict) -> dict:
+        """
+        Azure Cosmos DB にアイテムを追加する
+
+        Args:
+            item (dict): 追加するアイテム
+
+        Returns:
+            dict: 追加したアイテム
+        """
+        if "id" not in item:  # IDを生成して設定
+            item["id"] = str(uuid.uuid4())
+        with cosmos_operation("create") as hook:
+            return self.container.create_item(item, response_hook=hook)
+
+    def upsert_item(self, item: dict, etag: str = None):
         """
         Azure Cosmos DB にアイテムを追加または更新する
 
         Args:
             item (dict): 追加または更新するアイテム
+            etag (str): 指定した場合は、アイテムの ETag が一致する場合のみ更新する
+
+        Raises:
+            CosmosAccessConditionFailedError: ETag が一致しない場合
         """
         try:
             if "id" not in item:  # 新規作成の場合はIDを生成して設定
                 item["id"] = str(uuid.uuid4())
-            item = self.container.upsert_item(item)
+            with cosmos_operation("upsert") as hook:
+                item = self.container.upsert_item(item, response_hook=hook, **self._etag_options(etag))
             return item
-        except CosmosResourceNotFoundError:
+        except _errors().CosmosResourceNotFoundError:
             return None
 
-    def delete_item(self, id: str):
+    def patch_item(self, id: str, partition_key: str, operations: list[dict], etag: str = None) -> dict:
+        """
+        Azure Cosmos DB の指定されたIDのアイテムを部分更新する
+
+        Args:
+            id (str): アイテムID
+            partition_key (str): パーティションキー (ユーザID)
+            operations (list[dict]): パッチ操作のリスト (例: {"op": "set", "path": "/title", "value": "..."})
+            etag (str): 指定した場合は、アイテムの ETag が一致する場合のみ更新する
+
+        Returns:
+            dict: 更新後のアイテム (存在しない場合は None)
+
+        Raises:
+            CosmosAccessConditionFailedError: ETag が一致しない場合
+        """
+        try:
+            with cosmos_operation("patch") as hook:
+                return self.container.patch_item(
+                    item=id, partition_key=partition_key, patch_operations=operations, response_hook=hook, **self._etag_options(etag)
+                )
+        except _errors().CosmosResourceNotFoundError:
+            return None
+
+    def delete_item(self, id: str, partition_key: str):
         """
         Azure Cosmos DB から指定されたIDのアイテムを削除する
 
         Args:
             id (str): アイテムID
+            partition_key (str): パーティションキー (ユーザID)
         """
         try:
-            self.container.delete_item(item=id, partition_key=id)
-        except CosmosResourceNotFoundError:
+            with cosmos_operation("delete") as hook:
+                self.container.delete_item(item=id, partition_key=partition_key, response_hook=hook)
+        except _errors().CosmosResourceNotFoundError:
             pass
+
+    def append_talk_messages(self, talk: dict, messages: list[dict], operations: list[dict] = None) -> dict:
+        """
+        会話情報にメッセージを追記する
+
+        会話情報のアイテムには直近のメッセージ(末尾セグメント)のみを保持し、
+        パッチ操作で新しいメッセージだけを書き込む。末尾セグメントが上限に達した場合は、
+        それまでのメッセージをセグメント用のアイテムに切り出してから追記する。
+        読み込んだ時点から会話情報が更新されていた場合は、読み直して再試行する。
+
+        セグメントは上書きせずに新規作成し、同じ番号のセグメントが既にある場合は、
+        会話情報がまだそのセグメントを参照していない (切り出しの途中で失敗した) 場合に限り、ETag を指定して置き換える。
+        (古い会話情報を読み込んだ書き込みが、他の書き込みで切り出し済みのセグメントを上書きしないようにする)
+
+        Args:
+            talk (dict): 会話情報 (get_item で取得したもの)
+            messages (list[dict]): 追記するメッセージのリスト
+            operations (list[dict]): 追記と同時に行うパッチ操作のリスト
+
+        Returns:
+            dict: 更新後の会話情報 (存在しない場合は None)
+        """
+        extra_operations = operations or []
+        for _ in range(self.max_retries + 1):
+            tail = talk["messages"]
+            if len(tail) + len(messages) <= self.segment_size:
+                operations = [{"op": "add", "path": "/messages/-", "value": m} for m in messages]
+            else:
+                # 末尾セグメントをセグメント用のアイテムとして切り出す
+                segment_index = talk.get("segmentCount", 0)
+                segment = {
+                    "id": self._segment_id(talk["id"], segment_index),
+                    "talkId": talk["id"],
+                    "userId": talk["userId"],
+                    "segmentIndex": segment_index,
+                    "messages": tail,
+                }
+                try:
+                    self.create_item(segment)
+                except _errors().CosmosResourceExistsError:
+                    # 既にある場合は、セグメント、会話情報の順に読み直し、会話情報が変わっていなければ置き換える
+                    existing = self.get_item(segment["id"], talk["userId"], revalidate=True)
+                    latest = self.get_item(talk["id"], talk["userId"], revalidate=True)
+                    if latest is None:
+                        return None
+                    if existing is None or latest["_etag"] != talk["_etag"]:
+                        talk = latest
+                        continue
+                    try:
+                        self.upsert_item(segment, etag=existing["_etag"])
+                    except _errors().CosmosAccessConditionFailedError:
+                        continue
+                operations = [
+                    {"op": "set", "path": "/messages", "value": messages},
+                    {"op": "set", "path": "/segmentCount", "value": segment_index + 1},
+                ]
+            operations.append({"op": "set", "path": "/messageCount", "value": self.message_count(talk) + len(messages)})
+            operations += extra_operations
+            try:
+                return self.patch_item(talk["id"], talk["userId"], operations, etag=talk["_etag"])
+            except _errors().CosmosAccessConditionFailedError:
+                talk = self.get_item(talk["id"], talk["userId"])
+                if talk is None:
+                    return None
+        raise RuntimeError(f"Failed to append messages to talk {talk['id']}: too many concurrent updates")
+
+    def get_talk_messages(self, talk: dict, window: int = None) -> list[dict]:
+        """
+        会話情報のメッセージを取得する
+
+        末尾セグメントで足りない分だけ、過去のセグメントを新しいものから順に読み込む。
+
+        Args:
+            talk (dict): 会話情報 (get_item で取得したもの)
+            window (int): 取得する直近のメッセージ数 (None の場合は全て)
+
+        Returns:
+            list[dict]: 古い順に並んだメッセージのリスト
+        """
+        messages = list(talk["messages"])
+        segment_index = talk.get("segmentCount", 0) - 1
+        while segment_index >= 0 and (window is None or len(messages) < window):
+            segment = self.get_item(self._segment_id(talk["id"], segment_index), talk["userId"])
+            messages = (segment["messages"] if segment else []) + messages
+            segment_index -= 1
+        return messages if window is None else messages[-window:]
+
+    def get_talk_first_messages(self, talk: dict, count: int) -> list[dict]:
+        """
+        会話情報の冒頭のメッセージを取得する
+
+        Args:
+            talk (dict): 会話情報 (get_item で取得したもの)
+            count (int): 取得するメッセージ数
+
+        Returns:
+            list[dict]: 古い順に並んだメッセージのリスト
+        """
+        if talk.get("segmentCount", 0) == 0:
+            return talk["messages"][:count]
+        segment = self.get_item(self._segment_id(talk["id"], 0), talk["userId"])
+        messages = segment["messages"] if segment else []
+        return messages[:count] if len(messages) >= count else self.get_talk_messages(talk)[:count]
+
+    def delete_talk(self, talk: dict):
+        """
+        会話情報を、分割保存したセグメントと回答の途中経過も含めて削除する
+
+        Args:
+            talk (dict): 会話情報 (get_item で取得したもの)
+        """
+        for segment_index in range(talk.get("segmentCount", 0)):
+            self.delete_item(self._segment_id(talk["id"], segment_index), talk["userId"])
+        self.delete_item(self.stream_checkpoint_id(talk["id"]), talk["userId"])
+        self.delete_item(talk["id"], talk["userId"])
+
+    def message_count(self, talk: dict) -> int:
+        """
+        会話情報に保存されているメッセージの総数を取得する
+
+        Args:
+            talk (dict): 会話情報 (get_item で取得したもの)
+
+        Returns:
+            int: メッセージの総数
+        """
+        return talk.get("messageCount", len(talk["messages"]) + talk.get("segmentCount", 0) * self.segment_size)
+
+    @staticmethod
+    def stream_checkpoint_id(talk_id: str) -> str:
+        # 生成中の回答の途中経過を保存するアイテムのID (会話情報ごとに1つで、回答を生成するたびに上書きする)
+        return f"{talk_id}.stream"
+
+    @staticmethod
+    def _segment_id(talk_id: str, segment_index: int) -> str:
+        return f"{talk_id}.segment.{segment_index}"
+
+    def _last_response_headers(self) -> dict:
+        # クエリの response_hook はページの取得前に呼ばれるため、消費した RU は取得後の応答ヘッダから読み取る
+        # (gevent ワーカーでは取得から読み取りまでの間に他のリクエストへ切り替わらない)
+        connection = getattr(self.container, "client_connection", None)
+        return dict(getattr(connection, "last_response_headers", None) or {})
+
+    @staticmethod
+    def _partition_options(partition_key: str) -> dict:
+        return {"partition_key": partition_key} if partition_key is not None else {"enable_cross_partition_query": True}
+
+    @staticmethod
+    def _etag_options(etag: str) -> dict:
+        return {"etag": etag, "match_condition": _match_conditions().IfNotModified} if etag else {}
+
+
+class CachedCosmosContainer(CosmosContainer):
+    """
+    プロセス内にアイテムをキャッシュする CosmosContainer
+
+    自身の書き込みでキャッシュを更新し、削除時には破棄する。キャッシュしてから AZURE_COSMOS_CACHE_FRESH_SECONDS 秒 (既定は 5) 以内の
+    アイテムは Cosmos DB に問い合わせずに返し、それより古いアイテムは ETag による条件付き読み込み(If-None-Match)で変更の有無だけを確認する。
+    複数のワーカーやインスタンスで実行する場合、他のプロセスの書き込みはこの秒数だけ遅れて反映されるため、
+    最新の会話履歴が必要な読み込み (回答の生成や削除) は revalidate=True として、この秒数に関わらず必ず確認する。
+    生成中の回答の途中経過と、分割保存したセグメントはキャッシュしない
+    (途中経過は他のプロセスが頻繁に更新し、セグメントは切り出す時に一度しか読まないため、キャッシュすると会話情報を追い出してしまう)。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.cache_size = int(os.getenv("AZURE_COSMOS_CACHE_SIZE", 1000))
+        self.fresh_seconds = float(os.getenv("AZURE_COSMOS_CACHE_FRESH_SECONDS", 5))
+        self.items = OrderedDict()  # (パーティションキー, ID) -> (キャッシュした時刻, アイテム)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    def get_item(self, id: str, partition_key: str, revalidate: bool = False) -> dict:
+        if not self._cacheable(id):
+            return super().get_item(id, partition_key)
+        key = (partition_key, id)
+        with self.lock:
+            cached = self.items.get(key)
+            if cached is not None:
+                self.items.move_to_end(key)
+
+        # キャッシュしてから間もないアイテムはそのまま返す
+        if cached is not None and not revalidate and time.monotonic() - cached[0] < self.fresh_seconds:
+            with self.lock:
+                self.hits += 1
+            return copy.deepcopy(cached[1])
+
+        # キャッシュが古い場合は、変更されている場合のみアイテムを読み込む
+        try:
+            with cosmos_operation("read") as hook:
+                if cached is not None:
+                    item = self.container.read_item(
+                        item=id, partition_key=partition_key, etag=cached[1]["_etag"], match_condition=_match_conditions().IfModified, response_hook=hook
+                    )
+                else:
+                    item = self.container.read_item(item=id, partition_key=partition_key, response_hook=hook)
+        except _errors().CosmosResourceNotFoundError:
+            self._invalidate(key)
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            if cached is not None and not item:  # 304 Not Modified
+                self.revalidations += 1
+                item = cached[1]
+            else:
+                self.misses += 1
+        self._store(item)
+        return copy.deepcopy(item)
+
+    def create_item(self, item: dict) -> dict:
+        item = super().create_item(item)
+        self._store(item)
+        return item
+
+    def upsert_item(self, item: dict, etag: str = None):
+        item = super().upsert_item(item, etag=etag)
+        if item is not None:
+            self._store(item)
+        return item
+
+    def patch_item(self, id: str, partition_key: str, operations: list[dict], etag: str = None) -> dict:
+        try:
+            item = super().patch_item(id, partition_key, operations, etag=etag)
+        except _errors().CosmosAccessConditionFailedError:
+            self._invalidate((partition_key, id))
+            raise
+        if item is None:
+            self._invalidate((partition_key, id))
+        else:
+            self._store(item)
+        return item
+
+    def delete_item(self, id: str, partition_key: str):
+        super().delete_item(id, partition_key)
+        self._invalidate((partition_key, id))
+
+    def stats(self) -> dict:
+        """
+        キャッシュのヒット率などの統計情報を取得する
+        """
+        with self.lock:
+            total = self.hits + self.revalidations + self.misses
+            return {
+                "hits": self.hits,
+                "revalidations": self.revalidations,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.revalidations) / total if total else 0.0,
+                "round_trip_saved_rate": self.hits / total if total else 0.0,
+                "items": len(self.items),
+            }
+
+    def _store(self, item: dict):
+        if not self._cacheable(item["id"]):
+            return
+        key = (item[PARTITION_KEY_PATH[1:]], item["id"])
+        with self.lock:
+            self.items[key] = (time.monotonic(), copy.deepcopy(item))
+            self.items.move_to_end(key)
+            while len(self.items) > self.cache_size:
+                self.items.popitem(last=False)
+
+    def _invalidate(self, key: tuple[str, str]):
+        with self.lock:
+            self.items.pop(key, None)
+
+    @staticmethod
+    def _cacheable(id: str) -> bool:
+        # 生成中の回答の途中経過と、分割保存したセグメントはキャッシュしない
+        return not id.endswith(".stream") and ".segment." not in id
@@ -0,0 +1,32 @@
+import time
+import contextvars
+from contextlib import contextmanager
+
+# 一連の HTTP リクエスト (ツール呼び出しなど) を終わらせる期限 (time.monotonic() の値)
+# (requests を読み込まずに使えるように utils.http から分けている)
+_deadline = contextvars.ContextVar("http_deadline", default=None)
+
+
+@contextmanager
+def request_deadline(deadline: float):
+    """
+    ブロック内の HTTP リクエストを、再試行も含めて期限までに終わらせる
+
+    get_timeout で取得するタイムアウトを期限までの残り時間以下にし、期限を過ぎる再試行は行わない。
+
+    Args:
+        deadline (float): 期限 (time.monotonic() の値)
+    """
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time() -> float:
+    """
+    request_deadline で指定した期限までの残り時間(秒)を取得する (期限が指定されていない場合は None)
+    """
+    deadline = _deadline.get()
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import Future
+from utils.logger import logger
+from utils.cache import LRUCache
+from utils.deadline import remaining_time
+
+
+class QueryEmbedder:
+    """
+    Azure OpenAI Service で検索クエリのベクトルを計算する
+
+    ベクトルは正規化したクエリ文字列をキーにキャッシュする。同時に届いたクエリは
+    AZURE_OPENAI_EMBEDDING_BATCH_WAIT 秒だけ待ってまとめ、1回のリクエストでベクトル化する。
+    リクエストと結果を待つ時間は AZURE_OPENAI_EMBEDDING_TIMEOUT 秒と、ツール呼び出しの期限までの残り時間のうち短い方にする。
+    """
+
+    def __init__(self):
+
+        # 各種設定値を環境変数から取得
+        self.model = os.environ.get("AZURE_OPENAI_EMBEDDING_MODEL")
+        self.dimensions = int(os.environ.get("AZURE_OPENAI_EMBEDDING_DIMENSIONS", 0)) or None
+        self.batch_wait = float(os.environ.get("AZURE_OPENAI_EMBEDDING_BATCH_WAIT", 0.01))
+        self.batch_size = int(os.environ.get("AZURE_OPENAI_EMBEDDING_BATCH_SIZE", 16))
+        self.timeout = float(os.environ.get("AZURE_OPENAI_EMBEDDING_TIMEOUT", 10))
+        self.ttl = float(os.environ.get("AZURE_OPENAI_EMBEDDING_CACHE_TTL", 86400))
+        self.cache = LRUCache(max_bytes=int(os.environ.get("AZURE_OPENAI_EMBEDDING_CACHE_MAX_BYTES", 32 * 1024 * 1024)))
+
+        # まとめてベクトル化するのを待っているクエリ (正規化したクエリ -> (クエリ, Future))
+        self.pending = {}
+        self.scheduled = False
+        self.lock = threading.Lock()
+
+        # Azure OpenAI Service のクライアントは最初に使う時に作成する
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self.lock:
+                if self._client is None:
+                    from openai import AzureOpenAI
+
+                    self._client = AzureOpenAI(
+                        azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT"),
+                        api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
+                        api_version=os.environ.get("AZURE_OPENAI_API_VERSION", "2024-08-06"),
+                        timeout=self.timeout,
+                    )
+        return self._client
+
+    def embed(self, query: str) -> list[float]:
+        """
+        検索クエリのベクトルを取得する
+
+        Args:
+            query (str): 検索クエリ
+
+        Returns:
+            list[float]: クエリのベクトル
+        """
+        key = self.normalize(query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return json.loads(cached)
+
+        # 同じクエリを待っている場合はその結果を待ち、そうでなければ待ち行列に追加する
+        with self.lock:
+            if key in self.pending:
+                future = self.pending[key][1]
+                leader = False
+            else:
+                future = Future()
+                self.pending[key] = (query, future)
+                leader = not self.scheduled
+                self.scheduled = True
+
+        # 最初に待ち行列に追加したスレッドが、少し待ってからまとめてベクトル化する
+        if leader:
+            time.sleep(self.batch_wait)
+            with self.lock:
+                batch, self.pending, self.scheduled = self.pending, {}, False
+            items = list(batch.items())
+            for start in range(0, len(items), self.batch_size):
+                self._embed_batch(items[start : start + self.batch_size])
+        return future.result(timeout=self._timeout())
+
+    def stats(self) -> dict:
+        """
+        ベクトルのキャッシュの統計情報(ヒット数・ミス数・削除数など)を取得する
+        """
+        return self.cache.stats()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        # 前後の空白・連続する空白・大文字小文字の違いを無視する
+        return " ".join(query.split()).lower()
+
+    def _timeout(self) -> float:
+        # ツール呼び出しの期限が指定されている場合は、期限までの残り時間以下にする
+        remaining = remaining_time()
+        return self.timeout if remaining is None else min(self.timeout, remaining)
+
+    def _embed_batch(self, items: list[tuple[str, tuple[str, Future]]]):
+        try:
+            # 期限が指定されている場合は、再試行せずに期限までに終わらせる (待っている他のスレッドも期限を過ぎて待たせない)
+            timeout = self._timeout()
+            if timeout <= 0:
+                raise TimeoutError("embedding request deadline exceeded")
+            client = self.client if remaining_time() is None else self.client.with_options(max_retries=0)
+            options = {"dimensions": self.dimensions} if self.dimensions else {}
+            resp = client.embeddings.create(model=self.model, input=[query for _, (query, _) in items], timeout=timeout, **options)
+            for (key, (_, future)), data in zip(items, sorted(resp.data, key=lambda d: d.index)):
+                self.cache.set(key, json.dumps(data.embedding), self.ttl)
+                future.set_result(data.embedding)
+        except Exception as e:
+            logger.warning(f"failed to embed {len(items)} queries: {e}")
+            for _, (_, future) in items:
+                if not future.done():
+                    future.set_exception(e)
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import random
+import threading
+from utils.logger import logger
+from utils.telemetry import record
+from utils.scheduler import RateLimitScheduler, get_scheduler
+
+# 応答時間の指数移動平均の重み
+LATENCY_SMOOTHING = 0.3
+
+
+class Endpoint:
+    """
+    Azure OpenAI Service のエンドポイントとデプロイの組
+
+    クライアント・TPM/RPM のスケジューラ・応答時間と失敗回数(サーキットブレーカー)をエンドポイントごとに持つ。
+
+    Args:
+        name (str): ログや指標に使う名前
+        endpoint (str): Azure OpenAI Service のエンドポイント
+        api_key (str): API キー
+        deployment (str): デプロイ名
+        weight (float): 重み付けでルーティングする場合の重み
+        scheduler (RateLimitScheduler): このデプロイのクォータに合わせたスケジューラ
+    """
+
+    def __init__(self, name: str, endpoint: str, api_key: str, deployment: str, weight: float, scheduler: RateLimitScheduler):
+        self.name = name
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.deployment = deployment
+        self.weight = weight
+        self.scheduler = scheduler
+
+        # 応答時間 (ストリームの場合は最初のチャンクまで) の移動平均と、連続して失敗した回数
+        self.latency = None
+        self.failures = 0
+        self.open_until = 0.0  # サーキットが開いている (リクエストを送らない) 期限
+
+        # Azure OpenAI Service のクライアントは最初に使う時に作成する
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from openai import AzureOpenAI
+
+                    # 再試行やフェイルオーバーは EndpointPool を使う側で行うため、SDK では再試行しない
+                    self._client = AzureOpenAI(
+                        azure_endpoint=self.endpoint,
+                        api_key=self.api_key,
+                        api_version=os.environ.get("AZURE_OPENAI_API_VERSION", "2024-08-06"),
+                        timeout=float(os.environ.get("AZURE_OPENAI_TIMEOUT", 60)),
+                        max_retries=0,
+                    )
+        return self._client
+
+    @property
+    def available(self) -> bool:
+        # サーキットが閉じているか、期限が過ぎて試しにリクエストを送れる (半開き) 状態か
+        return time.monotonic() >= self.open_until
+
+
+class EndpointPool:
+    """
+    複数の Azure OpenAI Service のエンドポイントにリクエストを振り分ける
+
+    AZURE_OPENAI_ENDPOINTS に JSON 形式でエンドポイントのリストを指定する。指定しない場合は
+    AZURE_OPENAI_ENDPOINT・AZURE_OPENAI_API_KEY・AZURE_OPENAI_MODEL の1つだけを使う。
+    AZURE_OPENAI_ROUTING が "latency" の場合はスケジューラの待ち時間の見込みと応答時間の移動平均の合計が最も短いエンドポイントを、
+    "weighted" の場合はすぐに実行できるエンドポイントから重みに応じてランダムにエンドポイントを選ぶ。
+    AZURE_OPENAI_CIRCUIT_FAILURES 回続けて失敗したエンドポイントには、AZURE_OPENAI_CIRCUIT_COOLDOWN 秒の間リクエストを送らない。
+    """
+
+    def __init__(self):
+
+        # 各種設定値を環境変数から取得
+        self.routing = os.environ.get("AZURE_OPENAI_ROUTING", "latency")
+        self.circuit_failures = int(os.environ.get("AZURE_OPENAI_CIRCUIT_FAILURES", 3))
+        self.circuit_cooldown = float(os.environ.get("AZURE_OPENAI_CIRCUIT_COOLDOWN", 30))
+        self.lock = threading.Lock()
+
+        configs = json.loads(os.environ.get("AZURE_OPENAI_ENDPOINTS") or "[]")
+        if configs:
+            self.endpoints = [
+                Endpoint(
+                    name=config.get("name") or f"endpoint{i}",
+                    endpoint=config["endpoint"],
+                    api_key=config.get("api_key"),
+                    deployment=config.get("deployment") or os.environ.get("AZURE_OPENAI_MODEL", "gpt-4o"),
+                    weight=float(config.get("weight", 1)),
+                    scheduler=RateLimitScheduler(tpm=config.get("tpm_limit"), rpm=config.get("rpm_limit")),
+                )
+                for i, config in enumerate(configs)
+            ]
+        else:
+            self.endpoints = [
+                Endpoint(
+                    name="default",
+                    endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT"),
+                    api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
+                    deployment=os.environ.get("AZURE_OPENAI_MODEL", "gpt-4o"),
+                    weight=1.0,
+                    scheduler=get_scheduler(),
+                )
+            ]
+
+    def choose(self, exclude: set = None, tokens: int = 0) -> Endpoint:
+        """
+        リクエストを送るエンドポイントを選ぶ
+
+        サーキットが開いているエンドポイントと exclude に含まれるエンドポイントは避ける。
+        避けた結果、候補がなくなった場合はサーキットが最も早く閉じるエンドポイントを選ぶ。
+        クォータを使い切った・429 応答で待たされているエンドポイントは、スケジューラの待ち時間の見込みの分だけ後回しにする。
+
+        Args:
+            exclude (set): 避けるエンドポイントの名前 (同じリクエストで既に失敗したもの)
+            tokens (int): リクエストが消費する見込みのトークン数
+
+        Returns:
+            Endpoint: 選んだエンドポイント
+        """
+        exclude = exclude or set()
+        with self.lock:
+            candidates = [e for e in self.endpoints if e.available and e.name not in exclude]
+            if not candidates:
+                candidates = [e for e in self.endpoints if e.name not in exclude] or self.endpoints
+                return min(candidates, key=lambda e: e.open_until)
+            waits = {e.name: max(0.0, e.scheduler.expected_wait(tokens)) for e in candidates}
+            ready = [e for e in candidates if waits[e.name] <= 0]
+            if self.routing == "weighted" and ready:
+                return random.choices(ready, weights=[e.weight for e in ready])[0]
+
+            # 待ち時間の見込みと応答時間の合計が最も短いものを選ぶ (応答時間をまだ計測していないエンドポイントを優先して試す)
+            return min(candidates, key=lambda e: waits[e.name] + (e.latency if e.latency is not None else -1.0))
+
+    def report_success(self, endpoint: Endpoint, latency: float):
+        """
+        リクエストが成功したことを記録し、サーキットを閉じる
+
+        Args:
+            endpoint (Endpoint): リクエストを送ったエンドポイント
+            latency (float): 応答時間(秒)
+        """
+        with self.lock:
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += LATENCY_SMOOTHING * (latency - endpoint.latency)
+            endpoint.failures = 0
+            endpoint.open_until = 0.0
+
+    def report_failure(self, endpoint: Endpoint):
+        """
+        リクエストが失敗したことを記録し、続けて失敗した回数が上限に達したらサーキットを開く
+
+        Args:
+            endpoint (Endpoint): リクエストを送ったエンドポイント
+        """
+        with self.lock:
+            endpoint.failures += 1
+            opened = endpoint.failures >= self.circuit_failures and endpoint.available
+            if opened:
+                endpoint.open_until = time.monotonic() + self.circuit_cooldown
+        record("openai_endpoint_failures", 1, endpoint=endpoint.name)
+        if opened:
+            logger.warning(f"Azure OpenAI endpoint {endpoint.name} failed {endpoint.failures} times, skipping it for {self.circuit_cooldown:.0f}s")
+
+    def stats(self) -> dict:
+        """
+        エンドポイントごとの統計情報(応答時間・失敗回数・サーキットの状態・スケジューラの状態)を取得する
+        """
+        stats = {}
+        for endpoint in self.endpoints:
+            stats[endpoint.name] = {
+                "latency_seconds": endpoint.latency or 0.0,
+                "failures": endpoint.failures,
+                "circuit_open": 0 if endpoint.available else 1,
+                **(endpoint.scheduler.stats() if endpoint.scheduler.enabled else {}),
+            }
+        return stats
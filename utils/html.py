@@ -1,5 +1,113 @@
-import requests
-from bs4 import BeautifulSoup, Comment
+import os
+import re
+import json
+import codecs
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+from utils.http import get_session, get_timeout
+from utils.deadline import remaining_time
+from utils.cache import LRUCache
+
+# 取得するコンテンツの最大サイズ(バイト)
+HTML_MAX_BYTES = int(os.getenv("HTML_MAX_BYTES", 2 * 1024 * 1024))
+
+# 取得を許可するコンテンツの種類
+ALLOWED_CONTENT_TYPES = {"text/html", "application/xhtml+xml", "text/plain"}
+
+# 条件付きリクエストで再検証するためのキャッシュ (URL -> ETag / Last-Modified / コンテンツ)
+HTML_REVALIDATION_CACHE_TTL = float(os.getenv("HTML_REVALIDATION_CACHE_TTL", 24 * 60 * 60))
+_revalidation_cache = LRUCache(max_bytes=int(os.getenv("HTML_REVALIDATION_CACHE_MAX_BYTES", 64 * 1024 * 1024)))
+
+# meta タグで指定された文字コードを探すための正規表現 (<meta charset="..."> と http-equiv の両方に対応)
+META_CHARSET_PATTERN = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([a-zA-Z0-9_\-]+)""", re.IGNORECASE)
+
+# 子要素ごと削除する不要なタグ要素
+UNNECESSARY_TAGS = {
+    "head",
+    "meta",
+    "style",
+    "link",
+    "script",
+    "noscript",
+    "header",
+    "footer",
+    "nav",
+    "img",
+    "svg",
+    "form",
+    "select",
+    "input",
+    "textarea",
+    "button",
+    "i",
+    "iframe",
+    "figure",
+    "object",
+    "audio",
+    "video",
+    "progress",
+    "canvas",
+    "picture",
+}
+
+# 子要素ごと削除する不要なタグ要素 (タグ名, クラス名)
+UNNECESSARY_TAG_CLASSES = {
+    ("div", "header"),
+    ("div", "footer"),
+    ("div", "page-header"),
+    ("div", "page-footer"),
+    ("div", "nav"),
+}
+
+# メインコンテンツのある部分を探すためのタグ要素 (タグ名, 属性名, 属性値) を優先順に定義
+MAIN_CONTENT_CANDIDATES = [
+    ("main", None, None),
+    ("section", "id", "main"),
+    ("section", "id", "main-content"),
+    ("section", "class", "main"),
+    ("section", "class", "main-content"),
+    ("div", "id", "main"),
+    ("div", "id", "main-content"),
+    ("div", "class", "main"),
+    ("div", "class", "main-content"),
+    ("body", None, None),
+]
+
+# テキストを段落に分割する際の区切りとなるブロック要素
+BLOCK_TAGS = {
+    "p",
+    "li",
+    "dt",
+    "dd",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "tr",
+    "pre",
+    "blockquote",
+    "table",
+    "ul",
+    "ol",
+    "dl",
+    "section",
+    "article",
+    "main",
+    "body",
+}
+
+# 段落の最小・最大文字数 (短い段落は後続とまとめ、長い段落は文の区切りで分割する)
+PASSAGE_MIN_CHARS = int(os.getenv("HTML_PASSAGE_MIN_CHARS", 200))
+PASSAGE_MAX_CHARS = int(os.getenv("HTML_PASSAGE_MAX_CHARS", 800))
+
+# 長い段落を分割する文の区切り
+SENTENCE_END_PATTERN = re.compile(r"(?<=[。！？!?])|(?<=\. )")
+
+# 終了タグを持たない要素 (テキストを含まないため常に削除される)
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
 
 
 class HtmlTool:
@@ -9,129 +117,313 @@ class HtmlTool:
         """
         指定されたURLからコンテンツを取得
 
+        コンテンツはストリーミングで受信し、HTML_MAX_BYTES を超える部分は読み込まない。
+        文字コードはヘッダーまたは meta タグから判定して1回だけデコードする。
+        ETag / Last-Modified を記録しておき、同じURLを再取得する際は条件付きリクエストで検証する。
+
         Parameters:
         url (str): 取得するコンテンツのURL
 
         Returns:
         str: 取得したコンテンツの文字列形式
         """
-        resp = requests.get(url)
-        try:
-            return resp.content.decode("utf-8")
-        except:
-            try:
-                return resp.content.decode("shift_jis")
-            except:
-                return resp.text
+
+        # 前回取得時の ETag / Last-Modified があれば条件付きリクエストにする
+        cached = _revalidation_cache.get(url)
+        cached = json.loads(cached) if cached else None
+        headers = {}
+        if cached and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        # 本文のない 304 が返された場合 (前回のコンテンツがキャッシュから削除されていた場合など) は、条件を付けずに1回だけ取得し直す
+        for attempt in range(2):
+            with get_session().get(url, headers=headers, timeout=get_timeout(), stream=True) as resp:
+
+                # 更新されていない場合は前回取得したコンテンツを返す
+                if resp.status_code == 304:
+                    if cached:
+                        return cached["html"]
+                    if attempt == 0:
+                        headers = {"Cache-Control": "no-cache"}
+                        continue
+                    raise ValueError(f"Received 304 Not Modified without a cached copy: {url}")
+                resp.raise_for_status()
+
+                # HTML・テキスト以外のコンテンツは取得しない
+                content_type, params = _parse_content_type(resp.headers.get("Content-Type", ""))
+                if content_type and content_type not in ALLOWED_CONTENT_TYPES:
+                    raise ValueError(f"Unsupported content type: {content_type}")
+
+                # 上限サイズまでストリーミングで受信する
+                chunks = []
+                size = 0
+                for chunk in resp.iter_content(chunk_size=64 * 1024):
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= HTML_MAX_BYTES:
+                        break
+                    if remaining_time() == 0:
+                        raise TimeoutError(f"Timed out while downloading {url}")
+                content = b"".join(chunks)[:HTML_MAX_BYTES]
+
+                # 文字コードを判定して1回だけデコードする
+                html = content.decode(_detect_charset(content, params.get("charset")), errors="replace")
+
+                # 再検証用に ETag / Last-Modified とコンテンツを記録する
+                etag = resp.headers.get("ETag")
+                last_modified = resp.headers.get("Last-Modified")
+                if etag or last_modified:
+                    value = json.dumps({"etag": etag, "last_modified": last_modified, "html": html}, ensure_ascii=False)
+                    _revalidation_cache.set(url, value, HTML_REVALIDATION_CACHE_TTL)
+                return html
 
     @staticmethod
     def remove_unnecessary_html_tags(html: str, required_attrs: list[str] = ["href", "src", "alt", "title"]) -> str:
         """
         不要なHTMLタグを削除する
 
+        HTMLを先頭から1回だけ走査し、不要なタグ要素・中身のない要素・コメント・不要な属性を
+        削除しながら出力する。div タグは中身だけを残す。
+
         Parameters:
         html (str): HTML文字列
+        required_attrs (list[str]): 残す属性の名前
 
         Returns:
         str: 不要なHTMLタグを削除したHTML文字列
         """
+        cleaner = _HtmlCleaner(set(required_attrs))
+        cleaner.feed(html)
+        cleaner.close()
+        return cleaner.result()
+
+    @staticmethod
+    def extract_passages(html: str, base_url: str = None) -> list[str]:
+        """
+        HTMLをテキストの段落に分割する
+
+        ブロック要素ごとにテキストを区切り、短い段落は後続とまとめ、長い段落は文の区切りで分割する。
+        リンクはリンクテキストの後ろに絶対URLを括弧書きで残す。
 
-        # BeautifulSoup を使ってHTMLを解析する
-        soup = BeautifulSoup(html, "html.parser")
-
-        # 不要なタグ要素を定義する
-        unnecessary_tags = [
-            "head",
-            "meta",
-            "style",
-            "link",
-            "script",
-            "noscript",
-            "header",
-            "footer",
-            "nav",
-            "img",
-            "svg",
-            "form",
-            "select",
-            "input",
-            "textarea",
-            "button",
-            "i",
-            "iframe",
-            "figure",
-            "object",
-            "audio",
-            "video",
-            "progress",
-            "canvas",
-            "picture",
-        ]
-
-        # 不要なタグ要素を削除する
-        for tag in unnecessary_tags:
-            for tag_elm in soup.find_all(tag):
-                tag_elm.extract()
-
-        # 不要なタグ要素を抽出するクエリセレクタを定義
-        unnecessary_tag_selecters = [
-            "div.header",
-            "div.footer",
-            "div.page-header",
-            "div.page-footer",
-            "div.nav",
-        ]
-
-        # 不要なタグ要素をクエリセレクタで削除する
-        for selector in unnecessary_tag_selecters:
-            for tag_elm in soup.select(selector):
-                tag_elm.extract()
-
-        # メインコンテンツのある部分のみに限定する
-        find_methods = [
-            lambda elm: elm.find("main"),
-            lambda elm: elm.find("section#main"),
-            lambda elm: elm.find("section#main-content"),
-            lambda elm: elm.find("section.main"),
-            lambda elm: elm.find("section.main-content"),
-            lambda elm: elm.find("div#main"),
-            lambda elm: elm.find("div#main-content"),
-            lambda elm: elm.find("div.main"),
-            lambda elm: elm.find("div.main-content"),
-            lambda elm: elm.find("body"),
-        ]
-        for find_method in find_methods:
-            elm = find_method(soup)
-            if elm is not None:
+        Parameters:
+        html (str): HTML文字列 (remove_unnecessary_html_tags で不要なタグを削除したもの)
+        base_url (str): 相対URLを解決するための基準URL
+
+        Returns:
+        list[str]: 文書の順に並んだ段落のリスト
+        """
+        extractor = _PassageExtractor(base_url)
+        extractor.feed(html)
+        extractor.close()
+
+        # 短いブロックは後続のブロックとまとめ、長いブロックは文の区切りで分割する
+        passages = []
+        current = ""
+        for block in extractor.blocks:
+            for piece in _split_long_text(block, PASSAGE_MAX_CHARS):
+                if current and len(current) + len(piece) + 1 > PASSAGE_MAX_CHARS:
+                    passages.append(current)
+                    current = ""
+                current = f"{current}\n{piece}" if current else piece
+                if len(current) >= PASSAGE_MIN_CHARS:
+                    passages.append(current)
+                    current = ""
+        if current:
+            passages.append(current)
+        return passages
+
+
+def _split_long_text(text: str, max_chars: int) -> list[str]:
+    """
+    最大文字数を超えるテキストを文の区切りで分割する (区切りがない場合は最大文字数で分割する)
+    """
+    if len(text) <= max_chars:
+        return [text]
+    pieces = []
+    current = ""
+    for sentence in SENTENCE_END_PATTERN.split(text):
+        while len(sentence) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if len(current) + len(sentence) > max_chars:
+            pieces.append(current)
+            current = ""
+        current += sentence
+    if current:
+        pieces.append(current)
+    return [p.strip() for p in pieces if p.strip()]
+
+
+def _parse_content_type(value: str) -> tuple[str, dict]:
+    """
+    Content-Type ヘッダーをメディアタイプとパラメータに分解する
+    """
+    media_type, *params = value.split(";")
+    params = dict(p.strip().split("=", 1) for p in params if "=" in p)
+    return media_type.strip().lower(), {k.lower(): v.strip("\"' ") for k, v in params.items()}
+
+
+def _detect_charset(content: bytes, header_charset: str = None) -> str:
+    """
+    BOM・Content-Type ヘッダー・meta タグの順に文字コードを判定する
+    (宣言がない場合は UTF-8 としてデコードできれば UTF-8、できなければ cp932 とみなす)
+    """
+    if content.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    candidates = [header_charset]
+    match = META_CHARSET_PATTERN.search(content[:4096])
+    if match:
+        candidates.append(match.group(1).decode("ascii"))
+    for charset in candidates:
+        if not charset:
+            continue
+        try:
+            # Shift_JIS は機種依存文字を含む上位互換の cp932 としてデコードする
+            name = codecs.lookup(charset).name
+            return "cp932" if name == "shift_jis" else name
+        except LookupError:
+            continue
+
+    # 宣言のない日本語のページは Shift_JIS のことが多いため、UTF-8 として不正なバイト列があれば cp932 とする
+    # (上限サイズで切り詰めた場合に、末尾で途切れた文字は無視する)
+    try:
+        content.decode("utf-8")
+    except UnicodeDecodeError as e:
+        if e.start < len(content) - 3:
+            return "cp932"
+    return "utf-8"
+
+
+class _HtmlCleaner(HTMLParser):
+    """
+    HtmlTool.remove_unnecessary_html_tags の実装 (html.parser のイベントを1回走査で処理する)
+    """
+
+    def __init__(self, required_attrs: set[str]):
+        super().__init__(convert_charrefs=True)
+        self.required_attrs = required_attrs
+        self.out = []  # 出力する文字列の断片
+        self.stack = []  # 開いている要素: [タグ名, 出力開始位置, テキストを含むか, 削除対象か, メインコンテンツの候補の優先順位]
+        self.skip_depth = 0  # 開いている削除対象の要素の数
+        self.candidates = {}  # メインコンテンツの候補の優先順位 -> 出力範囲 (最初に見つかったもののみ)
+        self.open_candidates = set()
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str]]):
+        if tag in VOID_TAGS:
+            return
+        attrs_dict = dict(attrs)
+        classes = (attrs_dict.get("class") or "").split()
+        skip = self.skip_depth > 0 or tag in UNNECESSARY_TAGS or any((tag, c) in UNNECESSARY_TAG_CLASSES for c in classes)
+        candidate = None if skip else self._candidate_priority(tag, attrs_dict, classes)
+        if candidate is not None:
+            self.open_candidates.add(candidate)
+        self.stack.append([tag, len(self.out), False, skip, candidate])
+        if skip:
+            self.skip_depth += 1
+        elif tag != "div":
+            attrs_str = "".join(f' {k}="{escape(v or "")}"' for k, v in attrs if k in self.required_attrs)
+            self.out.append(f"<{tag}{attrs_str}>")
+
+    def handle_startendtag(self, tag: str, attrs: list[tuple[str, str]]):
+        # 自己終了タグは中身を持たないため常に削除する
+        pass
+
+    def handle_endtag(self, tag: str):
+        # 対応する開始タグがない終了タグは無視し、閉じ忘れの要素はまとめて閉じる
+        if not any(frame[0] == tag for frame in self.stack):
+            return
+        while self.stack:
+            if self._close() == tag:
                 break
-        if elm is not None:
-            soup = elm
 
-        # 中身のない要素を削除する
-        for tag in soup.find_all():
-            if tag.text.strip() == "":
-                tag.extract()
+    def handle_data(self, data: str):
+        if self.skip_depth > 0:
+            return
+        self.out.append(escape(data, quote=False))
+        if self.stack and data.strip():
+            self.stack[-1][2] = True
+
+    def close(self):
+        super().close()
+        while self.stack:
+            self._close()
+
+    def result(self) -> str:
+        # メインコンテンツの候補が見つかった場合は、優先順位の最も高いものに限定する
+        if self.candidates:
+            start, end = self.candidates[min(self.candidates)]
+            out = self.out[start:end]
+        else:
+            out = self.out
+        return "".join(out).replace("\n", "").strip()
+
+    def _close(self) -> str:
+        tag, start, has_text, skip, candidate = self.stack.pop()
+        if skip:
+            self.skip_depth -= 1
+        elif not has_text:
+            del self.out[start:]  # 中身のない要素は削除する
+        else:
+            if tag != "div":
+                self.out.append(f"</{tag}>")
+            if self.stack:
+                self.stack[-1][2] = True
+        if candidate is not None:
+            self.open_candidates.discard(candidate)
+            self.candidates[candidate] = (start, len(self.out))
+        return tag
+
+    def _candidate_priority(self, tag: str, attrs: dict, classes: list[str]) -> int:
+        for priority, (candidate_tag, attr, value) in enumerate(MAIN_CONTENT_CANDIDATES):
+            if priority in self.candidates or priority in self.open_candidates or tag != candidate_tag:
+                continue
+            if attr is None or (attr == "id" and attrs.get("id") == value) or (attr == "class" and value in classes):
+                return priority
+        return None
+
 
-        # タグの必要な属性以外の属性を全て削除する
-        for tag in soup.find_all():
-            tag.attrs = {key: tag.attrs[key] for key in tag.attrs.keys() if key in required_attrs}
+class _PassageExtractor(HTMLParser):
+    """
+    HtmlTool.extract_passages の実装 (ブロック要素ごとにテキストを区切り、リンクのURLを残す)
+    """
 
-        # コメントを削除する
-        comments = soup.find_all(string=lambda text: isinstance(text, Comment))
-        for comment in comments:
-            comment.extract()
+    def __init__(self, base_url: str = None):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.blocks = []  # 文書の順に並んだブロックのテキスト
+        self.text = []  # 現在のブロックのテキストの断片
+        self.links = []  # 開いている a 要素のリンク先
 
-        # 余分なdivを排除する
-        for div in soup.find_all("div"):
-            div.unwrap()
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str]]):
+        if tag in BLOCK_TAGS:
+            self._flush()
+        elif tag == "a":
+            self.links.append(dict(attrs).get("href"))
+        elif tag in ("td", "th"):
+            self.text.append(" ")
 
-        # HTMLを文字列に変換する
-        processed_html = str(soup)
+    def handle_endtag(self, tag: str):
+        if tag in BLOCK_TAGS:
+            self._flush()
+        elif tag == "a" and self.links:
+            href = self.links.pop()
+            if href and not href.startswith(("#", "javascript:", "mailto:")):
+                self.text.append(f" ({urljoin(self.base_url, href) if self.base_url else href})")
 
-        # 連続する改行を削除する
-        processed_html = processed_html.replace("\n", "")
+    def handle_data(self, data: str):
+        self.text.append(data)
 
-        # 連続する空白を削除する
-        processed_html = processed_html.strip()
+    def close(self):
+        super().close()
+        self._flush()
 
-        return processed_html
+    def _flush(self):
+        text = " ".join("".join(self.text).split())
+        if text:
+            self.blocks.append(text)
+        self.text = []
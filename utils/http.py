@@ -0,0 +1,77 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
+from utils.deadline import remaining_time
+
+# プロセス内で共有する HTTP セッション
+_session = None
+_session_lock = threading.Lock()
+
+
+class DeadlineRetry(Retry):
+    """
+    request_deadline で指定した期限を過ぎる場合は、待たずに再試行を打ち切る Retry
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None) -> Retry:
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        remaining = remaining_time()
+        if remaining is not None:
+            wait = max(retry.get_backoff_time(), (retry.get_retry_after(response) or 0) if response is not None else 0)
+            if wait >= remaining:
+                raise MaxRetryError(_pool, url, error or TimeoutError("HTTP request deadline exceeded"))
+        return retry
+
+
+def get_session() -> requests.Session:
+    """
+    プロセス内で共有する HTTP セッションを取得する (初回呼び出し時に作成する)
+
+    キープアライブによる接続プールと、一時的なエラーに対するバックオフ付きのリトライを設定する。
+
+    Returns:
+        requests.Session: HTTP セッション
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = DeadlineRetry(
+                    total=int(os.getenv("HTTP_MAX_RETRIES", 3)),
+                    backoff_factor=float(os.getenv("HTTP_RETRY_BACKOFF", 0.5)),
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=["GET", "HEAD"],
+                    respect_retry_after_header=True,
+                )
+                pool_size = int(os.getenv("HTTP_POOL_SIZE", 32))
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def get_timeout(respect_deadline: bool = True) -> tuple[float, float]:
+    """
+    HTTP リクエストのタイムアウト(接続, 読み取り)を秒単位で取得する
+
+    request_deadline で期限が指定されている場合は、期限までの残り時間以下にする。
+
+    Args:
+        respect_deadline (bool): 期限を考慮するかどうか (プロセス内で使い回すクライアントの初期化では False にする)
+
+    Raises:
+        TimeoutError: 期限を過ぎている場合
+    """
+    connect_timeout, read_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5)), float(os.getenv("HTTP_READ_TIMEOUT", 20))
+    remaining = remaining_time() if respect_deadline else None
+    if remaining is None:
+        return (connect_timeout, read_timeout)
+    if remaining <= 0:
+        raise TimeoutError("HTTP request deadline exceeded")
+    return (min(connect_timeout, remaining), min(read_timeout, remaining))
+
@@ -1,18 +1,52 @@
 import os
 import json
-from openai import AzureOpenAI
-from utils.openai_tools import OpenAITools
+import time
+import hashlib
+from utils.logger import logger
+from utils.cache import LRUCache
+from utils.telemetry import tracer, record
+from utils.openai_tools import OpenAITools, ToolCallAccumulator
+from utils.context import ContextWindow
+from utils.endpoints import EndpointPool
+from utils.scheduler import get_retry_after, PRIORITY_INTERACTIVE, PRIORITY_SUMMARY, PRIORITY_TITLE
+
+
+class PeekedStream:
+    """
+    最初のトークン(回答またはツール呼び出し)までのチャンクを先に受け取ったストリーム
+
+    最初のトークンを受け取るまでに発生したエラーは作成時に送出されるため、フェイルオーバーの判定に使える。
+
+    Args:
+        stream (Stream): chat.completions.create が返すストリーム
+        deployment (str): リクエストを処理したデプロイ名
+    """
+
+    def __init__(self, stream, deployment: str = None):
+        self.stream = stream
+        self.deployment = deployment
+        self.iterator = iter(stream)
+        self.buffered = []
+        for chunk in self.iterator:
+            self.buffered.append(chunk)
+            if chunk.choices and (chunk.choices[0].delta.content or chunk.choices[0].delta.tool_calls or chunk.choices[0].finish_reason):
+                break
+
+    def __iter__(self):
+        yield from self.buffered
+        yield from self.iterator
+
+    def close(self):
+        self.stream.close()
 
 
 class OpenAIClient:
 
     def __init__(self):
-        self.client = AzureOpenAI(
-            azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
-            api_version=os.environ.get("AZURE_OPENAI_API_VERSION", "2024-08-06"),
-#            api_version=os.environ.get("AZURE_OPENAI_API_VERSION", "2024-05-01-preview"),
-        )
+        # リクエストを振り分ける Azure OpenAI Service のエンドポイント
+        # (クライアントは最初に使う時に作成する。openai パッケージの読み込みに時間がかかるため)
+        self.pool = EndpointPool()
+
         # 各種設定値を環境変数から取得
         self.model = os.environ.get("AZURE_OPENAI_MODEL", "gpt-4o")
         self.system_message = os.environ.get(
@@ -21,10 +55,32 @@ class OpenAIClient:
         )
         self.temperature = os.environ.get("AZURE_OPENAI_TEMPERATURE", 0)
         self.max_tokens = os.environ.get("AZURE_OPENAI_MAX_TOKENS", 4096)
+        self.max_retries = int(os.environ.get("AZURE_OPENAI_MAX_RETRIES", 3))
+
+        # ツールの実行中などに、クライアントの切断を検知するために空のチャンクを返す間隔(秒)
+        self.heartbeat_interval = float(os.environ.get("STREAM_HEARTBEAT_INTERVAL", 5))
+
+        # 回答のトークン数の移動平均 (切断により生成を取り消した場合に、節約できたトークン数の見積もりに使う)
+        self.answer_tokens_average = None
+
+        # タイトル生成用の設定値 (デプロイ名を指定しない場合は各エンドポイントの回答生成と同じデプロイを使う)
+        self.title_model = os.environ.get("AZURE_OPENAI_TITLE_MODEL")
+        self.title_max_tokens = int(os.environ.get("AZURE_OPENAI_TITLE_MAX_TOKENS", 50))
+        self.title_excerpt_messages = int(os.environ.get("AZURE_OPENAI_TITLE_EXCERPT_MESSAGES", 3))
+        self.title_excerpt_chars = int(os.environ.get("AZURE_OPENAI_TITLE_EXCERPT_CHARS", 500))
 
         # Function Calling 用のツールを初期化
         self.tools = OpenAITools()
 
+        # 会話履歴をトークン数の上限に収めるためのコンテキスト管理を初期化
+        self.context = ContextWindow(self.model)
+
+        # 同じリクエストへの回答のキャッシュを初期化 (温度が 0 で回答が決定的な場合のみ使用する)
+        self.completion_cache = None
+        self.completion_cache_ttl = float(os.environ.get("AZURE_OPENAI_COMPLETION_CACHE_TTL", 3600))
+        if os.environ.get("AZURE_OPENAI_COMPLETION_CACHE_ENABLED") == "true" and float(self.temperature) == 0:
+            self.completion_cache = LRUCache(max_bytes=int(os.environ.get("AZURE_OPENAI_COMPLETION_CACHE_MAX_BYTES", 32 * 1024 * 1024)))
+
     def get_completion(self, messages: list[dict], json_mode: bool = False, stream: bool = False) -> any:
         """
         Azure OpenAI Service で回答を生成する
@@ -40,8 +96,8 @@ class OpenAIClient:
 
         messages = [{"role": "system", "content": self.system_message}] + messages
         response_format = {"type": "json_object"} if json_mode else None
-        resp = self.client.chat.completions.create(
-            model=self.model,
+        resp = self._create(
+            PRIORITY_INTERACTIVE,
             messages=messages,
             max_tokens=self.max_tokens,
             temperature=self.temperature,
@@ -53,107 +109,369 @@ class OpenAIClient:
         completion = resp.choices[0].message.content
         return json.loads(completion) if json_mode else completion
 
-    def get_completion_with_tools(self, messages: list[dict]) -> any:
+    def generate_title(self, messages: list[dict]) -> str:
+        """
+        会話の冒頭部分からチャットのタイトルを生成する
+
+        Args:
+            messages (list[dict]): 古い順に並んだチャットメッセージのリスト (冒頭の数件のみを使用する)
+
+        Returns:
+            str: 生成したタイトル
+        """
+        excerpt = "\n".join(
+            f"{m['role']}: {m['content'][: self.title_excerpt_chars]}" for m in messages[: self.title_excerpt_messages] if m.get("content")
+        )
+        user_message = f"""
+        以下の会話を元に、タイトルを生成してください。
+        タイトルは15文字以下で、以下のJSONフォーマットで出力してください。
+
+        # 出力フォーマット
+        {{"title": "{{生成したタイトル}}"}}
+
+        # 会話
+        {excerpt}
+        """
+        resp = self._create(
+            PRIORITY_TITLE,
+            deployment=self.title_model,
+            messages=[{"role": "user", "content": user_message}],
+            max_tokens=self.title_max_tokens,
+            temperature=0,
+            response_format={"type": "json_object"},
+        )
+        return json.loads(resp.choices[0].message.content)["title"]
+
+    def fit_context(self, messages: list[dict], summary: str = None) -> tuple[list[dict], list[dict]]:
+        """
+        会話履歴をシステムメッセージと要約を含めてトークン数の上限に収める
+
+        Args:
+            messages (list[dict]): 古い順に並んだチャットメッセージのリスト
+            summary (str): これまでの会話の要約
+
+        Returns:
+            tuple[list[dict], list[dict]]: 上限に収めたメッセージのリストと、切り捨てたメッセージのリスト
+        """
+        reserved_tokens = sum(self.context.count_tokens(m) for m in self._system_messages(summary))
+        return self.context.fit(messages, reserved_tokens=reserved_tokens)
+
+    def summarize(self, messages: list[dict], summary: str = None) -> str:
+        """
+        会話履歴を、これまでの要約と合わせて要約する
+
+        Args:
+            messages (list[dict]): 要約するチャットメッセージのリスト
+            summary (str): これまでの会話の要約
+
+        Returns:
+            str: 要約
+        """
+        conversation = "\n".join(f"{m['role']}: {m['content']}" for m in messages if m.get("content"))
+        user_message = f"""
+        以下の「これまでの要約」と「会話」を合わせて、後の会話で参照できるように簡潔に要約してください。
+        ユーザの質問内容、回答の要点、参照したURLやファイル名などの情報源は残してください。
+
+        # これまでの要約
+        {summary or "なし"}
+
+        # 会話
+        {conversation}
+        """
+        resp = self._create(
+            PRIORITY_SUMMARY,
+            messages=[{"role": "user", "content": user_message}],
+            max_tokens=int(os.environ.get("AZURE_OPENAI_SUMMARY_MAX_TOKENS", 1024)),
+            temperature=0,
+        )
+        return resp.choices[0].message.content
+
+    def get_completion_with_tools(self, messages: list[dict], summary: str = None) -> any:
         """
         Azure OpenAI Service で回答を生成する (Function Calling 対応)
 
         Args:
             messages (list[dict]): チャットメッセージのリスト
-            system_message (str): システムメッセージ
+            summary (str): これまでの会話の要約
         """
-        messages = [{"role": "system", "content": self.system_message}] + messages
+        messages = self._system_messages(summary) + messages
 
-        while True:
+        # キャッシュに同じリクエストへの回答があれば、生成時と同じ区切りでストリーミングする
+        # (回答は生成したデプロイごとにキャッシュし、リクエストを振り分けるいずれかのデプロイの回答があれば使う)
+        request_messages = list(messages)
+        if self.completion_cache is not None:
+            for deployment in sorted({e.deployment for e in self.pool.endpoints}):
+                key = self._completion_cache_key(deployment, request_messages, max_tokens=self.max_tokens, tools=self.tools.tools_definition)
+                cached = self.completion_cache.get(key)
+                if cached is not None:
+                    logger.debug(f"completion cache hit: {key}")
+                    yield from json.loads(cached)
+                    return
+        answer = []
+        resp, accumulator, span = None, None, None
 
-            # Azure OpenAI Service にリクエストを送信
-            resp = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                tools=self.tools.tools_definition,
-                tool_choice="auto" if len(self.tools.tools_definition) > 0 else None,
-                stream=True,
-            )
-
-            # Stream 形式で返される情報から、Completion か Tool Calls かを判定して対応する
-            role = ""
-            tool_calls = []
-            is_tool_calling = False
-            for chunk in resp:
-
-                # 1つ目は選択肢(choices)がないのでスキップ
-                if not chunk.choices:
-                    continue
-
-                # choice を1つに絞る
-                choice = chunk.choices[0]
-
-                # ロールを取得
-                role = choice.delta.role if choice.delta.role else role
-
-                # ツール呼び出し(Function Calling)かどうかを判定
-                if choice.delta.tool_calls:
-                    is_tool_calling = True
-
-                # ツール呼び出しがある場合は、ツール呼び出しの内容を取得
-                if is_tool_calling:
+        # ツールを呼び出した場合は、回答のキャッシュ有効期間を呼び出したツールの実行結果の有効期間までに短くする
+        # (実行結果をキャッシュしないツールを呼び出した場合は、回答もキャッシュしない)
+        cache_ttl = self.completion_cache_ttl
+
+        # クライアントが切断した場合は、yield している箇所で GeneratorExit が送出される
+        try:
+            while True:
+
+                # モデル呼び出しごとにスパンを作成し、最初のトークンまでの時間とトークン/秒を計測する
+                # (ジェネレータ内で yield をまたぐため、現在のコンテキストには設定しない)
+                span = tracer.start_span("openai.chat", attributes={"openai.model": self.model, "openai.messages": len(messages)})
+                prompt_bytes = len(json.dumps(messages, ensure_ascii=False).encode("utf-8"))
+                record("payload_bytes", prompt_bytes, kind="prompt")
+                start = time.perf_counter()
+                first_token_at = None
+                tokens = 0
 
-                    # 最後はツール呼び出し情報はない
-                    if not choice.delta.tool_calls:
+                # Azure OpenAI Service にリクエストを送信
+                resp = self._create(
+                    PRIORITY_INTERACTIVE,
+                    messages=messages,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    tools=self.tools.tools_definition,
+                    tool_choice="auto" if len(self.tools.tools_definition) > 0 else None,
+                    stream=True,
+                )
+
+                # Stream 形式で返される情報から、Completion か Tool Calls かを判定して対応する
+                # (ツール呼び出しは index ごとに組み立て、引数が揃ったものから実行を開始する)
+                role = ""
+                accumulator = ToolCallAccumulator(self.tools)
+                is_tool_calling = False
+                for chunk in resp:
+
+                    # 1つ目は選択肢(choices)がないのでスキップ
+                    if not chunk.choices:
                         continue
 
-                    # ツール呼び出し情報を取得
-                    for tool_call in choice.delta.tool_calls:
-                        if tool_call.function.arguments:
-                            tool_calls[-1]["function"]["arguments"] += tool_call.function.arguments
-                        else:
-                            tool_calls.append(
-                                {
-                                    "id": tool_call.id,
-                                    "type": tool_call.type,
-                                    "function": {
-                                        "name": tool_call.function.name,
-                                        "arguments": "",
-                                    },
-                                }
-                            )
+                    # choice を1つに絞る
+                    choice = chunk.choices[0]
+
+                    # ストリームの1チャンクを1トークンとみなして計測する
+                    if choice.delta.content or choice.delta.tool_calls:
+                        tokens += 1
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+
+                    # ロールを取得
+                    role = choice.delta.role if choice.delta.role else role
 
-                # ツール呼び出しでない場合は順次ユーザに返信
-                elif choice.delta.content:
-                    yield choice.delta.content
+                    # ツール呼び出し(Function Calling)の場合は、ツール呼び出し情報を追加
+                    # (ユーザに返す内容はないが、切断を検知できるように空のチャンクを返す)
+                    if choice.delta.tool_calls:
+                        is_tool_calling = True
+                        accumulator.add(choice.delta.tool_calls)
+                        yield ""
 
-            # ツール呼び出しの場合は、ツールを呼び出してその結果をメッセージに含める
-            if is_tool_calling:
+                    # ツール呼び出しでない場合は順次ユーザに返信
+                    elif choice.delta.content and not is_tool_calling:
+                        answer.append(choice.delta.content)
+                        yield choice.delta.content
 
-                messages.append(
+                # 計測結果を記録する
+                kind = "tool_calls" if is_tool_calling else "answer"
+                end = time.perf_counter()
+                if first_token_at is not None:
+                    record("chat_ttft_seconds", first_token_at - start, kind=kind)
+                    if end > first_token_at:
+                        record("chat_tokens_per_second", tokens / (end - first_token_at), kind=kind)
+                if is_tool_calling:
+                    record("chat_tool_calls", len(accumulator.calls))
+                span.set_attributes(
                     {
-                        "role": role,
-                        "tool_calls": [
-                            {
-                                "id": call["id"],
-                                "type": call["type"],
-                                "function": {"name": call["function"]["name"], "arguments": call["function"]["arguments"]},
-                            }
-                            for call in tool_calls
-                        ],
+                        "openai.kind": kind,
+                        "openai.ttft_ms": (first_token_at - start) * 1000 if first_token_at else -1,
+                        "openai.tokens": tokens,
+                        "openai.tool_calls": len(accumulator.calls),
+                        "openai.prompt_bytes": prompt_bytes,
                     }
                 )
+                span.end()
+                span = None
 
-                # 関数呼び出しを行う
-                for tool_call in tool_calls:
-                    func_name = tool_call["function"]["name"]
-                    func_args = json.loads(tool_call["function"]["arguments"])
-                    func_response = eval(f"self.tools.{func_name}(**func_args)")
+                # ツール呼び出しの場合は、ツールを呼び出してその結果をメッセージに含める
+                if is_tool_calling:
+
+                    # 実行を開始済みのツールも含め、全てのツールの実行結果を待つ
+                    # (待っている間も切断を検知できるように、一定間隔で空のチャンクを返す)
+                    deadline = time.monotonic() + self.tools.timeout
+                    while not accumulator.wait(min(self.heartbeat_interval, max(0, deadline - time.monotonic()))) and time.monotonic() < deadline:
+                        yield ""
+                    tool_calls, func_responses = accumulator.finish(max(0, deadline - time.monotonic()))
+                    cache_ttl = min([cache_ttl] + [self.tools.cache_ttls.get(call["function"]["name"], 0) for call in tool_calls])
                     messages.append(
                         {
-                            "tool_call_id": tool_call["id"],
-                            "role": "tool",
-                            "name": func_name,
-                            "content": func_response,
+                            "role": role,
+                            "tool_calls": [
+                                {
+                                    "id": call["id"],
+                                    "type": call["type"],
+                                    "function": {"name": call["function"]["name"], "arguments": call["function"]["arguments"]},
+                                }
+                                for call in tool_calls
+                            ],
                         }
                     )
 
-            # 一連のチャット処理が終わったら終了
-            else:
-                break
+                    # 呼び出し順に結果をメッセージに含める
+                    for tool_call, func_response in zip(tool_calls, func_responses):
+                        messages.append(
+                            {
+                                "tool_call_id": tool_call["id"],
+                                "role": "tool",
+                                "name": tool_call["function"]["name"],
+                                "content": func_response,
+                            }
+                        )
+
+                # 一連のチャット処理が終わったら、回答をキャッシュして終了
+                else:
+                    self._update_answer_tokens(len(answer))
+                    if self.completion_cache is not None and answer and cache_ttl > 0:
+                        key = self._completion_cache_key(resp.deployment, request_messages, max_tokens=self.max_tokens, tools=self.tools.tools_definition)
+                        self.completion_cache.set(key, json.dumps(answer, ensure_ascii=False), cache_ttl)
+                    break
+
+        except GeneratorExit:
+            self._cancel(resp, accumulator, span, len(answer))
+            raise
+
+    def _cancel(self, resp, accumulator: ToolCallAccumulator, span, answer_tokens: int):
+        """
+        クライアントが切断した場合に、モデルのストリームを閉じて未完了のツール呼び出しを取り消す
+
+        Args:
+            resp (PeekedStream): 受信中のモデルのストリーム
+            accumulator (ToolCallAccumulator): 組み立て中・実行中のツール呼び出し
+            span (Span): 終了していないスパン
+            answer_tokens (int): それまでに生成した回答のトークン数
+        """
+        if resp is not None:
+            try:
+                resp.close()
+            except Exception as e:
+                logger.warning(f"failed to close the model stream: {e}")
+        cancelled_tool_calls = accumulator.cancel() if accumulator is not None else 0
+        if span is not None:
+            span.set_attribute("openai.cancelled", True)
+            span.end()
+
+        # 回答のトークン数の平均から、生成しなかった残りのトークン数を見積もる
+        saved_tokens = max(0, round(self.answer_tokens_average or 0) - answer_tokens)
+        record("chat_cancelled", 1)
+        record("chat_cancelled_tokens_saved", saved_tokens)
+        logger.info(f"client disconnected, cancelled generation (answer tokens: {answer_tokens}, tool calls: {cancelled_tool_calls}, saved tokens: ~{saved_tokens})")
+
+    def _update_answer_tokens(self, tokens: int):
+        # 回答のトークン数の移動平均を更新する (競合して更新が失われても見積もりには影響しない)
+        if self.answer_tokens_average is None:
+            self.answer_tokens_average = float(tokens)
+        else:
+            self.answer_tokens_average += 0.1 * (tokens - self.answer_tokens_average)
+
+    def completion_cache_stats(self) -> dict:
+        """
+        回答のキャッシュの統計情報(ヒット数・ミス数・削除数など)を取得する
+        """
+        return self.completion_cache.stats() if self.completion_cache is not None else {}
+
+    def endpoint_stats(self) -> dict:
+        """
+        エンドポイントごとの統計情報(応答時間・失敗回数・サーキットの状態・スケジューラの状態)を取得する
+        """
+        return self.pool.stats()
+
+    def _create(self, priority: int, deployment: str = None, **kwargs) -> any:
+        """
+        エンドポイントを選び、スケジューラで実行が許可されてから Azure OpenAI Service にリクエストを送信する
+
+        接続エラー・5xx 応答・タイムアウトの場合は別のエンドポイントにフェイルオーバーする。ストリームの場合は
+        最初のトークンを受け取るまでに失敗した場合も同様にフェイルオーバーする (回答を返し始めた後は切り替えない)。
+        429 応答の場合は retry-after の間そのエンドポイントのスケジューラを止め、別のエンドポイントで再試行する。
+        再試行は AZURE_OPENAI_MAX_RETRIES 回まで行う。
+
+        Args:
+            priority (int): 優先度 (PRIORITY_*)
+            deployment (str): デプロイ名 (指定しない場合は各エンドポイントのデプロイ)
+            **kwargs: chat.completions.create の引数 (model を除く)
+
+        Returns:
+            any: 回答(Completion)、またはストリーム
+        """
+        # プロンプト・ツール定義・最大出力トークン数の合計を、消費するトークン数の見込みとする (TPM を制限する場合のみ)
+        estimated = 0
+        if any(e.scheduler.tpm for e in self.pool.endpoints):
+            estimated = sum(self.context.count_tokens(m) for m in kwargs["messages"]) + int(kwargs.get("max_tokens") or 0)
+            if kwargs.get("tools"):
+                estimated += self.context.count_text(json.dumps(kwargs["tools"], ensure_ascii=False))
+
+        failed = set()
+        attempt = 0
+        while True:
+            endpoint = self.pool.choose(exclude=failed, tokens=estimated)
+            endpoint.scheduler.acquire(estimated, priority)
+            start = time.perf_counter()
+            try:
+                resp = endpoint.client.chat.completions.create(model=deployment or endpoint.deployment, **kwargs)
+                if kwargs.get("stream"):
+                    resp = PeekedStream(resp, deployment or endpoint.deployment)
+            except Exception as e:
+                retry_after = get_retry_after(e, attempt)
+                if retry_after is not None:
+                    endpoint.scheduler.throttle(retry_after)
+                elif self._is_endpoint_failure(e):
+                    self.pool.report_failure(endpoint)
+                else:
+                    raise
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"Azure OpenAI request to {endpoint.name} failed, retrying: {e}")
+                record("openai_retries", 1, endpoint=endpoint.name)
+
+                # 全てのエンドポイントで失敗した場合は、少し待ってから最初からやり直す
+                failed.add(endpoint.name)
+                if len(failed) >= len(self.pool.endpoints):
+                    failed.clear()
+                    if retry_after is None:
+                        time.sleep(min(0.5 * 2**attempt, 8))
+                attempt += 1
+                continue
+            self.pool.report_success(endpoint, time.perf_counter() - start)
+
+            # ストリームでない場合は、実際に消費したトークン数をバケットに反映する
+            if not kwargs.get("stream") and getattr(resp, "usage", None):
+                endpoint.scheduler.settle(estimated, resp.usage.total_tokens)
+            return resp
+
+    @staticmethod
+    def _is_endpoint_failure(error: Exception) -> bool:
+        # 接続エラー・タイムアウト・ストリームの切断・5xx 応答は、エンドポイント側の障害とみなす
+        import httpx
+        from openai import APIConnectionError
+
+        if isinstance(error, (APIConnectionError, httpx.TransportError)):
+            return True
+        status_code = getattr(error, "status_code", None)
+        return status_code is not None and (status_code >= 500 or status_code == 408)
+
+    def _completion_cache_key(self, deployment: str, messages: list[dict], **params) -> str:
+        # メッセージは回答に影響する項目のみを残し、前後の空白を除いて正規化する
+        normalized = []
+        for message in messages:
+            message = {k: v for k, v in message.items() if k in ("role", "content", "name", "tool_calls", "tool_call_id") and v is not None}
+            if isinstance(message.get("content"), str):
+                message["content"] = message["content"].strip()
+            normalized.append(message)
+        request = {"deployment": deployment, "messages": normalized, "temperature": float(self.temperature), **params}
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _system_messages(self, summary: str = None) -> list[dict]:
+        messages = [{"role": "system", "content": self.system_message}]
+        if summary:
+            messages.append({"role": "system", "content": f"これまでの会話の要約:\n{summary}"})
+        return messages
@@ -1,21 +1,50 @@
 import os
 import json
+import time
+import threading
+import contextvars
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError, wait
 from utils.logger import logger
-from utils.bing import BingSearchClient
-from utils.html import HtmlTool
-from utils.search import AzureSearchClient
+from utils.telemetry import tracer, record
+from utils.cache import LRUCache, SqliteCache, TieredCache
+from utils.context import ContextWindow
+from utils.deadline import request_deadline
+
+
+# ツールごとの実行結果のキャッシュ有効期間(秒)の既定値
+# OPENAI_TOOLS_CACHE_TTL_<ツール名(大文字)> 環境変数で上書きできる
+DEFAULT_CACHE_TTLS = {
+    "search_web_pages": 900,
+    "search_news": 300,
+    "search_documents": 900,
+    "get_html_by_url": 3600,
+}
+
+
+@lru_cache(maxsize=None)
+def load_tools_definition(path: str) -> tuple[dict]:
+    """
+    ツールの定義ファイル(JSON)を読み込む
+
+    Args:
+        path (str): 定義ファイルのパス
+
+    Returns:
+        tuple[dict]: ツールの定義のリスト
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Tools definition file not found: {path}")
+    with open(path, "r") as f:
+        return tuple(json.load(f))
 
 
 class OpenAITools:
 
     def __init__(self, tools_definition_path: str = "openai_tools.json"):
 
-        # ツールの定義ファイル(JSON)を読み込む
-        tools_definition_path = os.path.join(os.path.dirname(__file__), tools_definition_path)
-        if not os.path.exists(tools_definition_path):
-            raise FileNotFoundError(f"Tools definition file not found: {tools_definition_path}")
-        with open(tools_definition_path, "r") as f:
-            self.tools_definition = json.load(f)
+        # ツールの定義ファイル(JSON)を読み込む (プロセス内で1度だけ読み込む)
+        self.tools_definition = list(load_tools_definition(os.path.join(os.path.dirname(__file__), tools_definition_path)))
 
         # Bing Search API に関する設定がされていない場合は、Web検索とニュース検索の機能を無効化
         if not os.environ.get("BING_SEARCH_API_KEY"):
@@ -26,6 +55,170 @@ class OpenAITools:
         if not (os.environ.get("AZURE_SEARCH_ENDPOINT") and os.environ.get("AZURE_SEARCH_QUERY_KEY") and os.environ.get("AZURE_SEARCH_INDEX_NAME")):
             self.tools_definition = [t for t in self.tools_definition if t["function"]["name"] != "search_documents"]
 
+        # ツール名から呼び出す関数へのディスパッチテーブル (定義が有効なツールのみ)
+        functions = {
+            "search_web_pages": self.search_web_pages,
+            "search_news": self.search_news,
+            "search_documents": self.search_documents,
+            "get_html_by_url": self.get_html_by_url,
+        }
+        self.functions = {t["function"]["name"]: functions[t["function"]["name"]] for t in self.tools_definition}
+
+        # ツールを並列に呼び出すためのスレッドプールを初期化
+        # (gevent ワーカーではスレッドがグリーンレットになり、1プロセスで数百の回答を同時に生成するため、既定の上限を大きくする)
+        self.timeout = float(os.environ.get("OPENAI_TOOLS_TIMEOUT", 30))
+        max_workers = int(os.environ.get("OPENAI_TOOLS_MAX_WORKERS", 256 if os.environ.get("SERVER_MODE", "async") == "async" else 32))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="openai-tools")
+
+        # ツールの実行結果のキャッシュを初期化 (共有キャッシュのパスが指定されている場合はワーカー間で共有する)
+        self.cache = None
+        if os.environ.get("OPENAI_TOOLS_CACHE_ENABLED", "true") == "true":
+            memory = LRUCache(max_bytes=int(os.environ.get("OPENAI_TOOLS_CACHE_MAX_BYTES", 64 * 1024 * 1024)))
+            shared_path = os.environ.get("OPENAI_TOOLS_CACHE_SQLITE_PATH")
+            shared = SqliteCache(shared_path, max_bytes=int(os.environ.get("OPENAI_TOOLS_CACHE_SQLITE_MAX_BYTES", 256 * 1024 * 1024))) if shared_path else None
+            self.cache = TieredCache(memory, shared)
+        self.cache_ttls = {name: float(os.environ.get(f"OPENAI_TOOLS_CACHE_TTL_{name.upper()}", ttl)) for name, ttl in DEFAULT_CACHE_TTLS.items()}
+
+        # Webページの内容から返す段落の合計トークン数の上限
+        self.html_token_budget = int(os.environ.get("OPENAI_TOOLS_HTML_TOKEN_BUDGET", 3000))
+        self.context = ContextWindow(os.environ.get("AZURE_OPENAI_MODEL", "gpt-4o"))
+
+        # 外部サービスのクライアントはプロセス内で1つずつ作成して使い回す
+        self._bing = None
+        self._search_client = None
+        self._clients_lock = threading.Lock()
+
+    # 外部サービスのクライアントのモジュールは、使用する時に読み込む
+    @property
+    def bing(self) -> "BingSearchClient":
+        if self._bing is None:
+            with self._clients_lock:
+                if self._bing is None:
+                    from utils.bing import BingSearchClient
+
+                    self._bing = BingSearchClient()
+        return self._bing
+
+    @property
+    def search_client(self) -> "AzureSearchClient":
+        if self._search_client is None:
+            with self._clients_lock:
+                if self._search_client is None:
+                    from utils.search import AzureSearchClient
+
+                    self._search_client = AzureSearchClient()
+        return self._search_client
+
+    def call(self, name: str, arguments: str) -> str:
+        """
+        ツールを呼び出す
+
+        Args:
+            name (str): ツール名
+            arguments (str): ツールの引数 (JSON文字列)
+
+        Returns:
+            str: ツールの実行結果
+        """
+        if name not in self.functions:
+            raise ValueError(f"Unknown tool: {name}")
+        kwargs = json.loads(arguments)
+
+        # ツール呼び出しごとにスパンを作成し、所要時間と結果の大きさを記録する
+        with tracer.start_as_current_span(f"tool.{name}") as span:
+            start = time.perf_counter()
+            status = "error"
+            try:
+                result, cache_hit = self._call(name, kwargs)
+                status = "ok"
+            finally:
+                record("tool_duration_seconds", time.perf_counter() - start, tool=name, status=status)
+            result_bytes = len(result.encode("utf-8"))
+            record("payload_bytes", result_bytes, kind="tool_result")
+            span.set_attributes({"tool.cache_hit": cache_hit, "tool.result_bytes": result_bytes})
+            return result
+
+    def _call(self, name: str, kwargs: dict) -> tuple[str, bool]:
+        # キャッシュを使用しない場合はそのまま呼び出す
+        ttl = self.cache_ttls.get(name, 0)
+        if self.cache is None or ttl <= 0:
+            return self.functions[name](**kwargs), False
+
+        # 正規化した引数をキーにキャッシュを参照し、なければ呼び出してキャッシュする
+        key = self._cache_key(name, kwargs)
+        result = self.cache.get(key)
+        if result is not None:
+            logger.debug(f"tool cache hit: {key}")
+            return result, True
+        result = self.functions[name](**kwargs)
+        self.cache.set(key, result, ttl)
+        return result, False
+
+    def cache_stats(self) -> dict:
+        """
+        ツールの実行結果のキャッシュの統計情報(ヒット数・ミス数・削除数など)を取得する
+        """
+        return self.cache.stats() if self.cache is not None else {}
+
+    @staticmethod
+    def _cache_key(name: str, kwargs: dict) -> str:
+        # 検索クエリは前後の空白・連続する空白・大文字小文字の違いを無視する
+        normalized = {}
+        for key, value in kwargs.items():
+            if key == "query" and isinstance(value, str):
+                value = " ".join(value.split()).lower()
+            normalized[key] = value
+        return f"{name}:{json.dumps(normalized, sort_keys=True, ensure_ascii=False)}"
+
+    def submit(self, tool_call: dict) -> Future:
+        """
+        ツールの呼び出しをスレッドプールで開始する
+
+        Args:
+            tool_call (dict): ツール呼び出し情報
+
+        Returns:
+            Future: ツールの実行結果を受け取るための Future
+        """
+        # 呼び出し元のトレースのコンテキストをワーカースレッドへ引き継ぐ
+        # (スレッドプールで待たされた時間も含めて、開始から OPENAI_TOOLS_TIMEOUT 秒以内に HTTP リクエストを終わらせる)
+        deadline = time.monotonic() + self.timeout
+        name, arguments = tool_call["function"]["name"], tool_call["function"]["arguments"]
+        return self.executor.submit(contextvars.copy_context().run, self._call_until, deadline, name, arguments)
+
+    def _call_until(self, deadline: float, name: str, arguments: str) -> str:
+        with request_deadline(deadline):
+            return self.call(name, arguments)
+
+    def collect(self, tool_calls: list[dict], futures: list[Future], timeout: float = None) -> list[str]:
+        """
+        開始したツールの呼び出しの完了を待ち、呼び出し順に結果を返す
+
+        タイムアウトや例外が発生したツールは、その内容を結果として返す。
+
+        Args:
+            tool_calls (list[dict]): ツール呼び出し情報のリスト
+            futures (list[Future]): submit で開始した呼び出しの Future のリスト (tool_calls と同じ順序)
+            timeout (float): 待つ時間(秒) (指定しない場合は OPENAI_TOOLS_TIMEOUT)
+
+        Returns:
+            list[str]: ツールの実行結果のリスト (tool_calls と同じ順序)
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        results = []
+        for tool_call, future in zip(tool_calls, futures):
+            name = tool_call["function"]["name"]
+            try:
+                results.append(future.result(timeout=max(0, deadline - time.monotonic())))
+            except TimeoutError:
+                future.cancel()
+                logger.warning(f"tool call timed out: {name} ({self.timeout}s)")
+                results.append(json.dumps({"error": f"{name} timed out after {self.timeout} seconds"}))
+            except Exception as e:
+                logger.exception(e)
+                results.append(json.dumps({"error": f"{name} failed: {e}"}, ensure_ascii=False))
+        return results
+
     def search_web_pages(self, query: str, count: int = 3, offset: int = 0) -> str:
         """
         Bing Web検索APIを利用して、指定されたクエリに一致するWebページを検索する。
@@ -39,8 +232,7 @@ class OpenAITools:
             str: 検索結果のJSON文字列
         """
         logger.info(f"search_web_pages: query={query}, count={count}, offset={offset}")
-        bing = BingSearchClient()
-        pages = bing.search_web_pages(query, count=count, offset=offset)
+        pages = self.bing.search_web_pages(query, count=count, offset=offset)
         return json.dumps(pages, ensure_ascii=False)
 
     def search_news(self, query: str, count: int = 3, offset: int = 0) -> str:
@@ -56,27 +248,139 @@ class OpenAITools:
             str: 検索結果のJSON文字列
         """
         logger.info(f"search_news: query={query}, count={count}, offset={offset}")
-        bing = BingSearchClient()
-        news = bing.search_news(query, count=count, offset=offset)
+        news = self.bing.search_news(query, count=count, offset=offset)
         return json.dumps(news, ensure_ascii=False)
 
     def search_documents(self, query: str, count: int = 3, offset: int = 0) -> str:
         logger.info(f"search_documents: query={query}, count={count}, offset={offset}")
-        search_client = AzureSearchClient()
-        docs = search_client.search(query, top=count, skip=offset)
+        docs = self.search_client.search(query, top=count, skip=offset)
         return json.dumps(docs, ensure_ascii=False)
 
-    def get_html_by_url(self, url: str) -> str:
+    def get_html_by_url(self, url: str, query: str = None, full: bool = False) -> str:
         """
-        指定されたURLのWebページのHTMLを取得する
+        指定されたURLのWebページの内容を取得する
+
+        既定では、ページを段落に分割してクエリとの関連度の高い段落だけを OPENAI_TOOLS_HTML_TOKEN_BUDGET
+        トークンまで返す。full が指定された場合は、不要なタグを削除したページ全体のHTMLを返す。
 
         Args:
             url (str): WebページのURL
+            query (str): 段落を選ぶためのクエリ (指定がない場合はページの先頭から選ぶ)
+            full (bool): ページ全体のHTMLを返すかどうか
 
         Returns:
-            str: WebページのHTML
+            str: WebページのHTML、または選んだ段落のJSON文字列
         """
-        logger.info(f"get_html_by_url: url={url}")
+        logger.info(f"get_html_by_url: url={url}, query={query}, full={full}")
+        from utils.html import HtmlTool
+        from utils.passages import select_passages
+
         html = HtmlTool.get_html(url)
         html = HtmlTool.remove_unnecessary_html_tags(html)
-        return html
+        if full:
+            return html
+
+        passages = HtmlTool.extract_passages(html, base_url=url)
+        selected = select_passages(passages, query, self.html_token_budget, self.context.count_text)
+        result = {"url": url, "passages": selected}
+        if len(selected) < len(passages):
+            result["note"] = f"Only {len(selected)} of {len(passages)} passages relevant to the query are included. Call again with full=true to get the whole page."
+        return json.dumps(result, ensure_ascii=False)
+
+
+class ToolCallAccumulator:
+    """
+    ストリーミングで返されるツール呼び出しの断片を、index ごとに組み立てる
+
+    引数の JSON が完結したツール呼び出しは、モデルが次のツール呼び出しを生成している間に実行を開始する。
+
+    Args:
+        tools (OpenAITools): ツールを呼び出す OpenAITools
+    """
+
+    def __init__(self, tools: OpenAITools):
+        self.tools = tools
+        self.calls = {}  # index -> ツール呼び出し情報
+        self.futures = {}  # index -> 実行結果の Future
+
+    def add(self, deltas: list) -> None:
+        """
+        ストリームの1チャンクに含まれるツール呼び出しの断片を追加する
+
+        Args:
+            deltas (list): チャンクの delta.tool_calls
+        """
+        for delta in deltas:
+            call = self.calls.setdefault(delta.index, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+            if delta.id:
+                call["id"] = delta.id
+            if delta.type:
+                call["type"] = delta.type
+            if delta.function is not None:
+                if delta.function.name:
+                    call["function"]["name"] += delta.function.name
+                if delta.function.arguments:
+                    call["function"]["arguments"] += delta.function.arguments
+
+            # 複数のツール呼び出しの断片が交互に届く場合もあるため、引数の JSON が完結したかどうかで判定する
+            if self._is_complete(call):
+                self._dispatch(delta.index)
+
+    def wait(self, timeout: float) -> bool:
+        """
+        未実行のツール呼び出しを開始し、全ての実行が終わるまで最大 timeout 秒待つ
+
+        Args:
+            timeout (float): 待つ時間(秒)
+
+        Returns:
+            bool: 全ての実行が終わったかどうか
+        """
+        for index in self.calls:
+            self._dispatch(index)
+        _, not_done = wait(self.futures.values(), timeout=timeout)
+        return not not_done
+
+    def finish(self, timeout: float = None) -> tuple[list[dict], list[str]]:
+        """
+        未実行のツール呼び出しを開始し、全ての実行結果を待つ
+
+        Args:
+            timeout (float): 待つ時間(秒) (指定しない場合は OPENAI_TOOLS_TIMEOUT)
+
+        Returns:
+            tuple[list[dict], list[str]]: index 順のツール呼び出し情報のリストと、その実行結果のリスト
+        """
+        for index in self.calls:
+            self._dispatch(index)
+        indexes = sorted(self.calls)
+        tool_calls = [self.calls[i] for i in indexes]
+        return tool_calls, self.tools.collect(tool_calls, [self.futures[i] for i in indexes], timeout)
+
+    def cancel(self) -> int:
+        """
+        まだ実行が始まっていないツール呼び出しを取り消す (実行中のものは完了を待たずに結果を破棄する)
+
+        Returns:
+            int: 完了していなかったツール呼び出しの数
+        """
+        pending = [f for f in self.futures.values() if not f.done()]
+        for future in pending:
+            future.cancel()
+        return len(pending)
+
+    def _dispatch(self, index: int):
+        if index not in self.futures:
+            self.futures[index] = self.tools.submit(self.calls[index])
+
+    @staticmethod
+    def _is_complete(call: dict) -> bool:
+        # 引数は JSON オブジェクトなので、閉じ括弧で終わり解析できれば完結している
+        arguments = call["function"]["arguments"]
+        if not (call["id"] and call["function"]["name"] and arguments.rstrip().endswith("}")):
+            return False
+        try:
+            json.loads(arguments)
+            return True
+        except ValueError:
+            return False
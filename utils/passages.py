@@ -0,0 +1,94 @@
+import re
+import math
+from collections import Counter
+from typing import Callable
+
+# 英数字は単語単位、日本語などのそれ以外の文字は2文字ずつ(bi-gram)に区切る
+WORD_PATTERN = re.compile(r"[a-z0-9]+|[^\W\d_a-z]+")
+
+# BM25 のパラメータ
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    BM25 で使用する単語に分割する
+
+    Args:
+        text (str): テキスト
+
+    Returns:
+        list[str]: 単語のリスト
+    """
+    tokens = []
+    for word in WORD_PATTERN.findall(text.lower()):
+        if word.isascii() or len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i : i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def rank_passages(passages: list[str], query: str) -> list[float]:
+    """
+    クエリに対する各段落の関連度を BM25 で計算する
+
+    Args:
+        passages (list[str]): 段落のリスト
+        query (str): クエリ
+
+    Returns:
+        list[float]: 段落ごとのスコア (passages と同じ順序)
+    """
+    documents = [Counter(tokenize(p)) for p in passages]
+    if not documents:
+        return []
+    lengths = [sum(d.values()) for d in documents]
+    average_length = sum(lengths) / len(lengths) or 1
+    document_frequency = Counter(term for d in documents for term in d)
+
+    scores = []
+    query_terms = set(tokenize(query))
+    for document, length in zip(documents, lengths):
+        score = 0.0
+        for term in query_terms:
+            frequency = document.get(term, 0)
+            if frequency == 0:
+                continue
+            idf = math.log(1 + (len(documents) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+            score += idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+        scores.append(score)
+    return scores
+
+
+def select_passages(passages: list[str], query: str, token_budget: int, count_tokens: Callable[[str], int]) -> list[str]:
+    """
+    クエリとの関連度の高い段落から、トークン数の上限に収まるだけ選ぶ
+
+    クエリが空の場合は文書の先頭から選ぶ。選んだ段落は文書の順に並べて返す。
+
+    Args:
+        passages (list[str]): 文書の順に並んだ段落のリスト
+        query (str): クエリ
+        token_budget (int): 選ぶ段落の合計トークン数の上限
+        count_tokens (Callable[[str], int]): テキストのトークン数を数える関数
+
+    Returns:
+        list[str]: 選んだ段落のリスト (文書の順)
+    """
+    if query and query.strip():
+        scores = rank_passages(passages, query)
+        order = sorted(range(len(passages)), key=lambda i: (-scores[i], i))
+    else:
+        order = list(range(len(passages)))
+
+    selected = []
+    total = 0
+    for i in order:
+        tokens = count_tokens(passages[i])
+        if total + tokens > token_budget:
+            continue
+        selected.append(i)
+        total += tokens
+    return [passages[i] for i in sorted(selected)]
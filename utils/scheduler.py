@@ -0,0 +1,214 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+from email.utils import parsedate_to_datetime
+from utils.logger import logger
+from utils.telemetry import record
+
+# リクエストの優先度 (小さいほど先に実行する)
+PRIORITY_INTERACTIVE = 0  # ユーザが待っている回答の生成
+PRIORITY_SUMMARY = 1  # 会話履歴の要約
+PRIORITY_TITLE = 2  # タイトルの生成
+
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_SUMMARY: "summary", PRIORITY_TITLE: "title"}
+
+# プロセス内で共有するスケジューラ
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class RateLimitScheduler:
+    """
+    Azure OpenAI Service へのリクエストを、デプロイのクォータ (TPM/RPM) に合わせて実行するスケジューラ
+
+    トークン数とリクエスト数のトークンバケットで実行を許可し、許可できないリクエストは
+    優先度順(同じ優先度の場合は到着順)に待たせる。429 応答の retry-after の間は全てのリクエストを待たせる。
+    AZURE_OPENAI_TPM_LIMIT・AZURE_OPENAI_RPM_LIMIT が 0 の場合は、その制限を行わない (retry-after による待機のみ行う)。
+    """
+
+    def __init__(self, tpm: int = None, rpm: int = None):
+
+        # 各種設定値を環境変数から取得 (エンドポイントごとに上限を指定する場合は引数で指定する)
+        self.tpm = int(tpm if tpm is not None else os.getenv("AZURE_OPENAI_TPM_LIMIT", 0))
+        self.rpm = int(rpm if rpm is not None else os.getenv("AZURE_OPENAI_RPM_LIMIT", 0))
+        self.max_wait = float(os.getenv("AZURE_OPENAI_SCHEDULER_MAX_WAIT", 60))
+
+        # トークンバケット (上限まで貯まった状態から始める)
+        self.tokens = float(self.tpm)
+        self.requests = float(self.rpm)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0  # retry-after で指定された、リクエストを再開できる時刻
+
+        # 実行を待っているリクエストの優先度付きキュー: (優先度, 到着順)
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.admitted = 0
+        self.throttled = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.tpm > 0 or self.rpm > 0
+
+    def acquire(self, tokens: int, priority: int = PRIORITY_INTERACTIVE):
+        """
+        リクエストの実行が許可されるまで待つ
+
+        Args:
+            tokens (int): リクエストが消費する見込みのトークン数 (プロンプトと max_tokens の合計)
+            priority (int): 優先度 (PRIORITY_*)
+
+        Raises:
+            TimeoutError: AZURE_OPENAI_SCHEDULER_MAX_WAIT 秒待っても許可されなかった場合
+        """
+        tokens = min(tokens, self.tpm) if self.tpm else tokens
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        with self.condition:
+            entry = (priority, next(self.counter))
+            heapq.heappush(self.queue, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+
+                    # 先頭のリクエストのみ、バケットに十分な残量があれば実行を許可する
+                    wait = None
+                    if self.queue[0] == entry:
+                        wait = self._wait_time(tokens, now)
+                        if wait <= 0:
+                            heapq.heappop(self.queue)
+                            self.tokens -= tokens if self.tpm else 0
+                            self.requests -= 1 if self.rpm else 0
+                            self.admitted += 1
+                            self.condition.notify_all()
+                            break
+                    if now >= deadline:
+                        raise TimeoutError(f"Azure OpenAI request was not admitted within {self.max_wait} seconds")
+                    self.condition.wait(timeout=min(wait or deadline - now, deadline - now))
+            except BaseException:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                self.condition.notify_all()
+                raise
+        record("openai_queue_wait_seconds", time.monotonic() - start, priority=PRIORITY_NAMES.get(priority, str(priority)))
+
+    def expected_wait(self, tokens: int = 0) -> float:
+        """
+        今リクエストした場合に、実行が許可されるまでの待ち時間の見込みを取得する
+
+        retry-after による待機と、既に待っているリクエストを含めてバケットの残量が足りるまでの時間から見積もる
+        (待っているリクエストのトークン数は、指定したトークン数と同じとみなす)。
+
+        Args:
+            tokens (int): リクエストが消費する見込みのトークン数
+
+        Returns:
+            float: 待ち時間の見込み(秒) (すぐに実行できる場合は 0 以下)
+        """
+        with self.condition:
+            now = time.monotonic()
+            self._refill(now)
+            ahead = len(self.queue) + 1
+            wait = self.blocked_until - now
+            if self.tpm:
+                wait = max(wait, (min(tokens, self.tpm) * ahead - self.tokens) * 60 / self.tpm)
+            if self.rpm:
+                wait = max(wait, (ahead - self.requests) * 60 / self.rpm)
+            return wait
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """
+        実際に消費したトークン数が分かった場合に、見込みとの差をバケットに反映する
+
+        Args:
+            estimated_tokens (int): acquire で指定したトークン数
+            actual_tokens (int): 実際に消費したトークン数
+        """
+        if not self.tpm:
+            return
+        with self.condition:
+            self.tokens = min(float(self.tpm), self.tokens + min(estimated_tokens, self.tpm) - actual_tokens)
+            self.condition.notify_all()
+
+    def throttle(self, seconds: float):
+        """
+        429 応答を受け取った場合に、指定された秒数の間は全てのリクエストを待たせる
+
+        Args:
+            seconds (float): retry-after で指定された秒数
+        """
+        with self.condition:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.throttled += 1
+        record("openai_throttled", 1)
+        logger.warning(f"Azure OpenAI rate limited, pausing requests for {seconds:.1f}s")
+
+    def stats(self) -> dict:
+        """
+        キューの長さやバケットの残量などの統計情報を取得する
+        """
+        with self.condition:
+            self._refill(time.monotonic())
+            return {
+                "queue_depth": len(self.queue),
+                "tokens_available": self.tokens,
+                "requests_available": self.requests,
+                "admitted": self.admitted,
+                "throttled": self.throttled,
+            }
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.tokens = min(float(self.tpm), self.tokens + elapsed * self.tpm / 60)
+        self.requests = min(float(self.rpm), self.requests + elapsed * self.rpm / 60)
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        # バケットの残量が足りるまでの時間 (retry-after で待たされている場合はその時刻まで)
+        wait = self.blocked_until - now
+        if self.tpm and self.tokens < tokens:
+            wait = max(wait, (tokens - self.tokens) * 60 / self.tpm)
+        if self.rpm and self.requests < 1:
+            wait = max(wait, (1 - self.requests) * 60 / self.rpm)
+        return wait
+
+
+def get_scheduler() -> RateLimitScheduler:
+    """
+    プロセス内で共有するスケジューラを取得する (初回呼び出し時に作成する)
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = RateLimitScheduler()
+    return _scheduler
+
+
+def get_retry_after(error: Exception, attempt: int) -> float:
+    """
+    429 応答の例外から、再試行までに待つ秒数を取得する
+
+    Args:
+        error (Exception): Azure OpenAI Service の呼び出しで発生した例外
+        attempt (int): 何回目の再試行か (ヘッダーがない場合の指数バックオフに使う)
+
+    Returns:
+        float: 待つ秒数 (429 応答でない場合は None)
+    """
+    if getattr(error, "status_code", None) != 429:
+        return None
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    return float(2**attempt)
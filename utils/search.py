@@ -1,7 +1,11 @@
 import os
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.models import VectorizableTextQuery, VectorizedQuery
-from azure.search.documents.indexes import SearchIndexClient
+from azure.search.documents import SearchClient
+from utils.http import get_timeout
+from utils.deadline import remaining_time
+from utils.logger import logger
+from utils.embedding import QueryEmbedder
 
 
 class AzureSearchClient:
@@ -17,9 +21,23 @@ class AzureSearchClient:
         self.vector_field_names = os.getenv("AZURE_SEARCH_VECTOR_FIELD_NAMES", "")
         self.vector_field_names = self.vector_field_names.split(",") if self.vector_field_names else []
 
-        # Azure AI Search にアクセスするためのクライアントの初期化
-        index_client = SearchIndexClient(endpoint=endpoint, credential=AzureKeyCredential(key), api_version=api_version)
-        self.search_client = index_client.get_search_client(index_name)
+        # 埋め込みモデルのデプロイ名が指定されている場合は、クエリのベクトルをアプリ側で計算して全てのベクトルフィールドで使い回す
+        # (指定されていない場合は、検索サービス側でベクトルフィールドごとにクエリをベクトル化する)
+        self.embedder = QueryEmbedder() if os.getenv("AZURE_OPENAI_EMBEDDING_MODEL") and self.vector_field_names else None
+
+        # Azure AI Search にアクセスするためのクライアントの初期化 (接続プール・タイムアウト・リトライを設定)
+        # (クライアントはプロセス内で使い回すため、ツール呼び出しの期限は考慮せず、期限は検索ごとに指定する)
+        connection_timeout, read_timeout = get_timeout(respect_deadline=False)
+        self.search_client = SearchClient(
+            endpoint=endpoint,
+            index_name=index_name,
+            credential=AzureKeyCredential(key),
+            api_version=api_version,
+            connection_timeout=connection_timeout,
+            read_timeout=read_timeout,
+            retry_total=int(os.getenv("HTTP_MAX_RETRIES", 3)),
+            retry_backoff_factor=float(os.getenv("HTTP_RETRY_BACKOFF", 0.5)),
+        )
 
     # インデックスを検索する
     def search(self, query: str = None, query_vector: list[float] = None, top: int = 10, skip: int = 0, filter: str = None) -> list[dict]:
@@ -36,7 +54,18 @@ class AzureSearchClient:
         Returns:
             list[dict]: 検索結果のドキュメント一覧
         """
+        if query_vector is None and query and self.embedder is not None:
+            try:
+                query_vector = self.embedder.embed(query)
+            except Exception as e:
+                logger.warning(f"falling back to service-side vectorization: {e}")
+
+        # ツール呼び出しの期限が指定されている場合は、再試行も含めて期限までに終わらせる
+        remaining = remaining_time()
+        deadline_options = {"timeout": remaining, "read_timeout": min(get_timeout(respect_deadline=False)[1], remaining)} if remaining is not None else {}
+
         docs = self.search_client.search(
+            **deadline_options,
             search_text=query,
             query_type="semantic" if self.use_semantic_search else "full",
             filter=filter,
@@ -0,0 +1,215 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+
+class AnswerStream:
+    """
+    生成中・生成済みの回答のストリーム
+
+    回答を生成するスレッドが差分(delta)を追加し、クライアントへ返却するジェネレータがそれを読み出す。
+    クライアントが切断しても生成は続けるため、再接続したクライアントは途中から読み出しを再開できる。
+
+    Args:
+        talk_id (str): チャットID
+        user_id (str): ユーザID
+        id (str): ストリームID (指定しない場合は新しく発行する)
+    """
+
+    def __init__(self, talk_id: str, user_id: str, id: str = None):
+        self.id = id or str(uuid.uuid4())
+        self.talk_id = talk_id
+        self.user_id = user_id
+        self.deltas = []  # 生成した回答の差分 (インデックスがプロトコル v2 の seq になる)
+        self.done = False  # 回答の生成が終わったかどうか
+        self.truncated = False  # 回答の生成を途中で取り消したかどうか
+        self.error = False  # 回答の生成に失敗したかどうか
+        self.title = None  # 自動生成したタイトル
+        self.title_pending = False  # 完了時にタイトルを生成中だったかどうか (タイトルを返せなかった場合も、クライアントは生成を重複して依頼しない)
+        self.finished = False  # タイトルの生成などの後処理も含めて終わったかどうか
+        self.readers = 0  # 読み出し中のクライアントの数
+        self.detached_at = None  # 最後のクライアントが切断した時刻
+        self.remote_polled_at = 0.0  # 別のプロセスのクライアントが最後に途中経過を読み込んだ時刻 (time.time())
+        self.updated_at = time.monotonic()
+        self.condition = threading.Condition()
+
+    @property
+    def content(self) -> str:
+        return "".join(self.deltas)
+
+    def append(self, delta: str):
+        """
+        回答の差分を追加する
+        """
+        with self.condition:
+            self.deltas.append(delta)
+            self._notify()
+
+    def complete(self, truncated: bool = False, error: bool = False, title_pending: bool = False):
+        """
+        回答の生成が終わったことを通知する
+
+        Args:
+            truncated (bool): 回答の生成を途中で取り消したかどうか
+            error (bool): 回答の生成に失敗したかどうか
+            title_pending (bool): タイトルを生成中かどうか
+        """
+        with self.condition:
+            self.done = True
+            self.truncated = truncated
+            self.error = error
+            self.title_pending = title_pending
+            self._notify()
+
+    def set_title(self, title: str):
+        with self.condition:
+            self.title = title
+            self._notify()
+
+    def finish(self):
+        """
+        後処理も含めて全て終わったこと (これ以上情報が追加されないこと) を通知する
+        """
+        with self.condition:
+            self.finished = True
+            self._notify()
+
+    def attach(self):
+        with self.condition:
+            self.readers += 1
+            self.detached_at = None
+
+    def detach(self):
+        with self.condition:
+            self.readers -= 1
+            if self.readers == 0:
+                self.detached_at = time.monotonic()
+
+    def touch(self, polled_at: float):
+        """
+        別のプロセスのクライアントが途中経過を読み込んだ時刻 (途中経過の lastPolledAt) を記録する
+        """
+        with self.condition:
+            self.remote_polled_at = max(self.remote_polled_at, polled_at or 0.0)
+
+    def abandoned(self, grace: float) -> bool:
+        """
+        全てのクライアントが切断してから grace 秒以上、再接続されていない (別のプロセスからも読み込まれていない) かどうか
+        """
+        with self.condition:
+            return (
+                self.readers == 0
+                and self.detached_at is not None
+                and time.monotonic() - self.detached_at >= grace
+                and time.time() - self.remote_polled_at >= grace
+            )
+
+    def checkpoint_chunk(self, start: int) -> dict:
+        """
+        途中経過として保存する、start 番目以降の差分 (連結した文字列と、差分ごとの長さ)
+
+        Args:
+            start (int): 最初の差分のインデックス (前回保存した差分の数)
+
+        Returns:
+            dict: {"text": 連結した差分, "lengths": 差分ごとの長さ}
+        """
+        deltas = self.deltas[start:]
+        return {"text": "".join(deltas), "lengths": [len(d) for d in deltas]}
+
+    def apply_checkpoint(self, checkpoint: dict):
+        """
+        別のプロセスで保存した途中経過のうち、まだ追加していない差分・完了・タイトルを追加する
+
+        Args:
+            checkpoint (dict): 保存した途中経過
+        """
+        deltas = []
+        for chunk in checkpoint.get("chunks", []):
+            position = 0
+            for length in chunk["lengths"]:
+                deltas.append(chunk["text"][position : position + length])
+                position += length
+        with self.condition:
+            self.deltas.extend(deltas[len(self.deltas) :])
+            if checkpoint.get("done") and not self.done:
+                self.done = True
+                self.truncated = checkpoint.get("truncated", False)
+                self.error = checkpoint.get("error", False)
+                self.title_pending = checkpoint.get("titlePending", False)
+            if checkpoint.get("title") and self.title is None:
+                self.title = checkpoint["title"]
+            if checkpoint.get("finished"):
+                self.finished = True
+            self._notify()
+
+    def wait(self, seq: int, done_sent: bool, title_sent: bool, timeout: float) -> bool:
+        """
+        まだ読み出していない差分・完了・タイトルなどが追加されるまで最大 timeout 秒待つ
+
+        Args:
+            seq (int): 次に読み出す差分のインデックス
+            done_sent (bool): 完了を読み出し済みかどうか
+            title_sent (bool): タイトルを読み出し済みかどうか
+            timeout (float): 待つ時間(秒)
+
+        Returns:
+            bool: 読み出す情報があるかどうか
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: len(self.deltas) > seq
+                or (self.done and not done_sent)
+                or (self.title is not None and not title_sent)
+                or self.finished,
+                timeout=timeout,
+            )
+
+    def _notify(self):
+        self.updated_at = time.monotonic()
+        self.condition.notify_all()
+
+
+class StreamRegistry:
+    """
+    プロセス内の回答のストリームを、ストリームIDで管理する
+
+    生成が終わったストリームは STREAM_RESUME_TTL 秒だけ保持し、再接続したクライアントが最後まで読み出せるようにする。
+    """
+
+    def __init__(self):
+        self.ttl = float(os.getenv("STREAM_RESUME_TTL", 300))
+        self.max_streams = int(os.getenv("STREAM_RESUME_MAX_STREAMS", 1000))
+        self.streams = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self, talk_id: str, user_id: str) -> AnswerStream:
+        """
+        新しいストリームを作成して登録する
+        """
+        stream = AnswerStream(talk_id, user_id)
+        with self.lock:
+            self._evict()
+            self.streams[stream.id] = stream
+        return stream
+
+    def get(self, stream_id: str) -> AnswerStream:
+        """
+        ストリームを取得する (存在しない場合や、保持期間が過ぎた場合は None)
+        """
+        with self.lock:
+            self._evict()
+            return self.streams.get(stream_id)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"streams": len(self.streams), "active": sum(1 for s in self.streams.values() if not s.finished)}
+
+    def _evict(self):
+        # 生成が終わって保持期間が過ぎたもの、上限を超えた分の古いものを削除する (生成中のものは削除しない)
+        now = time.monotonic()
+        for stream_id, stream in list(self.streams.items()):
+            if stream.finished and (now - stream.updated_at >= self.ttl or len(self.streams) > self.max_streams):
+                del self.streams[stream_id]
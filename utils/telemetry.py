@@ -0,0 +1,155 @@
+import time
+import threading
+from typing import Iterator
+from contextlib import contextmanager
+from opentelemetry import metrics, trace
+
+# OpenTelemetry のトレーサーとメーター (Azure Monitor が構成されている場合は Application Insights へ送信される)
+tracer = trace.get_tracer("kensaku-app")
+meter = metrics.get_meter("kensaku-app")
+
+# ヒストグラムのバケット境界 (Prometheus 形式の出力用)
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000, 10000, 100000, 1000000]
+
+# 計測する指標の定義: 名前 -> (種類, 単位, 説明)
+METRICS = {
+    "chat_ttft_seconds": ("histogram", "s", "Time to first token of a model response"),
+    "chat_tokens_per_second": ("histogram", "1/s", "Streamed tokens per second of a model response"),
+    "chat_tool_calls": ("counter", "1", "Number of tool calls requested by the model"),
+    "tool_duration_seconds": ("histogram", "s", "Duration of a tool call"),
+    "cosmos_request_charge": ("histogram", "RU", "Request units consumed by a Cosmos DB operation"),
+    "cosmos_latency_seconds": ("histogram", "s", "Latency of a Cosmos DB operation"),
+    "payload_bytes": ("histogram", "By", "Size of payloads sent to or received from the model, tools and clients"),
+    "openai_queue_wait_seconds": ("histogram", "s", "Time a model request waited for the rate limit scheduler"),
+    "openai_throttled": ("counter", "1", "Number of 429 responses from the model"),
+    "openai_endpoint_failures": ("counter", "1", "Number of failed requests to a model endpoint"),
+    "chat_cancelled": ("counter", "1", "Number of answers cancelled because the client disconnected"),
+    "chat_cancelled_tokens_saved": ("counter", "1", "Estimated output tokens not generated because the client disconnected"),
+    "openai_retries": ("counter", "1", "Number of model requests retried after a failure or 429"),
+}
+
+
+class LocalRegistry:
+    """
+    デバッグ実行時に Prometheus 形式で出力するための、プロセス内の指標の集計
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # (名前, 属性) -> {"count", "sum", "buckets"}
+
+    def record(self, name: str, value: float, attributes: dict):
+        key = (name, tuple(sorted(attributes.items())))
+        with self.lock:
+            entry = self.values.setdefault(key, {"count": 0, "sum": 0.0, "buckets": [0] * len(BUCKETS)})
+            entry["count"] += 1
+            entry["sum"] += value
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    entry["buckets"][i] += 1
+
+    def render(self, extra: dict[str, dict] = None) -> str:
+        """
+        集計した指標を Prometheus のテキスト形式で出力する
+
+        Args:
+            extra (dict[str, dict]): 追加で出力するゲージ (名前 -> {属性のラベル文字列: 値})
+        """
+        lines = []
+        with self.lock:
+            for (name, attributes), entry in sorted(self.values.items()):
+                kind = METRICS.get(name, ("histogram",))[0]
+                labels = ",".join(f'{k}="{v}"' for k, v in attributes)
+                if kind == "counter":
+                    lines.append(f"{name}_total{_braces(labels)} {entry['sum']}")
+                    continue
+                for bound, count in zip(BUCKETS, entry["buckets"]):
+                    lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="+Inf"}} {entry["count"]}')
+                lines.append(f"{name}_sum{_braces(labels)} {entry['sum']}")
+                lines.append(f"{name}_count{_braces(labels)} {entry['count']}")
+        for name, values in (extra or {}).items():
+            for labels, value in values.items():
+                lines.append(f"{name}{_braces(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _braces(labels: str) -> str:
+    return f"{{{labels}}}" if labels else ""
+
+
+registry = LocalRegistry()
+
+# OpenTelemetry の計測器を初期化
+_instruments = {}
+for _name, (_kind, _unit, _description) in METRICS.items():
+    if _kind == "counter":
+        _instruments[_name] = meter.create_counter(_name, unit=_unit, description=_description)
+    else:
+        _instruments[_name] = meter.create_histogram(_name, unit=_unit, description=_description)
+
+
+def record(name: str, value: float, **attributes):
+    """
+    指標を記録する (OpenTelemetry とプロセス内の集計の両方に記録する)
+
+    Args:
+        name (str): 指標の名前 (METRICS のキー)
+        value (float): 値
+        attributes: 指標の属性
+    """
+    instrument = _instruments[name]
+    if METRICS[name][0] == "counter":
+        instrument.add(value, attributes)
+    else:
+        instrument.record(value, attributes)
+    registry.record(name, value, attributes)
+
+
+@contextmanager
+def cosmos_operation(operation: str):
+    """
+    Cosmos DB の操作のスパンを作成し、レイテンシと消費した RU を記録する
+
+    Cosmos DB の SDK の response_hook に渡す関数を返す。
+
+    Args:
+        operation (str): 操作の名前 (read, patch など)
+    """
+    charges = []
+
+    def response_hook(headers: dict, *_):
+        charge = headers.get("x-ms-request-charge")
+        if charge:
+            charges.append(float(charge))
+
+    with tracer.start_as_current_span(f"cosmos.{operation}") as span:
+        start = time.perf_counter()
+        try:
+            yield response_hook
+        finally:
+            latency = time.perf_counter() - start
+            charge = sum(charges)
+            span.set_attribute("cosmos.request_charge", charge)
+            record("cosmos_latency_seconds", latency, operation=operation)
+            record("cosmos_request_charge", charge, operation=operation)
+
+
+def measure_stream(chunks: Iterator[str], kind: str) -> Iterator[str]:
+    """
+    ストリーミングで返却するデータをそのまま返し、返却しきった後に合計の大きさを記録する
+
+    Args:
+        chunks (Iterator[str]): 返却するデータ
+        kind (str): payload_bytes 指標の kind 属性
+    """
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk.encode("utf-8"))
+            yield chunk
+    finally:
+        # クライアントが切断した場合も、元のストリームを閉じて返却できた大きさを記録する
+        if hasattr(chunks, "close"):
+            chunks.close()
+        record("payload_bytes", size, kind=kind)